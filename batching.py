@@ -0,0 +1,222 @@
+"""batching
+Micro-batching of outgoing chat messages for the Chatterbox server
+
+Messages are not framed and written as soon as they are handled. They are
+held for a short window (or until enough of them pile up) and then every
+recipient gets all of theirs in a single MESSAGES frame. Recipients who can
+see exactly the same public messages share one encoded frame. Joins and
+leaves are batched the same way into USERS_JOINED/USERS_LEFT frames, so a
+burst of logins costs each client one frame rather than one per login.
+"""
+import asyncio
+import time
+
+import codec
+import metrics
+from framing import Frame
+from metrics import log
+
+DEFAULT_WINDOW = 0.002  # Seconds messages may wait to be batched
+DEFAULT_MAX_MESSAGES = 64  # Pending messages that force a flush
+
+FANOUT = metrics.Histogram('chatterbox_fanout_recipients', 'Recipients each batched public frame is sent to',
+                           metrics.FANOUT_BUCKETS)
+FLUSH_SECONDS = metrics.Histogram('chatterbox_batch_flush_seconds', 'Time spent encoding and fanning out a batch')
+UNENCODABLE = metrics.Counter('chatterbox_unencodable_messages_total', 'Messages dropped because they could not be encoded')
+
+
+class Batcher:
+    """Collects messages per recipient and flushes them as MESSAGES frames
+
+    outboxes maps usernames to their outbox.Outbox, users who have left by
+    the time a batch is flushed are skipped. A window of 0 still merges
+    everything handled in the same pass of the event loop.
+    """
+
+    def __init__(self, outboxes, window=DEFAULT_WINDOW, max_messages=DEFAULT_MAX_MESSAGES):
+        self.outboxes = outboxes
+        self.window = window
+        self.max_messages = max_messages
+
+        self.public = []  # (message, frozenset of recipients) in arrival order
+        self.direct = {}  # Recipient to the DMs and replies waiting for them
+        self.presence = {}  # Username to [online before the batch, online now, recipients]
+        self.roster_version = 0
+        self.pending = 0
+        self._handle = None
+
+    # Pre: recipients is the frozenset of usernames allowed to see message
+    # Post: message will go out to them with the next flush
+    def add_public(self, message, recipients):
+        # The bus hub applies messages with nobody connected to it
+        if not self.outboxes:
+            return
+
+        self.public.append((message, recipients))
+        self._added()
+
+    # Pre: version is the presence.Roster version after user joined (online)
+    #       or left, recipients the frozenset of users who may see it
+    # Post: the change will go out with the next flush, unless the user is
+    #       back where they started by then
+    def add_presence(self, user, online, recipients, version):
+        self.roster_version = version
+        if not self.outboxes:
+            return
+
+        if user in self.presence:
+            change = self.presence[user]
+            change[1] = online
+            change[2] = recipients
+        else:
+            self.presence[user] = [not online, online, recipients]
+        self._added()
+
+    # Queues a DM or command reply for a single user
+    def add_direct(self, recipient, message):
+        if recipient not in self.outboxes:
+            return
+
+        if recipient in self.direct:
+            self.direct[recipient].append(message)
+        else:
+            self.direct[recipient] = [message]
+        self._added()
+
+    def _added(self):
+        self.pending += 1
+
+        if self.pending >= self.max_messages:
+            self.flush()
+        elif self._handle is None:
+            loop = asyncio.get_event_loop()
+            if self.window > 0:
+                self._handle = loop.call_later(self.window, self.flush)
+            else:
+                self._handle = loop.call_soon(self.flush)
+
+    # Pre: none
+    # Post: every pending message has been handed to its recipients' outboxes
+    # Purpose: groups recipients by the public messages they may see so each
+    #       distinct batch is encoded once, then sends each recipient's DMs
+    #       and replies in one more frame
+    def flush(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+        started = time.perf_counter()
+        public, self.public = self.public, []
+        direct, self.direct = self.direct, {}
+        presence, self.presence = self.presence, {}
+        self.pending = 0
+
+        if public:
+            for messages, users in self._batches(public):
+                self._send(Frame.encode({"MESSAGES": messages}), users)
+
+        # After the messages, so a goodbye arrives before its sender leaves
+        if presence:
+            self._flush_presence(presence)
+
+        for recipient in direct:
+            if recipient in self.outboxes:
+                self._send(Frame.encode({"MESSAGES": direct[recipient]}), (recipient,), observe=False)
+
+        FLUSH_SECONDS.observe(time.perf_counter() - started)
+
+    # Pre: items is a list of (item, frozenset of recipients) in order
+    # Post: yields (items, users) once per distinct set of items some users
+    #       may see, in their original order
+    def _batches(self, items):
+        # Senders nobody has blocked all share the same recipients, so there
+        # is usually a single group
+        groups = {}
+        for item, recipients in items:
+            if recipients in groups:
+                groups[recipients].append(item)
+            else:
+                groups[recipients] = [item]
+
+        if len(groups) == 1:
+            for recipients, group in groups.items():
+                yield group, recipients
+            return
+
+        # Otherwise work out which groups each recipient belongs to and encode
+        # once per distinct combination, keeping messages in arrival order
+        recipient_sets = list(groups)
+        batches = {}
+        for user in frozenset().union(*recipient_sets):
+            key = tuple(i for i, recipients in enumerate(recipient_sets) if user in recipients)
+            if key in batches:
+                batches[key].append(user)
+            else:
+                batches[key] = [user]
+
+        positions = {recipients: i for i, recipients in enumerate(recipient_sets)}
+        for key, users in batches.items():
+            visible = set(key)
+            yield [item for item, recipients in items if positions[recipients] in visible], users
+
+    def _flush_presence(self, presence):
+        changes = [((user, change[1]), change[2]) for user, change in presence.items() if change[0] != change[1]]
+
+        for group, users in self._batches(changes):
+            update = {}
+            joined = [user for user, online in group if online]
+            left = [user for user, online in group if not online]
+            if joined:
+                update["USERS_JOINED"] = joined
+            if left:
+                update["USERS_LEFT"] = left
+
+            # Clients keeping a roster are also told which version it is now
+            frame = Frame.encode(update)
+            versioned = None
+            FANOUT.observe(len(users))
+            for user in users:
+                outbox = self.outboxes.get(user)
+                if outbox is None:
+                    continue
+                if outbox.roster:
+                    if versioned is None:
+                        versioned = Frame.encode(dict(update, ROSTER_VERSION=self.roster_version))
+                    outbox.send(versioned)
+                else:
+                    outbox.send(frame)
+
+    # Pre: frame is a MESSAGES frame
+    # Post: frame has been handed to every user still connected, without any
+    #       message that can't be encoded for them
+    def _send(self, frame, users, observe=True):
+        if observe:
+            FANOUT.observe(len(users))
+        for user in users:
+            outbox = self.outboxes.get(user)
+            if outbox is None:
+                continue
+            try:
+                outbox.send(frame)
+            except (ValueError, TypeError):
+                frame = self._encodable(frame)
+                if frame is None:
+                    return
+                outbox.send(frame)
+
+    # Pre: frame is a MESSAGES frame that failed to encode
+    # Post: returns the frame without the messages that fail with any codec,
+    #       or None if none are left
+    # Purpose: one bad message must not cost everyone else in the batch theirs
+    def _encodable(self, frame):
+        kept = []
+        for message in frame.message["MESSAGES"]:
+            try:
+                for each in codec.CODECS.values():
+                    each.encode({"MESSAGES": [message]})
+            except (ValueError, TypeError) as error:
+                UNENCODABLE.inc()
+                log.warning("Dropped a message that could not be encoded: %s", error)
+            else:
+                kept.append(message)
+        return Frame.encode({"MESSAGES": kept}) if kept else None
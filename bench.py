@@ -0,0 +1,537 @@
+#!/usr/bin/env python3
+"""bench
+Load generator and latency benchmark for the Chatterbox server
+
+Starts server.py locally on a scratch data file, logs in any number of
+simulated clients speaking the same protocol as client.py, drives a mix of
+broadcasts, DMs and commands at them for a while and reports throughput,
+end-to-end latency percentiles per kind of message, login times and the
+server's memory use. Login time can also be measured against several
+history sizes. Results are written as JSON, and a previous results file can
+be given with --baseline to print how the run compares.
+
+Every simulated client runs in this one process, so with many clients or
+high rates check that the benchmark itself isn't the process pinned at 100%
+CPU before reading too much into the latencies.
+
+    python bench.py --clients 2000 --rate 0.5 --duration 30 --output run.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import signal
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+
+import codec
+import storage
+from framing import DEFLATE, FrameCompressor, FrameDecoder, encode_frame
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Messages the benchmark sends start with this, followed by a token used to
+# look up when they were sent
+TOKEN_PREFIX = "bench:"
+
+KINDS = ("broadcast", "dm", "command")
+DEFAULT_MIX = "broadcast=0.8,dm=0.15,command=0.05"
+
+
+class BenchClient(asyncio.Protocol):
+    """One simulated user, speaking the protocol the way client.py does"""
+
+    def __init__(self, bench, username):
+        self.bench = bench
+        self.username = username
+        self.transport = None
+        self.decoder = FrameDecoder()
+        self.codec = codec.JSON
+        self.compressor = None
+        self.commands = []  # Send times of commands still waiting on a reply
+        self.logged_in = asyncio.get_event_loop().create_future()
+        self.login_bytes = 0
+        self.closed = False
+
+        if bench.compression:
+            self.decoder.enable_compression()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def send(self, message):
+        data = encode_frame(self.codec.encode(message))
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        self.transport.write(data)
+
+    def login(self):
+        message = {"USERNAME": self.username, "CODECS": self.bench.codecs}
+        if self.bench.compression:
+            message["COMPRESSION"] = [DEFLATE]
+        self.started = time.perf_counter()
+        self.send(message)
+
+    def data_received(self, data):
+        if not self.logged_in.done():
+            self.login_bytes += len(data)
+
+        for frame in self.decoder.feed(data):
+            self.handle_frame(self.codec.decode(frame))
+
+    def handle_frame(self, data):
+        now = time.perf_counter()
+
+        if "USERNAME_ACCEPTED" in data:
+            if "CODEC" in data:
+                self.codec = codec.CODECS[data["CODEC"]]
+            if "COMPRESSION" in data:
+                self.compressor = FrameCompressor()
+            if not self.logged_in.done():
+                self.logged_in.set_result(data["USERNAME_ACCEPTED"])
+            return
+
+        # Idle clients are pinged and closed if they don't answer
+        if "PING" in data:
+            self.send({"PONG": data["PING"]})
+
+        for message in data.get("MESSAGES", ()):
+            content = message[3]
+            if content.startswith(TOKEN_PREFIX):
+                self.bench.delivered(content, now)
+            elif message[0] == message[1] == self.username and self.commands:
+                self.bench.record("command", now - self.commands.pop(0))
+
+    def connection_lost(self, exc):
+        self.closed = True
+        if not self.logged_in.done():
+            self.logged_in.set_result(False)
+
+
+class Bench:
+    """Keeps the clients of one run and what they measured"""
+
+    def __init__(self, args):
+        self.args = args
+        self.codecs = [args.codec] if args.codec else list(codec.CODECS)
+        self.compression = not args.no_compression
+        self.clients = []
+
+        self.next_token = 0
+        self.sent = {}  # Token to (kind, send time)
+        self.latencies = {kind: [] for kind in KINDS}
+        self.counts = {kind: 0 for kind in KINDS}
+        self.deliveries = 0
+        self.measuring = False
+
+    # Pre: a server is listening on port
+    # Post: returns a logged in client, or None if the login was refused
+    async def connect(self, port, username):
+        loop = asyncio.get_event_loop()
+        client = BenchClient(self, username)
+        await loop.create_connection(lambda: client, '127.0.0.1', port, ssl=make_client_context(self.args.cafile),
+                                     server_hostname='localhost')
+        client.login()
+        if not await client.logged_in:
+            client.transport.close()
+            return None
+
+        client.login_time = time.perf_counter() - client.started
+        return client
+
+    # Logs in count clients, a few at a time, returning their login times
+    async def connect_all(self, port, count):
+        semaphore = asyncio.Semaphore(self.args.connect_concurrency)
+
+        async def one(i):
+            async with semaphore:
+                return await self.connect(port, 'bench{}'.format(i))
+
+        clients = await asyncio.gather(*(one(i) for i in range(count)))
+        self.clients = [client for client in clients if client is not None]
+        return [client.login_time for client in self.clients]
+
+    def record(self, kind, latency):
+        if self.measuring:
+            self.latencies[kind].append(latency)
+
+    def delivered(self, content, now):
+        sent = self.sent.get(content)
+        if sent is not None:
+            self.deliveries += 1
+            self.record(sent[0], now - sent[1])
+
+    # Pre: the clients are logged in
+    # Post: every client has sent messages at the configured rate for the
+    #       configured duration
+    async def drive(self, mix):
+        kinds, weights = zip(*mix.items())
+
+        async def run(client, until):
+            while time.perf_counter() < until and not client.closed:
+                await asyncio.sleep(random.expovariate(self.args.rate))
+                self.send_one(client, random.choices(kinds, weights)[0])
+
+        if self.args.warmup > 0:
+            await asyncio.gather(*(run(client, time.perf_counter() + self.args.warmup) for client in self.clients))
+
+        self.measuring = True
+        started = time.perf_counter()
+        until = started + self.args.duration
+        await asyncio.gather(*(run(client, until) for client in self.clients))
+        sending = time.perf_counter() - started
+
+        # Give stragglers a moment to arrive before the numbers are read
+        await asyncio.sleep(self.args.drain)
+        self.measuring = False
+        return sending, time.perf_counter() - started
+
+    def send_one(self, client, kind):
+        now = time.perf_counter()
+
+        if kind == "command":
+            if self.measuring:
+                self.counts[kind] += 1
+            client.commands.append(now)
+            client.send({"MESSAGES": [[client.username, client.username, int(time.time()), "/Name"]]})
+            return
+
+        if kind == "dm" and len(self.clients) > 1:
+            recipient = client
+            while recipient is client:
+                recipient = random.choice(self.clients)
+            destination = recipient.username
+        else:
+            kind = "broadcast"
+            destination = "ALL"
+
+        token = "{}{} {}".format(TOKEN_PREFIX, self.next_token, self.args.payload)
+        self.next_token += 1
+        self.sent[token] = (kind, now)
+        if self.measuring:
+            self.counts[kind] += 1
+
+        client.send({"MESSAGES": [[client.username, destination, int(time.time()), token]]})
+
+    def close(self):
+        for client in self.clients:
+            client.transport.close()
+        self.clients = []
+
+
+# TLS for the benchmark's clients. Certificates are only checked when a CA
+# file is given, the bundled ca.crt is rejected as a CA by recent OpenSSL.
+def make_client_context(cafile):
+    context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH, cafile=cafile)
+    if cafile is None:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+# Pre: path is a scratch snapshot path
+# Post: the snapshot holds count public messages from count // 10 + 1 users
+def seed_history(path, count):
+    users = ['seed{}'.format(i) for i in range(count // 10 + 1)]
+    now = int(time.time())
+    messages = [[users[i % len(users)], "ALL", now - count + i, "seed message {}".format(i)] for i in range(count)]
+    storage.write_snapshot(path, (messages, set(users), {}, {}, {}), 0)
+
+
+class Server:
+    """server.py running as a child process on a scratch data file"""
+
+    def __init__(self, args, history):
+        self.directory = tempfile.mkdtemp(prefix='chatterbox-bench-')
+        self.data = os.path.join(self.directory, 'bench.pkl')
+        self.port = args.port or free_port()
+        seed_history(self.data, history)
+
+        command = [sys.executable, 'server.py', '127.0.0.1', '-p', str(self.port), '--data', self.data]
+        command += args.server_args.split()
+        self.process = subprocess.Popen(command, cwd=ROOT, stdout=subprocess.DEVNULL,
+                                        stderr=None if args.verbose else subprocess.DEVNULL)
+        self.rss_peak = 0
+
+    # Waits until the server accepts connections
+    async def ready(self, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError("server exited with status {}".format(self.process.returncode))
+            try:
+                reader, writer = await asyncio.open_connection('127.0.0.1', self.port)
+                writer.close()
+                return
+            except OSError:
+                await asyncio.sleep(0.1)
+        raise RuntimeError("server did not start listening within {} seconds".format(timeout))
+
+    # Resident memory of the server and any workers it forked, in KiB
+    def rss(self):
+        total = 0
+        for pid in [self.process.pid] + children(self.process.pid):
+            try:
+                with open('/proc/{}/status'.format(pid)) as f:
+                    for line in f:
+                        if line.startswith('VmRSS:'):
+                            total += int(line.split()[1])
+            except OSError:
+                pass
+        self.rss_peak = max(self.rss_peak, total)
+        return total
+
+    async def sample_rss(self, interval=0.5):
+        while True:
+            self.rss()
+            await asyncio.sleep(interval)
+
+    def stop(self):
+        if self.process.poll() is None:
+            self.process.send_signal(signal.SIGINT)
+            try:
+                self.process.wait(10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+
+        for name in os.listdir(self.directory):
+            os.remove(os.path.join(self.directory, name))
+        os.rmdir(self.directory)
+
+
+def children(pid):
+    try:
+        with open('/proc/{0}/task/{0}/children'.format(pid)) as f:
+            return [int(child) for child in f.read().split()]
+    except OSError:
+        return []
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+# Pre: samples is a list of numbers
+# Post: returns the count, mean and percentiles of samples in milliseconds
+def summarize(samples):
+    if not samples:
+        return {"count": 0}
+
+    samples = sorted(samples)
+
+    def percentile(q):
+        return round(samples[min(len(samples) - 1, int(q * len(samples)))] * 1000, 3)
+
+    return {
+        "count": len(samples),
+        "mean": round(sum(samples) / len(samples) * 1000, 3),
+        "p50": percentile(0.5),
+        "p99": percentile(0.99),
+        "p999": percentile(0.999),
+        "max": round(samples[-1] * 1000, 3),
+    }
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        kind, _, weight = part.partition('=')
+        if kind not in KINDS:
+            raise argparse.ArgumentTypeError("unknown message kind {!r}, expected one of {}".format(kind, KINDS))
+        mix[kind] = float(weight)
+    return mix
+
+
+# Pre: sizes is a list of history lengths
+# Post: returns the login time and reply size for each, measured on a fresh
+#       server seeded with that much history
+async def logins_by_history(args, sizes):
+    results = []
+
+    for size in sizes:
+        server = Server(args, size)
+        try:
+            await server.ready()
+            bench = Bench(args)
+            times = []
+            received = []
+            failed = 0  # Logins refused, by the login rate limit for one
+            for i in range(args.login_samples):
+                client = await bench.connect(server.port, 'probe{}'.format(i))
+                if client is None:
+                    failed += 1
+                    continue
+                times.append(client.login_time)
+                received.append(client.login_bytes)
+                client.transport.close()
+
+            result = {"history": size, "login_ms": summarize(times), "failed_logins": failed,
+                      "reply_bytes": sum(received) // len(received) if received else 0, "rss_kb": server.rss()}
+            print("history {:>9}: login p50 {} ms, reply {} bytes, {} refused".format(
+                size, result["login_ms"].get("p50"), result["reply_bytes"], failed))
+            results.append(result)
+        finally:
+            server.stop()
+
+    return results
+
+
+async def run(args):
+    results = {
+        "started": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "config": vars(args).copy(),
+        "commit": git_commit(),
+        "python": sys.version.split()[0],
+    }
+
+    if args.login_history:
+        results["logins_by_history"] = await logins_by_history(args, args.login_history)
+
+    if args.clients <= 0:
+        return results
+
+    server = Server(args, args.history)
+    sampler = None
+    bench = Bench(args)
+    try:
+        await server.ready()
+        sampler = asyncio.ensure_future(server.sample_rss())
+        rss_idle = server.rss()
+
+        print("Logging in {} clients".format(args.clients))
+        started = time.perf_counter()
+        login_times = await bench.connect_all(server.port, args.clients)
+        login_elapsed = time.perf_counter() - started
+
+        print("Driving load for {} seconds".format(args.duration))
+        sending, elapsed = await bench.drive(args.mix)
+
+        sent = sum(bench.counts.values())
+        results.update({
+            "clients": len(bench.clients),
+            "login": {"elapsed_s": round(login_elapsed, 3), "ms": summarize(login_times)},
+            "throughput": {
+                "elapsed_s": round(elapsed, 3),
+                "sent": sent,
+                "sent_per_s": round(sent / sending, 1),
+                "delivered": bench.deliveries,
+                "delivered_per_s": round(bench.deliveries / elapsed, 1),
+                "by_kind": bench.counts,
+            },
+            "latency_ms": {kind: summarize(bench.latencies[kind]) for kind in KINDS},
+            "server_rss_kb": {"idle": rss_idle, "peak": server.rss_peak, "end": server.rss()},
+        })
+    finally:
+        if sampler is not None:
+            sampler.cancel()
+        bench.close()
+        server.stop()
+
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(results):
+    if "throughput" in results:
+        throughput = results["throughput"]
+        print("Sent {sent_per_s}/s, delivered {delivered_per_s}/s".format(**throughput))
+        print("Login p50 {p50} ms, p99 {p99} ms".format(**results["login"]["ms"]))
+        for kind, latency in results["latency_ms"].items():
+            if latency["count"]:
+                print("{:<10} p50 {p50} ms, p99 {p99} ms, p999 {p999} ms ({count} samples)".format(kind, **latency))
+        print("Server RSS peak {peak} KiB".format(**results["server_rss_kb"]))
+
+
+# Pre: results and baseline are results from this script
+# Post: prints the change in the headline numbers between them
+def compare(results, baseline):
+    rows = []
+    if "throughput" in results and "throughput" in baseline:
+        rows.append(("delivered/s", baseline["throughput"]["delivered_per_s"], results["throughput"]["delivered_per_s"]))
+        rows.append(("login p99 ms", baseline["login"]["ms"].get("p99"), results["login"]["ms"].get("p99")))
+        for kind in KINDS:
+            for percentile in ("p50", "p99", "p999"):
+                rows.append(("{} {} ms".format(kind, percentile), baseline["latency_ms"][kind].get(percentile),
+                             results["latency_ms"][kind].get(percentile)))
+        rows.append(("rss peak KiB", baseline["server_rss_kb"]["peak"], results["server_rss_kb"]["peak"]))
+
+    print("Compared with baseline {}".format(baseline.get("commit")))
+    for name, before, after in rows:
+        if before and after is not None:
+            print("  {:<22} {:>12} -> {:>12} ({:+.1f}%)".format(name, before, after, (after - before) / before * 100))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Chatterbox load generator and latency benchmark')
+    parser.add_argument('--clients', metavar='N', type=int, default=500,
+                        help='Simulated clients to log in, 0 to only measure logins (default 500)')
+    parser.add_argument('--rate', metavar='messages', type=float, default=1.0,
+                        help='Messages each client sends per second on average (default 1)')
+    parser.add_argument('--duration', metavar='seconds', type=float, default=10.0,
+                        help='How long the load is measured for (default 10)')
+    parser.add_argument('--warmup', metavar='seconds', type=float, default=2.0,
+                        help='Load applied before measuring starts (default 2)')
+    parser.add_argument('--drain', metavar='seconds', type=float, default=1.0,
+                        help='How long to wait for deliveries after the last send (default 1)')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help='Relative weights of each kind of message (default {})'.format(DEFAULT_MIX))
+    parser.add_argument('--payload', metavar='text', default='x' * 32,
+                        help='Text appended to every chat message')
+    parser.add_argument('--history', metavar='messages', type=int, default=0,
+                        help='Messages of history the server starts with (default 0)')
+    parser.add_argument('--login-history', metavar='messages', type=int, nargs='*', default=[],
+                        help='Measure login time on fresh servers with each of these history sizes')
+    parser.add_argument('--login-samples', metavar='N', type=int, default=20,
+                        help='Logins timed per --login-history size (default 20)')
+    parser.add_argument('--connect-concurrency', metavar='N', type=int, default=100,
+                        help='Clients logging in at the same time (default 100)')
+    parser.add_argument('--codec', choices=list(codec.CODECS), default=None,
+                        help='Only offer this codec (default: offer all)')
+    parser.add_argument('--no-compression', action='store_true',
+                        help='Do not offer to compress large frames')
+    parser.add_argument('--server-args', metavar='args', default='',
+                        help='Extra arguments for server.py, e.g. "--workers 4"')
+    parser.add_argument('--port', type=int, default=None,
+                        help='Port for the server (default: any free port)')
+    parser.add_argument('--cafile', default=None,
+                        help='Verify the server against this CA file (default: no verification)')
+    parser.add_argument('--output', metavar='path', default=None,
+                        help='Write the results to this JSON file')
+    parser.add_argument('--baseline', metavar='path', default=None,
+                        help='Results of an earlier run to compare against')
+    parser.add_argument('-v', dest='verbose', action='store_true',
+                        help='Show the server\'s errors')
+    args = parser.parse_args()
+
+    # Thousands of clients need as many file descriptors
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    loop = asyncio.get_event_loop()
+    results = loop.run_until_complete(run(args))
+    loop.close()
+
+    report(results)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
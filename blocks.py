@@ -0,0 +1,91 @@
+"""blocks
+Block relationships between users and who may receive whose messages
+
+A block works in both directions, so for every user the index keeps the users
+they have blocked and the users who have blocked them. From those it caches,
+per sender, the set of online users their public messages should reach.
+"""
+
+
+class BlockIndex:
+    """Bidirectional block index with cached broadcast recipient sets
+
+    blocking is the server's client_blocked_users mapping (username to the set
+    of usernames they blocked). It is updated in place so it can still be
+    snapshotted as it always has been.
+    """
+
+    def __init__(self, blocking):
+        self.blocking = blocking
+        self.blocked_by = {}
+        self.online = set()
+
+        # Sender to the frozenset of online users allowed to hear from them,
+        # dropped whenever a block, unblock, join or leave could change it
+        self._recipients = {}
+
+        for user in blocking:
+            for target in blocking[user]:
+                self.blocked_by.setdefault(target, set()).add(user)
+
+    # Pre: user and target are usernames
+    # Post: returns True if the block is new
+    def block(self, user, target):
+        if user not in self.blocking:
+            self.blocking[user] = set()
+
+        if target in self.blocking[user]:
+            return False
+
+        self.blocking[user].add(target)
+        self.blocked_by.setdefault(target, set()).add(user)
+        self._invalidate(user, target)
+        return True
+
+    # Pre: user and target are usernames
+    # Post: returns True if user had target blocked
+    def unblock(self, user, target):
+        if target not in self.blocking.get(user, ()):
+            return False
+
+        self.blocking[user].discard(target)
+        self.blocked_by[target].discard(user)
+        self._invalidate(user, target)
+        return True
+
+    # Usernames the given user has blocked
+    def blocked(self, user):
+        return self.blocking.get(user) or set()
+
+    # True if either user has blocked the other
+    def is_blocked(self, user, other):
+        return other in self.blocking.get(user, ()) or other in self.blocked_by.get(user, ())
+
+    # Users whose messages should be hidden from the given user and vice versa
+    def hidden(self, user):
+        return self.blocked(user) | self.blocked_by.get(user, set())
+
+    def join(self, user):
+        self.online.add(user)
+        self._recipients.clear()
+
+    def leave(self, user):
+        self.online.discard(user)
+        self._recipients.clear()
+
+    # Pre: sender is a username
+    # Post: returns the frozenset of online users (sender included) who
+    #       should receive sender's public messages
+    def recipients(self, sender):
+        recipients = self._recipients.get(sender)
+
+        if recipients is None:
+            recipients = frozenset(self.online - self.blocking.get(sender, set()) - self.blocked_by.get(sender, set()))
+            self._recipients[sender] = recipients
+
+        return recipients
+
+    # A block between two users only changes what those two can reach
+    def _invalidate(self, user, target):
+        self._recipients.pop(user, None)
+        self._recipients.pop(target, None)
@@ -0,0 +1,164 @@
+"""bus
+Event bus tying the Chatterbox server's connections to its shared state
+
+Everything that changes shared state (a public message, a DM, a join, a
+leave, a block or unblock) is published as an event and applied with
+ServerState.apply(). With a single process the LocalBus applies events
+straight away. With --workers the parent process runs a BusHub on a Unix
+domain socket: each worker publishes its events to the hub, which applies
+them to the parent's copy of the state (the only one that is persisted)
+and forwards them to every worker in one global order, so all replicas
+assign the same message and inbox IDs and see the same users online.
+
+Events travel over the socket as length prefixed JSON frames, whatever
+codec the clients negotiated.
+"""
+import asyncio
+
+import codec
+from framing import Frame, FrameDecoder
+from metrics import log
+
+# Event types
+MESSAGE = "message"  # A public message, {"sender", "message"}
+INBOX = "inbox"  # A DM, kept in the recipient's inbox until acknowledged, {"to", "message"}
+INBOX_ACK = "inbox_ack"  # {"user", "through"} the inbox ID of the newest DM the user received
+JOIN = "join"  # A user logged in, {"user"}
+LEAVE = "leave"  # A user disconnected, {"user"}
+BLOCK = "block"  # {"user", "target"}
+UNBLOCK = "unblock"  # {"user", "target"}
+CHANNEL_MESSAGE = "channel_message"  # {"sender", "channel", "message"}
+CHANNEL_JOIN = "channel_join"  # {"user", "channel"}
+CHANNEL_LEAVE = "channel_leave"  # {"user", "channel"}
+ARCHIVED = "archived"  # Parent to workers, {"count"} messages are in the archive, {"channels"} theirs
+JOIN_REJECTED = "join_rejected"  # Hub to worker, the user is already on another worker
+READY = "ready"  # Hub to workers, every worker is connected
+
+
+class LocalBus:
+    """Bus for a single process server, events are applied immediately"""
+
+    def __init__(self, state):
+        self.state = state
+
+    def publish(self, event):
+        self.state.apply(event)
+
+
+class WorkerBus(asyncio.Protocol):
+    """A worker's connection to the hub
+
+    Published events are applied once the hub sends them back, in the same
+    order every other worker applies them.
+    """
+
+    def __init__(self, state):
+        self.state = state
+        self.transport = None
+        self.decoder = FrameDecoder()
+        self.ready = asyncio.get_event_loop().create_future()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def publish(self, event):
+        self.transport.write(Frame.encode(event).encoded())
+
+    def data_received(self, data):
+        for frame in self.decoder.feed(data):
+            event = codec.JSON.decode(frame)
+
+            if event["type"] == READY:
+                self.ready.set_result(None)
+            else:
+                self.state.apply(event)
+
+    def connection_lost(self, exc):
+        # Without the hub this worker's state would silently diverge
+        log.error("Lost connection to the bus, stopping worker")
+        asyncio.get_event_loop().stop()
+
+
+class BusHub:
+    """The parent process's side of the bus
+
+    Keeps which worker each online user is connected to and rejects a
+    username that is already online on another worker.
+    """
+
+    def __init__(self, state, workers):
+        self.state = state
+        self.workers = workers  # Number of workers expected to connect
+        self.connections = []
+        self.owners = {}  # Username to the HubConnection they are on
+
+    def connection(self):
+        return HubConnection(self)
+
+    def connected(self, connection):
+        self.connections.append(connection)
+
+        if len(self.connections) == self.workers:
+            for worker in self.connections:
+                worker.send({"type": READY})
+
+    def disconnected(self, connection):
+        log.warning("A worker exited")
+        self.connections.remove(connection)
+
+        if not self.connections:
+            asyncio.get_event_loop().stop()
+
+        for user in [user for user in self.owners if self.owners[user] is connection]:
+            self.received(connection, {"type": LEAVE, "user": user})
+
+    # Publishes an event of the parent's own, such as more history archived
+    def publish(self, event):
+        self.received(None, event)
+
+    # Pre: event was published by the worker on connection, or by the
+    #       parent with no connection
+    # Post: the event is applied to the hub's state and forwarded
+    def received(self, connection, event):
+        kind = event["type"]
+
+        if kind == JOIN:
+            if event["user"] in self.owners:
+                connection.send({"type": JOIN_REJECTED, "user": event["user"]})
+                return
+            self.owners[event["user"]] = connection
+
+        elif kind == LEAVE:
+            # The worker that lost a rejected duplicate login doesn't own it
+            if self.owners.get(event["user"]) is not connection:
+                return
+            del self.owners[event["user"]]
+
+        self.state.apply(event)
+
+        frame = Frame.encode(event)
+        for worker in self.connections:
+            worker.transport.write(frame.encoded())
+
+
+class HubConnection(asyncio.Protocol):
+    """One worker's connection to the hub"""
+
+    def __init__(self, hub):
+        self.hub = hub
+        self.transport = None
+        self.decoder = FrameDecoder()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.hub.connected(self)
+
+    def send(self, event):
+        self.transport.write(Frame.encode(event).encoded())
+
+    def data_received(self, data):
+        for frame in self.decoder.feed(data):
+            self.hub.received(self, codec.JSON.decode(frame))
+
+    def connection_lost(self, exc):
+        self.hub.disconnected(self)
@@ -0,0 +1,95 @@
+"""capture
+Recording of client traffic, for replaying it with replay.py
+
+With --capture the server appends every frame it decodes from a client to a
+line delimited JSON log, along with when each connection opened and closed:
+
+    {"capture": 1, "started": <epoch seconds>}
+    [<seconds since started>, <connection>, "open"]
+    [<seconds since started>, <connection>, <frame>]
+    [<seconds since started>, <connection>, "close"]
+
+Connections are numbered from 0 in the order they were accepted. Frames are
+written as they were decoded, whatever codec and compression the client
+used, before the server acts on them. Lines are buffered and handed to the
+OS once a second rather than synced, a capture is a diagnostic and not
+worth a disk write per frame. With --workers each process writes its own
+capture, the path followed by the worker's number.
+
+Captures hold every message as sent, treat them like the data file.
+"""
+import json
+import time
+
+VERSION = 1
+DEFAULT_FLUSH_INTERVAL = 1.0  # Seconds lines may wait before they are written out
+
+OPEN = "open"
+CLOSE = "close"
+
+
+class Capture:
+    """Line delimited log of the frames clients send one server process"""
+
+    def __init__(self, path, loop, flush_interval=DEFAULT_FLUSH_INTERVAL):
+        self.path = path
+        self.loop = loop
+        self.flush_interval = flush_interval
+
+        self._file = open(path, 'w', encoding='utf-8')
+        self._start = time.monotonic()
+        self._next_id = 0
+        self._flush_handle = None
+        self._write({"capture": VERSION, "started": time.time()})
+
+    def _write(self, record):
+        self._file.write(json.dumps(record, separators=(',', ':')) + '\n')
+        if self._flush_handle is None:
+            self._flush_handle = self.loop.call_later(self.flush_interval, self.flush)
+
+    def _record(self, connection, value):
+        self._write([round(time.monotonic() - self._start, 6), connection, value])
+
+    # Returns the number the new connection is recorded under
+    def opened(self):
+        connection = self._next_id
+        self._next_id += 1
+        self._record(connection, OPEN)
+        return connection
+
+    # Pre: frame is a frame just decoded from connection, not yet handled
+    def received(self, connection, frame):
+        self._record(connection, frame)
+
+    def closed(self, connection):
+        self._record(connection, CLOSE)
+
+    def flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        self._file.flush()
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+
+# Pre: path names a capture written by Capture
+# Post: yields (epoch seconds, connection, value) for each record in order,
+#       value being a frame, OPEN or CLOSE
+# Purpose: reads a capture back, stopping at a torn final line left by a
+#       server that was killed
+def read(path):
+    with open(path, encoding='utf-8') as f:
+        header = json.loads(f.readline())
+        if not isinstance(header, dict) or header.get("capture") != VERSION:
+            raise ValueError("{} is not a capture".format(path))
+        started = header["started"]
+
+        for line in f:
+            try:
+                offset, connection, value = json.loads(line)
+            except ValueError:
+                return
+            yield started + offset, connection, value
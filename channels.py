@@ -0,0 +1,126 @@
+"""channels
+Named channels, who is subscribed to them and their message histories
+
+Public messages addressed to "ALL" go to everyone online as they always
+have. A message addressed to a channel ("#name") only goes to the channel's
+members and is kept in that channel's own history, with message IDs
+counting from 0 per channel. Membership lasts until the user leaves the
+channel, across disconnects and restarts.
+
+Each channel's history is a history.MessageStore of its own, archived and
+evicted from memory under the same retention policy as the public history.
+"""
+import re
+
+from history import MessageStore
+
+PREFIX = "#"
+NAME = re.compile(r"^#[A-Za-z0-9_-]{1,32}$")
+
+
+# True if name can be used as a channel, "#" followed by up to 32 letters,
+# digits, underscores or dashes
+def valid_name(name):
+    return isinstance(name, str) and NAME.match(name) is not None
+
+
+def is_channel(destination):
+    return destination.startswith(PREFIX)
+
+
+class ChannelIndex:
+    """Channel memberships and histories with a subscription index
+
+    channels is the server's persisted mapping of channel name to
+    {"members": set of usernames, "messages": history.MessageStore}. It is
+    updated in place so it can be snapshotted like the rest of the state.
+    online is the set of users online on any worker, shared with the
+    blocks.BlockIndex. new_history(name) returns the empty history of a
+    channel being created.
+    """
+
+    def __init__(self, channels, online, new_history=None):
+        self.channels = channels
+        self.online = online
+        self.new_history = new_history if new_history is not None else lambda name: MessageStore()
+        self.subscriptions = {}  # Username to the set of channels they are in
+
+        # Channel to the frozenset of its members that are online, dropped
+        # when a member joins, leaves or comes and goes
+        self._online_members = {}
+
+        for name in channels:
+            for user in channels[name]["members"]:
+                self.subscriptions.setdefault(user, set()).add(name)
+
+    def exists(self, name):
+        return name in self.channels
+
+    def is_member(self, name, user):
+        return name in self.subscriptions.get(user, ())
+
+    # Channels the given user is in
+    def joined(self, user):
+        return self.subscriptions.get(user) or set()
+
+    # Pre: name is a valid channel name
+    # Post: returns True if user was not already a member, creating the
+    #       channel if it did not exist
+    def join(self, name, user):
+        if name not in self.channels:
+            self.channels[name] = {"members": set(), "messages": self.new_history(name)}
+
+        members = self.channels[name]["members"]
+        if user in members:
+            return False
+
+        members.add(user)
+        self.subscriptions.setdefault(user, set()).add(name)
+        self._online_members.pop(name, None)
+        return True
+
+    # Returns True if user was a member of the channel
+    def leave(self, name, user):
+        if not self.is_member(name, user):
+            return False
+
+        self.channels[name]["members"].discard(user)
+        self.subscriptions[user].discard(name)
+        self._online_members.pop(name, None)
+        return True
+
+    # Called when user comes online or goes offline on any worker
+    def presence_changed(self, user):
+        for name in self.subscriptions.get(user, ()):
+            self._online_members.pop(name, None)
+
+    # Pre: name is an existing channel
+    # Post: returns the frozenset of its members who are online
+    def online_members(self, name):
+        members = self._online_members.get(name)
+
+        if members is None:
+            channel_members = self.channels[name]["members"]
+            if len(channel_members) < len(self.online):
+                members = frozenset(user for user in channel_members if user in self.online)
+            else:
+                members = frozenset(user for user in self.online if user in channel_members)
+            self._online_members[name] = members
+
+        return members
+
+    # The channel's messages, a message's ID is its position in the history
+    def history(self, name):
+        return self.channels[name]["messages"]
+
+    # Pre: name is an existing channel
+    # Post: returns the message ID assigned to message
+    def add_message(self, name, message):
+        messages = self.channels[name]["messages"]
+        messages.append(message)
+        return len(messages) - 1
+
+    # Pre: none
+    # Post: returns (name, member count) for every channel, sorted by name
+    def listing(self):
+        return sorted((name, len(self.channels[name]["members"])) for name in self.channels)
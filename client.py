@@ -7,121 +7,524 @@ data from server and user input from stdin
 Last modified by Alice Easter && Eric Cacciavillani on 4/26/18
 """
 import json
-import ssl
-import struct
+import os
+import random
+import stat
+import sys
 import time
 
 import argparse
 import asyncio
 
+import codec
+import tls
+from framing import (DEFAULT_COMPRESS_THRESHOLD, DEFAULT_MAX_FRAME_SIZE, DEFLATE, FrameCompressor, FrameDecoder,
+                     FrameTooLarge, encode_frame)
+
+
+RECONNECT_DELAY = 0.5  # Longest wait before the first reconnection attempt, in seconds
+MAX_RECONNECT_DELAY = 30.0  # The longest wait doubles up to this after each failed attempt
+
 
 class AsyncClient(asyncio.Protocol):
-    def __init__(self):
-        self.__buffer = ""
+    def __init__(self, max_frame_size=DEFAULT_MAX_FRAME_SIZE, codecs=tuple(codec.CODECS), compression=True,
+                 context=None, reconnect=True):
+        self.max_frame_size = max_frame_size
+        self.decoder = FrameDecoder(max_frame_size)
         self.is_logged_in = False
         self.username = ""
-        self.data_len = 0
 
+        # Codecs offered at login, JSON is used until the server picks one
+        self.codecs = list(codecs)
+        self.codec = codec.JSON
+
+        # Offered at login, the server may compress its reply to it so
+        # compressed frames are accepted straight away. Ours are only
+        # compressed once the server agrees.
+        self.compression = compression
+        self.compressor = None
+        if compression:
+            self.decoder.enable_compression()
+
+        # ID of the oldest message received and whether the server has older
+        # ones, used to page back through history. Kept per channel, with
+        # None for messages to ALL.
+        self.history_cursors = {}
+
+        # ID of the newest message received, per channel with None for
+        # messages to ALL, sent in RESUME when logging in again so the
+        # server only sends what was missed
+        self.last_seen = {}
+
+        # Inbox ID of the newest DM received, acknowledged with INBOX_ACK so
+        # the server stops keeping it
+        self.inbox_seen = None
+
+        # Every user the server knows of and whether they are online, kept up
+        # to date from ROSTER frames and USERS_JOINED/USERS_LEFT
+        self.roster = {}
+        self.roster_version = None
+        self.roster_epoch = None  # Which server start roster_version counts from
+
+        # The ssl.SSLContext connections are made with. A tls.ClientContext
+        # also keeps the session so reconnecting can skip the full handshake.
+        self.context = context
+        self.session_kept = False
+
+        # Future for the answer to the last login sent
+        self.login_reply = None
+
+        # Seconds the server last asked us to wait before trying again
+        self.retry_after = 0
+
+        # Where open() connected to, and whether to connect there again
+        # and log back in when the connection drops
+        self.endpoint = None
+        self.auto_reconnect = reconnect
+        self.reconnecting = False
+        self.closing = False
+
+    # Each connection starts over with JSON and fresh compression streams
     def connection_made(self, transport):
         self.transport = transport
         self.is_logged_in = False
+        self.session_kept = False
+
+        self.codec = codec.JSON
+        self.compressor = None
+        self.decoder = FrameDecoder(self.max_frame_size)
+        if self.compression:
+            self.decoder.enable_compression()
+
+    # Pre: a server is listening on host:port
+    # Post: connects this client to it, returning the transport
+    async def open(self, host, port, server_hostname=None):
+        self.endpoint = (host, port, server_hostname)
+        loop = asyncio.get_event_loop()
+        transport, _ = await loop.create_connection(lambda: self, host, port, ssl=self.context,
+                                                    server_hostname=server_hostname or host)
+        return transport
 
     # Client sends message
     def send_message(self, data):
-        msg = b''
-        msg += struct.pack("!I", len(data))
-        msg += data
-        self.transport.write(msg)
+        data = encode_frame(data)
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        self.transport.write(data)
+
+    # Encodes a protocol object with the negotiated codec and sends it
+    def send(self, message):
+        self.send_message(self.codec.encode(message))
 
     # Handles the client reciving data
     def data_received(self, data):
-        """simply prints any data that is received"""
-        # Get data into usable format
-        if self.__buffer == '':
-            # Find first brace and offset the data by that
-            brace_index = data.find(b'{')
-            self.data_len = struct.unpack("!I", data[0:brace_index])[0]
-            data = data[brace_index:(self.data_len + brace_index)]
-
-        data = data.decode('ascii')
-        self.__buffer += data
-
-        # Buffer contains full message
-        if len(self.__buffer) == self.data_len:
+        """decodes every complete frame in the received data"""
+        if not self.session_kept and isinstance(self.context, tls.ClientContext):
+            self.session_kept = self.context.remember(self.transport)
+
+        try:
+            frames = self.decoder.feed(data)
+        except FrameTooLarge as e:
+            print(e)
+            self.transport.close()
+            return
 
+        for frame in frames:
             # Extract to JSON object
-            data = json.loads(self.__buffer)
-
-            # Clear pre and post
-            self.__buffer = ''
-            self.data_len = 0
-
-            # Iterate through JSON keys
-            for key in data:
-
-                # Check json key value
-                if key == "USERNAME_ACCEPTED":
-                    if data[key]:
-                        self.is_logged_in = True
-                        print('\nSuccessfully Logged In')
-
-                # ----
-                elif key == "INFO":
-                    print(data[key])
-                    print()
-
-                # ----
-                elif key == "USER_LIST":
-                    print("USERS ONLINE:")
-                    for user in data[key]:
-                        if user["name"] is not '' and user["active"]:
-                            print(user["name"])
-                    print()
-
-                # ----
-                elif key == "MESSAGES":
-
-                    for message in data[key]:
-
-                        # Ensure message is designated for set user
-                        if message[1] == "ALL" or message[1] == self.username:
-
-                            # Convert time seconds to UTC time for prefix of recived message
-                            time_prefix = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(message[2]))
-
-                            # Main display for all given output from the server
-                            if message[0] == self.username:
-                                print("[{}] \033[36m{}\033[0m : {}".format(time_prefix,message[0],message[3]))
-                            else:
-                                print("[{}] \033[35m{}\033[0m : {}".format(time_prefix,message[0],message[3]))
-
-                elif key == "USERS_JOINED":
-                    print("New User(s) Joined:")
-                    for user in data[key]:
-                        print(user)
-                    print()
-                elif key == "USERS_LEFT":
-                    print("User(s) Left:")
-                    for user in data[key]:
+            self.handle_frame(self.codec.decode(frame))
+
+    # Handles a single decoded frame from the server
+    def handle_frame(self, data):
+        """keeps track of protocol state, then displays the frame"""
+        # Iterate through JSON keys
+        for key in data:
+            self.track(key, data[key])
+            self.display(key, data[key])
+
+    # Updates what the client knows from one key of a frame
+    def track(self, key, value):
+        if key == "USERNAME_ACCEPTED":
+            self.is_logged_in = bool(value)
+            if self.login_reply is not None and not self.login_reply.done():
+                self.login_reply.set_result(self.is_logged_in)
+
+        # Public and channel messages carry their message ID, DMs their
+        # inbox ID
+        elif key == "MESSAGES":
+            inbox_seen = self.inbox_seen
+            for message in value:
+                if len(message) <= 4 or type(message[4]) is not int:
+                    continue
+                if message[1] == "ALL" or message[1].startswith('#'):
+                    channel = message[1] if message[1].startswith('#') else None
+                    if message[4] > self.last_seen.get(channel, -1):
+                        self.last_seen[channel] = message[4]
+                elif inbox_seen is None or message[4] > inbox_seen:
+                    inbox_seen = message[4]
+
+            if inbox_seen != self.inbox_seen:
+                self.inbox_seen = inbox_seen
+                self.send({"INBOX_ACK": inbox_seen})
+
+        # The server refused something for going over a rate limit
+        elif key == "RATE_LIMITED":
+            self.retry_after = value.get("retry_after", 0)
+
+        # The server checking this client is still there
+        elif key == "PING":
+            self.send({"PONG": value})
+
+        # Codec the server picked, used for every later frame
+        elif key == "CODEC":
+            self.codec = codec.CODECS[value]
+
+        elif key == "COMPRESSION":
+            self.compressor = FrameCompressor(DEFAULT_COMPRESS_THRESHOLD)
+
+        # Cursor for the page of history that came with this frame, one that
+        # didn't resume after a reconnection starts over from the newest page
+        elif key == "HISTORY":
+            channel = value.get("channel")
+            cursor = self.history_cursors.get(channel)
+            if value.get("resumed") is False:
+                cursor = None
+            if "before" in value and (cursor is None or value["before"] < cursor["before"]):
+                self.history_cursors[channel] = {"before": value["before"], "more": value["more"]}
+
+        # The whole roster, or what changed in it since the version "since"
+        elif key == "ROSTER":
+            if "users" in value:
+                self.roster = {user["name"]: user["active"] for user in value["users"]}
+            else:
+                for user in value["joined"]:
+                    self.roster[user] = True
+                for user in value["left"]:
+                    self.roster[user] = False
+            self.roster_version = value["version"]
+            self.roster_epoch = value.get("epoch")
+
+        elif key == "ROSTER_VERSION":
+            self.roster_version = value
+
+        elif key == "USERS_JOINED":
+            for user in value:
+                self.roster[user] = True
+
+        elif key == "USERS_LEFT":
+            for user in value:
+                self.roster[user] = False
+
+    # Prints one key of a frame
+    def display(self, key, value):
+        # Check json key value
+        if key == "USERNAME_ACCEPTED":
+            if value:
+                print('\nSuccessfully Logged In')
+
+        elif key == "HISTORY":
+            if value.get("resumed") is False and value.get("channel") is None:
+                print("Missed too much while disconnected, showing the latest messages")
+
+        # Kept track of only
+        elif key in ("CODEC", "COMPRESSION", "ROSTER_VERSION", "PING", "PONG", "RATE_LIMITED"):
+            pass
+
+        # ----
+        elif key == "INFO":
+            print(value)
+            print()
+
+        # ----
+        elif key == "USER_LIST":
+            print("USERS ONLINE:")
+            for user in value:
+                if user["name"] is not '' and user["active"]:
+                    print(user["name"])
+            print()
+
+        # ----
+        elif key == "MESSAGES":
+
+            for message in value:
+
+                # Ensure message is designated for set user
+                if message[1] == "ALL" or message[1] == self.username or message[1].startswith('#'):
+
+                    # Convert time seconds to UTC time for prefix of recived message
+                    time_prefix = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(message[2]))
+                    if message[1].startswith('#'):
+                        time_prefix += "] [" + message[1]
+
+                    # Main display for all given output from the server
+                    if message[0] == self.username:
+                        print("[{}] \033[36m{}\033[0m : {}".format(time_prefix,message[0],message[3]))
+                    else:
+                        print("[{}] \033[35m{}\033[0m : {}".format(time_prefix,message[0],message[3]))
+
+        elif key == "ROSTER":
+            if "users" in value:
+                print("USERS ONLINE:")
+                for user in self.roster:
+                    if self.roster[user]:
                         print(user)
-                    print()
-                # Encapsulates error and other servers' additional features
-                else:
-                    # If we get something we aren't expecting, print it
-                    print("UNEXPECTED RESP FROM SERVER" + key + ": " + data[key])
+                print()
+
+        # Channels this user is in, their history follows
+        elif key == "CHANNELS":
+            if value:
+                print("Your channels: " + " ".join(value))
+                print()
+
+        elif key == "USERS_JOINED":
+            print("New User(s) Joined:")
+            for user in value:
+                print(user)
+            print()
+        elif key == "USERS_LEFT":
+            print("User(s) Left:")
+            for user in value:
+                print(user)
+            print()
+        # Encapsulates error and other servers' additional features
+        else:
+            # If we get something we aren't expecting, print it
+            print("UNEXPECTED RESP FROM SERVER" + key + ": " + value)
+
+    # Pre: the client is connected
+    # Post: returns a future set to whether the server accepted username
+    def log_in(self, username):
+        login_data = {"USERNAME": username, "CODECS": self.codecs, "ROSTER_VERSION": self.roster_version,
+                      "ROSTER_EPOCH": self.roster_epoch}
+        if self.compression:
+            login_data["COMPRESSION"] = [DEFLATE]
+
+        # Logging back in, only what was missed is wanted
+        if self.last_seen:
+            login_data["RESUME"] = {"after": self.last_seen.get(None),
+                                    "channels": {channel: self.last_seen[channel] for channel in self.last_seen
+                                                 if channel is not None}}
+
+        # Present even before any DM is received, it asks for the inbox
+        login_data["INBOX_ACK"] = self.inbox_seen
+
+        self.username = username
+        self.login_reply = asyncio.get_event_loop().create_future()
+        self.send(login_data)
+        return self.login_reply
+
+    # Pre: the connection to endpoint was lost after logging in
+    # Post: returns True once connected and logged in again as the same
+    #       user, or False if the client was closed first
+    # Purpose: waits a random time up to a delay that doubles after every
+    #       failed attempt, so clients cut off together don't all come
+    #       back at once
+    async def reconnect(self):
+        delay = RECONNECT_DELAY
+        self.reconnecting = True
+        try:
+            while not self.closing:
+                await asyncio.sleep(self.retry_after + random.uniform(0, delay))
+                delay = min(delay * 2, MAX_RECONNECT_DELAY)
+                self.retry_after = 0
+
+                try:
+                    transport = await self.open(*self.endpoint)
+                except OSError:
+                    continue
+
+                # The server may not have noticed the old connection is gone, or
+                # may be turning logins away for a moment
+                if await self.log_in(self.username):
+                    return True
+                transport.close()
+            return False
+        finally:
+            self.reconnecting = False
+
+    # Notes that the connection is gone, returning True if the client is
+    # reconnecting
+    def lost(self):
+        was_logged_in = self.is_logged_in
+        self.is_logged_in = False
+        if self.login_reply is not None and not self.login_reply.done():
+            self.login_reply.set_result(False)
+
+        if self.reconnecting:
+            return True
+        if was_logged_in and self.auto_reconnect and self.endpoint is not None and not self.closing:
+            self.reconnecting = True
+            self.notify('Connection to server lost, reconnecting...')
+            asyncio.ensure_future(self.reconnect())
+            return True
+        return False
+
+    # Tells the user about the connection
+    def notify(self, text):
+        print(text)
+
+    def close(self):
+        self.closing = True
+        self.transport.close()
 
     # When the client is disconnected from the server
     def connection_lost(self, exc):
+        if self.lost():
+            return
+
         print('Connection to server lost')
         print('(Press RET to exit)')
-        self.is_logged_in = False
 
         loop.run_in_executor(None, input, "")
         exit(0)
 
 
-@asyncio.coroutine
-def handle_user_input(loop, client):
+class LoginRefused(Exception):
+    """Raised when the server turns down a headless client's username"""
+
+
+class HeadlessClient(AsyncClient):
+    """AsyncClient for bots and scripted senders, nothing is printed
+
+        client = await HeadlessClient.connect(host, port, "bot")
+        client.send("hello")
+        async for message in client:
+            ...
+
+    Messages are sent as fast as the connection takes them, await drain()
+    to wait while it is backed up. Every chat message received is yielded
+    as a (SRC, DEST, TIMESTAMP, CONTENT[, ID]) list until the connection
+    closes, ERROR texts are kept in errors.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.received = asyncio.Queue()
+        self.errors = []
+        self.writable = asyncio.Event()
+        self.writable.set()
+
+    # Pre: a server is listening on host:port, context is an ssl.SSLContext
+    #       or None for tls.client_context(). Only a tls.ClientContext
+    #       resumes its TLS session when reconnecting.
+    # Post: returns a client logged in as username, raises LoginRefused if
+    #       the server turns the username down
+    @classmethod
+    async def connect(cls, host, port, username, context=None, server_hostname=None, **options):
+        if context is None:
+            context = tls.client_context()
+        client = cls(context=context, **options)
+
+        await client.open(host, port, server_hostname)
+        if not await client.log_in(username):
+            client.close()
+            raise LoginRefused(username)
+        return client
+
+    # Sends text to recipient ("ALL", a username or a #channel), or a
+    # protocol object as it is
+    def send(self, message, to="ALL"):
+        if isinstance(message, str):
+            message = {"MESSAGES": [[self.username, to, int(time.time()), message]]}
+        super().send(message)
+
+    # Waits until the connection is no longer backed up, or until the
+    # client has logged back in while it is reconnecting
+    async def drain(self):
+        await self.writable.wait()
+
+    def pause_writing(self):
+        self.writable.clear()
+
+    def resume_writing(self):
+        self.writable.set()
+
+    def notify(self, text):
+        pass
+
+    def display(self, key, value):
+        if key == "MESSAGES":
+            for message in value:
+                self.received.put_nowait(message)
+        elif key == "ERROR":
+            self.errors.append(value)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        message = await self.received.get()
+        if message is None:
+            raise StopAsyncIteration
+        return message
+
+    async def reconnect(self):
+        reconnected = await super().reconnect()
+        self.writable.set()
+        if not reconnected:
+            self.received.put_nowait(None)
+        return reconnected
+
+    def connection_lost(self, exc):
+        if self.lost():
+            self.writable.clear()
+            return
+
+        self.writable.set()
+        self.received.put_nowait(None)
+
+
+# Pre: client is logged in and message is a /History [#channel] [count]
+#       command
+# Post: asks the server for the page of history before the oldest message
+#       the client has seen, in the channel if one is given
+def request_history(client, message):
+    tokenized_message = message.split()[1:]
+    channel = None
+    if tokenized_message and tokenized_message[0].startswith('#'):
+        channel = tokenized_message.pop(0)
+
+    cursor = client.history_cursors.get(channel)
+    if cursor is None or not cursor["more"]:
+        print("No older messages")
+        return
+
+    request = {"before": cursor["before"]}
+    if channel is not None:
+        request["channel"] = channel
+    if tokenized_message and tokenized_message[0].isdigit():
+        request["limit"] = int(tokenized_message[0])
+
+    message = {"HISTORY": request}
+    client.send(message)
+
+
+# Pre: message is a line from a logged in user
+# Post: returns (recipient, text), "@user text" is a DM, "#channel text" a
+#       channel message, a /Command goes to the user themselves and
+#       anything else to ALL
+def address(username, message):
+    recip = "ALL"
+
+    # Checking for DM
+    if len(message) != 0 and message[0] == '@':
+        index = message.find(' ')
+        recip = message[1:index]
+        message = message[index + 1:]
+
+    # Checking for a channel message
+    elif len(message) != 0 and message[0] == '#' and ' ' in message:
+        index = message.find(' ')
+        recip = message[:index]
+        message = message[index + 1:]
+
+    # Checking for command
+    elif len(message) != 0 and message[0] == '/':
+        recip = username
+
+    return recip, message
+
+
+async def handle_user_input(loop, client):
     """reads from stdin in separate thread
     if user inputs 'quit' stops the event loop
     otherwise just echos user input
@@ -129,75 +532,116 @@ def handle_user_input(loop, client):
     # When new/unknown user joins
     while not client.is_logged_in:
 
-        # Set up JSON login message with dictionary
-        login_data = {"USERNAME": ""}
-
         # ---
-        message = yield from loop.run_in_executor(None, input, "> Enter your username:  ")
+        message = await loop.run_in_executor(None, input, "> Enter your username:  ")
         if message == "/Quit":
             loop.stop()
             return
 
-        # Use username in login dictionary to convert
-        client.username = message
-        login_data["USERNAME"] = message
-        data_json = json.dumps(login_data)
-        data_bytes_json = data_json.encode('ascii')
-
-        # Send message to server
-        client.send_message(data_bytes_json)
-
-        # Give server one second delay to push data to it
-        yield from asyncio.sleep(1)
-
-        if not client.is_logged_in:
+        # Wait for the server's answer
+        if not await client.log_in(message):
             print("This user has already been signed into the current server session!!!")
 
-    # When user is known and logged into the server
-    while client.is_logged_in:
-        recip = "ALL"
-        message = yield from loop.run_in_executor(None, input, "> ")
-
-        # Checking for DM
-        if len(message) != 0 and message[0] == '@':
-            index = message.find(' ')
-            recip = message[1:index]
-            message = message[index + 1:]
-
-        # Checking for command
-        elif len(message) != 0 and message[0] == '/':
-            if message == '/Quit':
-                loop.stop()
-                return
-            elif message == '/Help':
-                print('Chatterbox: The Chat Client You Never Knew You Didn\'t Need')
-                print('---')
-                print('Commands:')
-                print('/Block <username> - blocks messages to and from the specified username')
-                print('/Blocked - display a list of all users whom the client has blocked')
-                print('/DisplayAllUsers - display all users whom have ever been active')
-                print('/DisplayUsers - dispaly all currently active users')
-                print('/Help - display all supported commands')
-                print('/Name - display current user\'s username')
-                print('/Unblock <username> - unblocks messages from the specified username. Note that if the unblocked user has blocked the current client, messages still cannot be sent between the two clients')
-                print('/Quit - quits the application')
-                print('')
-                continue
-            else:
-                recip = client.username
+    # When user is known and logged into the server, or reconnecting
+    while True:
+        message = await loop.run_in_executor(None, input, "> ")
+
+        # Commands the client handles itself
+        if message == '/Quit':
+            client.closing = True
+            loop.stop()
+            return
+        elif not client.is_logged_in:
+            print("Not connected, reconnecting to the server...")
+            continue
+        elif message.split()[:1] == ['/History']:
+            request_history(client, message)
+            continue
+        elif message == '/Help':
+            print('Chatterbox: The Chat Client You Never Knew You Didn\'t Need')
+            print('---')
+            print('Commands:')
+            print('/Block <username> - blocks messages to and from the specified username')
+            print('/Blocked - display a list of all users whom the client has blocked')
+            print('/Channels - display all channels and which ones you are in')
+            print('/DisplayAllUsers - display all users whom have ever been active')
+            print('/DisplayUsers - dispaly all currently active users')
+            print('/Help - display all supported commands')
+            print('/History [#channel] [count] - display older messages, of a channel if given')
+            print('/Join #channel - join a channel, creating it if it doesn\'t exist yet')
+            print('/Leave #channel - leave a channel')
+            print('/Name - display current user\'s username')
+            print('/Search [-page] <terms> - find public messages holding every term, best matches first')
+            print('/Unblock <username> - unblocks messages from the specified username. Note that if the unblocked user has blocked the current client, messages still cannot be sent between the two clients')
+            print('/Quit - quits the application')
+            print('#channel <message> - send a message to a channel you have joined')
+            print('')
+            continue
+
+        recip, message = address(client.username, message)
 
         # Format message object to be encoded and JSONified
         message = {"MESSAGES": [(client.username, recip, int(time.time()), message)]}
-        message = json.dumps(message)
-        message = message.encode('ascii')
-        client.send_message(message)
-
-        # Give server one second delay to push data to it
-        yield from asyncio.sleep(1)
+        client.send(message)
 
     return
 
 
+# Pre: client is a logged in HeadlessClient, lines an open text file or
+#       None for standard input
+# Post: every line is sent as it would be typed, pipelined, and every
+#       message received is written to standard output as a JSON line until
+#       linger seconds after the input ends
+async def run_headless(client, lines=None, linger=0):
+    loop = asyncio.get_event_loop()
+
+    async def show():
+        async for message in client:
+            print(json.dumps(message), flush=True)
+    printer = asyncio.ensure_future(show())
+
+    # Pipes and terminals are read without blocking the loop, regular files
+    # (including a redirected stdin) are simply read
+    reader = None
+    if lines is None:
+        if stat.S_ISREG(os.fstat(sys.stdin.fileno()).st_mode):
+            lines = sys.stdin
+        else:
+            reader = asyncio.StreamReader()
+            await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+
+    while client.is_logged_in or client.reconnecting:
+        if reader is not None:
+            line = (await reader.readline()).decode('utf-8')
+        else:
+            line = lines.readline()
+        if not line:
+            break
+
+        line = line.rstrip('\n')
+        if line == '/Quit':
+            break
+
+        # Lines read while reconnecting are sent once logged back in
+        await client.drain()
+        if not client.is_logged_in:
+            break
+        elif line.split()[:1] == ['/History']:
+            request_history(client, line)
+        elif line:
+            recip, text = address(client.username, line)
+            client.send(text, recip)
+
+        await client.drain()
+
+    if client.is_logged_in:
+        await asyncio.sleep(linger)
+    for error in client.errors:
+        print(error, file=sys.stderr)
+    client.close()
+    await printer
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Example client')
     parser.add_argument('host', help='IP or hostname')
@@ -205,27 +649,56 @@ if __name__ == '__main__':
                         help='TCP port (default 9000)')
     parser.add_argument('-ca', dest='cafile', metavar='cafile', type=str, default=None,
                         help='CA File')
+    parser.add_argument('--max-frame-size', metavar='bytes', type=int, default=DEFAULT_MAX_FRAME_SIZE,
+                        help='Largest frame accepted from the server (default {})'.format(DEFAULT_MAX_FRAME_SIZE))
+    parser.add_argument('--codec', choices=list(codec.CODECS), default=None,
+                        help='Only offer this codec at login (default: offer all, preferring bin1)')
+    parser.add_argument('--no-compression', action='store_true',
+                        help='Do not offer to compress large frames')
+    parser.add_argument('--headless', metavar='username', default=None,
+                        help='Log in as username, send each line of --input and print what is received as '
+                             'JSON lines, for bots and scripts')
+    parser.add_argument('--input', metavar='path', default=None,
+                        help='With --headless, read lines from this file (default standard input)')
+    parser.add_argument('--no-reconnect', action='store_true',
+                        help='Exit when the connection drops instead of reconnecting and resuming')
+    parser.add_argument('--linger', metavar='seconds', type=float, default=0,
+                        help='With --headless, keep printing replies this long after the input ends (default 0)')
     args = parser.parse_args()
 
     loop = asyncio.get_event_loop()
 
-    # we only need one client instance
-    client = AsyncClient()
+    # Made once, it keeps the TLS session for reconnecting
+    context = tls.client_context(args.cafile)
 
-    # the lambda client serves as a factory that just returns
-    # the client instance we just created
-    purpose = ssl.Purpose.SERVER_AUTH
-    context = ssl.create_default_context(purpose, cafile=args.cafile)
     server_name = args.host
     if args.cafile is not None:
         server_name = 'localhost'
 
-    coro = loop.create_connection(lambda: client, host=args.host, port=args.p, ssl=context, server_hostname=server_name)
+    if args.headless is not None:
+        client = loop.run_until_complete(HeadlessClient.connect(
+            args.host, args.p, args.headless, context, server_name, max_frame_size=args.max_frame_size,
+            codecs=[args.codec] if args.codec else codec.CODECS, compression=not args.no_compression,
+            reconnect=not args.no_reconnect))
+
+        lines = open(args.input, encoding='utf-8') if args.input is not None else None
+        try:
+            loop.run_until_complete(run_headless(client, lines, args.linger))
+        finally:
+            if lines is not None:
+                lines.close()
+            loop.close()
+        sys.exit(0)
+
+    # we only need one client instance
+    client = AsyncClient(args.max_frame_size, [args.codec] if args.codec else codec.CODECS, not args.no_compression,
+                         context, not args.no_reconnect)
 
-    loop.run_until_complete(coro)
+    # open() remembers where to for reconnecting
+    loop.run_until_complete(client.open(args.host, args.p, server_name))
 
     # Start a task which reads from standard input
-    asyncio.async(handle_user_input(loop, client))
+    asyncio.ensure_future(handle_user_input(loop, client))
 
     try:
         loop.run_forever()
@@ -0,0 +1,181 @@
+"""codec
+Payload encodings for the Chatterbox protocol
+
+Frames carry JSON by default. A client may offer other codecs in its login
+frame ("CODECS": ["bin1", "json"]); the server answers with the one it
+picked in the USERNAME_ACCEPTED reply ("CODEC": "bin1") and both sides use it
+for every frame after that reply. Text is always UTF-8, except that a lone
+surrogate from an old journal, which UTF-8 can't carry, is escaped by json
+(the frame goes out as ASCII JSON) and passed through as is by bin1.
+
+bin1 packs frames that carry nothing but MESSAGES: every username in the
+frame is written once to a name table and referenced by index, timestamps
+are stored as variable length deltas from the previous message, and message
+IDs as variable length integers. Packed frames start with a 0x01 byte, any
+other frame is sent as plain JSON, which always starts with "{". A peer
+that decodes with bin1 therefore still reads frames sent before the switch.
+"""
+import json
+
+# Compact separators, the protocol never needs the whitespace
+_encoder = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False)
+_ascii_encoder = json.JSONEncoder(separators=(',', ':'))
+
+
+class JsonCodec:
+    """The protocol's original JSON encoding, as UTF-8"""
+
+    name = "json"
+
+    def encode(self, message):
+        text = _encoder.encode(message)
+        try:
+            return text.encode('utf-8')
+        except UnicodeEncodeError:
+            return _ascii_encoder.encode(message).encode('ascii')
+
+    def decode(self, payload):
+        return json.loads(bytes(payload).decode('utf-8'))
+
+
+# First byte of a packed bin1 payload, JSON payloads start with "{"
+PACKED_MESSAGES = 1
+
+
+def _write_uvarint(out, value):
+    if value < 0:
+        raise ValueError("negative value for unsigned varint")
+
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _write_svarint(out, value):
+    _write_uvarint(out, value * 2 if value >= 0 else -value * 2 - 1)
+
+
+def _write_text(out, text):
+    data = text.encode('utf-8', 'surrogatepass')
+    _write_uvarint(out, len(data))
+    out += data
+
+
+def _read_uvarint(payload, offset):
+    value = 0
+    shift = 0
+
+    while True:
+        byte = payload[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+def _read_svarint(payload, offset):
+    value, offset = _read_uvarint(payload, offset)
+    return (value >> 1) if not value & 1 else -((value + 1) >> 1), offset
+
+
+def _read_text(payload, offset):
+    size, offset = _read_uvarint(payload, offset)
+    return bytes(payload[offset:offset + size]).decode('utf-8', 'surrogatepass'), offset + size
+
+
+class BinaryCodec:
+    """Compact encoding for MESSAGES frames with interned usernames"""
+
+    name = "bin1"
+
+    def encode(self, message):
+        if len(message) == 1 and "MESSAGES" in message:
+            try:
+                return self._encode_messages(message["MESSAGES"])
+            except (AttributeError, TypeError, ValueError):
+                # Anything that doesn't fit the packed layout goes as JSON
+                pass
+
+        return JSON.encode(message)
+
+    def _encode_messages(self, messages):
+        names = {}
+        body = bytearray()
+        previous_time = 0
+
+        _write_uvarint(body, len(messages))
+        for message in messages:
+            if len(message) not in (4, 5) or type(message[2]) is not int:
+                raise ValueError("message does not fit the packed layout")
+
+            source, destination, timestamp, content = message[:4]
+            for name in (source, destination):
+                if name not in names:
+                    names[name] = len(names)
+
+            body.append(len(message) == 5)
+            _write_uvarint(body, names[source])
+            _write_uvarint(body, names[destination])
+            _write_svarint(body, timestamp - previous_time)
+            _write_text(body, content)
+            if len(message) == 5:
+                _write_uvarint(body, message[4])
+
+            previous_time = timestamp
+
+        out = bytearray([PACKED_MESSAGES])
+        _write_uvarint(out, len(names))
+        for name in names:
+            _write_text(out, name)
+
+        return bytes(out + body)
+
+    def decode(self, payload):
+        if payload[0] != PACKED_MESSAGES:
+            return JSON.decode(payload)
+
+        offset = 1
+        names = []
+        count, offset = _read_uvarint(payload, offset)
+        for _ in range(count):
+            name, offset = _read_text(payload, offset)
+            names.append(name)
+
+        messages = []
+        timestamp = 0
+        count, offset = _read_uvarint(payload, offset)
+        for _ in range(count):
+            has_id = payload[offset]
+            source, offset = _read_uvarint(payload, offset + 1)
+            destination, offset = _read_uvarint(payload, offset)
+            delta, offset = _read_svarint(payload, offset)
+            content, offset = _read_text(payload, offset)
+
+            timestamp += delta
+            message = [names[source], names[destination], timestamp, content]
+            if has_id:
+                message_id, offset = _read_uvarint(payload, offset)
+                message.append(message_id)
+            messages.append(message)
+
+        return {"MESSAGES": messages}
+
+
+JSON = JsonCodec()
+BINARY = BinaryCodec()
+
+# Codecs by the name clients offer them under, in order of preference
+CODECS = {BINARY.name: BINARY, JSON.name: JSON}
+
+
+# Pre: offered is the CODECS list from a client's login frame, if any
+# Post: returns the first codec in the client's list this side supports,
+#       falling back to JSON
+def negotiate(offered):
+    if isinstance(offered, list):
+        for name in offered:
+            if isinstance(name, str) and name in CODECS:
+                return CODECS[name]
+    return JSON
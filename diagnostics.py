@@ -0,0 +1,143 @@
+"""diagnostics
+Event loop lag monitoring and on-demand profiling for the Chatterbox server
+
+Enabled with --diagnostics. A timer measures how late the event loop runs
+it and logs when the loop falls behind, the handlers most likely to stall
+it are timed and logged by name when one runs longer than the slow callback
+threshold, and two signals toggle profiling of a running server:
+
+    kill -USR1 <pid>   start, then stop, a cProfile capture (.prof)
+    kill -USR2 <pid>   start, then stop, a stack sampling capture, written
+                       as collapsed stacks for flame graph tools (.folded)
+
+Captures are written to --profile-dir and only cover the event loop's
+thread. Nothing here is installed without --diagnostics, so the handlers
+run unwrapped otherwise.
+"""
+import cProfile
+import functools
+import os
+import signal
+import time
+
+import metrics
+from metrics import log
+
+DEFAULT_LAG_INTERVAL = 0.1  # Seconds between lag measurements
+DEFAULT_SLOW_CALLBACK = 0.05  # Seconds a handler may run before it is logged
+DEFAULT_SAMPLE_INTERVAL = 0.001  # Seconds of CPU time between stack samples
+
+LOOP_LAG_SECONDS = metrics.Histogram('chatterbox_loop_lag_seconds', 'How late the event loop ran a timer')
+
+
+class LagMonitor:
+    """Schedules a timer every interval and records how late it fires"""
+
+    def __init__(self, loop, interval=DEFAULT_LAG_INTERVAL, threshold=DEFAULT_SLOW_CALLBACK):
+        self.loop = loop
+        self.interval = interval
+        self.threshold = threshold
+        self._expected = None
+        self._handle = None
+
+    def start(self):
+        self._expected = self.loop.time() + self.interval
+        self._handle = self.loop.call_at(self._expected, self._tick)
+
+    def stop(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def _tick(self):
+        lag = self.loop.time() - self._expected
+        LOOP_LAG_SECONDS.observe(lag)
+        if lag > self.threshold:
+            log.warning("Event loop lagged %.1f ms", lag * 1000)
+        self.start()
+
+
+# Pre: owner is a class, names are methods of it likely to block the loop
+# Post: each method logs its name and duration whenever a call takes longer
+#       than threshold seconds
+def instrument(owner, names, threshold=DEFAULT_SLOW_CALLBACK):
+    for name in names:
+        setattr(owner, name, _timed(getattr(owner, name), '{}.{}'.format(owner.__name__, name), threshold))
+
+
+def _timed(method, label, threshold):
+    @functools.wraps(method)
+    def timed(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            if elapsed > threshold:
+                log.warning("Slow callback %s took %.1f ms", label, elapsed * 1000)
+    return timed
+
+
+class Profiler:
+    """cProfile and stack sampling captures, toggled by signals"""
+
+    def __init__(self, directory='.', sample_interval=DEFAULT_SAMPLE_INTERVAL):
+        self.directory = directory
+        self.sample_interval = sample_interval
+        self._profile = None
+        self._samples = None
+
+    # Pre: loop is the running process's event loop
+    # Post: SIGUSR1 toggles cProfile and SIGUSR2 toggles sampling
+    def install(self, loop):
+        loop.add_signal_handler(signal.SIGUSR1, self.toggle_profile)
+        loop.add_signal_handler(signal.SIGUSR2, self.toggle_sampling)
+
+    def _path(self, extension):
+        return os.path.join(self.directory, 'chatterbox-{}-{}.{}'.format(
+            os.getpid(), time.strftime('%Y%m%d-%H%M%S'), extension))
+
+    def toggle_profile(self):
+        if self._profile is None:
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+            log.warning("cProfile capture started")
+            return
+
+        self._profile.disable()
+        path = self._path('prof')
+        self._profile.dump_stats(path)
+        self._profile = None
+        log.warning("cProfile capture written to %s", path)
+
+    def toggle_sampling(self):
+        if self._samples is None:
+            self._samples = {}
+            signal.signal(signal.SIGPROF, self._sample)
+            signal.setitimer(signal.ITIMER_PROF, self.sample_interval, self.sample_interval)
+            log.warning("Stack sampling started")
+            return
+
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_IGN)
+        samples, self._samples = self._samples, None
+
+        path = self._path('folded')
+        with open(path, 'w') as f:
+            for stack, count in sorted(samples.items(), key=lambda item: -item[1]):
+                f.write('{} {}\n'.format(stack, count))
+        log.warning("%d stack samples written to %s", sum(samples.values()), path)
+
+    # SIGPROF handler, counts the stack the main thread was interrupted in
+    def _sample(self, signum, frame):
+        if self._samples is None:
+            return
+
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('{}:{}'.format(os.path.basename(code.co_filename), code.co_name))
+            frame = frame.f_back
+
+        key = ';'.join(reversed(stack))
+        self._samples[key] = self._samples.get(key, 0) + 1
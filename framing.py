@@ -0,0 +1,197 @@
+"""framing
+Length prefixed framing shared by the Chatterbox client and server
+
+Every frame on the wire is a 4 byte unsigned integer (struct format "!I")
+holding the length of the payload, followed by the payload itself.
+
+Connections that negotiated compression may set the top bit of the header
+(COMPRESSED). The payload of such a frame is deflate data produced with one
+zlib stream per direction and flushed with Z_SYNC_FLUSH, so each frame can be
+inflated as soon as it arrives while still sharing the stream's dictionary
+with the frames before it. Only frames of at least a threshold size are
+compressed, short chat lines are sent as they are.
+"""
+import struct
+import time
+import zlib
+
+import codec
+import metrics
+
+HEADER = struct.Struct("!I")
+HEADER_SIZE = HEADER.size
+
+COMPRESSED = 0x80000000  # Header bit marking a deflated payload
+DEFLATE = "deflate"  # Name the compression is negotiated under
+DEFAULT_COMPRESS_THRESHOLD = 1024  # Smallest payload worth compressing
+
+ENCODE_SECONDS = metrics.Histogram('chatterbox_encode_seconds', 'Time spent encoding and framing a message')
+
+# Anything larger than this is treated as a protocol error rather than
+# something we are willing to buffer in memory
+DEFAULT_MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+
+class FrameTooLarge(ValueError):
+    """Raised when a peer announces a frame over the configured maximum"""
+
+    def __init__(self, size, max_frame_size):
+        super().__init__("Frame of {} bytes exceeds the maximum of {} bytes".format(size, max_frame_size))
+        self.size = size
+        self.max_frame_size = max_frame_size
+
+
+class FrameDecoder:
+    """Incremental decoder for a stream of length prefixed frames
+
+    Chunks handed to feed() may contain any number of frames, including
+    partial ones at either end. Complete payloads are returned in order and
+    the unconsumed tail stays in the buffer until the next chunk arrives.
+    """
+
+    def __init__(self, max_frame_size=DEFAULT_MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self._buffer = bytearray()
+
+        # Inflates COMPRESSED frames once compression is enabled, until then
+        # the flag makes the header look oversized and is rejected
+        self._inflater = None
+
+        # Length of the frame currently being accumulated, None while we are
+        # still waiting on its header
+        self._pending = None
+
+    # Pre: data is a bytes-like chunk read off the transport
+    # Post: returns a list of complete payloads (bytes), possibly empty
+    # Purpose: appends the chunk to the buffer and slices out every frame
+    #       that is now complete, raising FrameTooLarge if a header announces
+    #       more than max_frame_size bytes
+    def feed(self, data):
+        buffer = self._buffer
+        buffer += data
+
+        # Still waiting on the rest of a large frame, nothing to scan
+        if self._pending is not None and len(buffer) < HEADER_SIZE + self._pending:
+            return []
+
+        frames = []
+        offset = 0
+        end = len(buffer)
+
+        with memoryview(buffer) as view:
+            while end - offset >= HEADER_SIZE:
+                size = HEADER.unpack_from(view, offset)[0]
+                compressed = size & COMPRESSED and self._inflater is not None
+                if compressed:
+                    size &= ~COMPRESSED
+                if size > self.max_frame_size:
+                    raise FrameTooLarge(size, self.max_frame_size)
+
+                start = offset + HEADER_SIZE
+                if end - start < size:
+                    self._pending = size
+                    break
+
+                if compressed:
+                    frames.append(self._inflate(view[start:start + size]))
+                else:
+                    frames.append(bytes(view[start:start + size]))
+                offset = start + size
+            else:
+                self._pending = None
+
+        # Deleting from the front of a bytearray only moves its start pointer,
+        # so the partial tail is kept without being copied again
+        if offset:
+            del buffer[:offset]
+
+        return frames
+
+    # Number of bytes received but not yet returned as part of a frame
+    def buffered(self):
+        return len(self._buffer)
+
+    # Accept COMPRESSED frames from the peer from now on
+    def enable_compression(self):
+        if self._inflater is None:
+            self._inflater = zlib.decompressobj()
+
+    def _inflate(self, data):
+        # Bounded so a small frame can't inflate into an unbounded one
+        payload = self._inflater.decompress(data, self.max_frame_size + 1)
+        if len(payload) > self.max_frame_size or self._inflater.unconsumed_tail:
+            raise FrameTooLarge(len(payload), self.max_frame_size)
+        return payload
+
+
+# Pre: payload is an encoded bytes-like message
+# Post: returns the header and payload as a single bytes object
+# Purpose: builds a frame ready to be written to a transport
+def encode_frame(payload):
+    return HEADER.pack(len(payload)) + payload
+
+
+class FrameCompressor:
+    """Deflates outgoing frames for one connection
+
+    Frames are handed over already framed, exactly as they would be written,
+    and must be compressed in the order they are written since they share a
+    single zlib stream. Frames under the threshold come back unchanged so
+    they can still be shared between connections.
+    """
+
+    def __init__(self, threshold=DEFAULT_COMPRESS_THRESHOLD, level=zlib.Z_DEFAULT_COMPRESSION):
+        self.threshold = threshold
+        self._deflater = zlib.compressobj(level)
+
+    # Pre: data is a whole frame built by encode_frame
+    # Post: returns the frame to write, compressed if it is large enough
+    def compress(self, data):
+        if len(data) - HEADER_SIZE < self.threshold:
+            return data
+
+        with memoryview(data) as view:
+            payload = self._deflater.compress(view[HEADER_SIZE:])
+        payload += self._deflater.flush(zlib.Z_SYNC_FLUSH)
+        return HEADER.pack(len(payload) | COMPRESSED) + payload
+
+
+class Frame:
+    """A message serialized and length prefixed once per codec
+
+    The header and payload are joined into a single immutable bytes object
+    the first time the frame is written with a codec, so the same object can
+    be handed to every recipient using that codec without packing a header or
+    copying the payload per recipient. Frames keep the message they came from
+    so queued frames can be merged later.
+    """
+
+    __slots__ = ('message', '_encoded')
+
+    def __init__(self, message):
+        self.message = message
+        self._encoded = {}
+
+    # Pre: message is a JSON serializable protocol object
+    # Post: returns the message as a Frame
+    @classmethod
+    def encode(cls, message):
+        return cls(message)
+
+    # Pre: codec is one of the codec.CODECS
+    # Post: returns the header and payload for codec as a single bytes object
+    def encoded(self, codec=codec.JSON):
+        data = self._encoded.get(codec.name)
+        if data is None:
+            started = time.perf_counter()
+            data = self._encoded[codec.name] = encode_frame(codec.encode(self.message))
+            ENCODE_SECONDS.observe(time.perf_counter() - started)
+        return data
+
+    # The frame as JSON, as every frame was before codecs were negotiated
+    @property
+    def data(self):
+        return self.encoded()
+
+    def __len__(self):
+        return len(self.data)
@@ -0,0 +1,98 @@
+"""heartbeat
+Application level heartbeats and reaping of dead connections
+
+A connection that has sent nothing for --ping-after seconds is sent a PING
+frame, which clients answer with PONG. One that has still sent nothing
+after --idle-timeout seconds is taken for dead (a half-open TCP connection,
+say) and aborted, which frees its username and takes it out of every
+broadcast.
+
+Connections aren't given a timer each. A single hashed timer wheel per
+process ticks once per --heartbeat-tick and only looks at the connections in
+the current slot, so tens of thousands of idle connections cost a dict entry
+each and no per-frame work beyond noting when data last arrived. A
+connection whose deadline comes up checks how long it has really been idle
+and is put back on the wheel if it has heard from its client since.
+"""
+import math
+
+import metrics
+
+DEFAULT_PING_AFTER = 30.0  # Seconds of silence before a client is pinged
+DEFAULT_IDLE_TIMEOUT = 90.0  # Seconds of silence before a connection is aborted
+DEFAULT_TICK = 1.0  # Seconds between turns of the wheel
+DEFAULT_SLOTS = 128  # Slots on the wheel, later deadlines take extra rounds
+
+PINGS = metrics.Counter('chatterbox_pings_total', 'PING frames sent to idle clients')
+REAPED = metrics.Counter('chatterbox_idle_reaped_total', 'Connections aborted for sending nothing, not even PONG')
+
+
+class TimerWheel:
+    """Hashed timer wheel calling callback(key) for each key that comes due
+
+    Scheduling and cancelling are O(1). Deadlines are rounded up to whole
+    ticks, a key may come due up to a tick early.
+    """
+
+    def __init__(self, loop, callback, tick=DEFAULT_TICK, slots=DEFAULT_SLOTS):
+        self.loop = loop
+        self.callback = callback
+        self.tick = tick
+
+        # Each slot maps its keys to the full turns left before they are due
+        self.slots = [dict() for _ in range(slots)]
+        self.where = {}  # Key to the slot it is in
+        self.cursor = 0  # Slot handled on the next tick
+        self._handle = None
+
+    def __len__(self):
+        return len(self.where)
+
+    # Pre: key is hashable, delay in seconds
+    # Post: callback(key) is called in about delay seconds, replacing any
+    #       deadline key already had
+    def schedule(self, key, delay):
+        self.cancel(key)
+
+        ticks = max(math.ceil(delay / self.tick), 1)
+        rounds, offset = divmod(ticks - 1, len(self.slots))
+        slot = (self.cursor + offset) % len(self.slots)
+        self.slots[slot][key] = rounds
+        self.where[key] = slot
+
+        if self._handle is None:
+            self._handle = self.loop.call_later(self.tick, self._advance)
+
+    def cancel(self, key):
+        slot = self.where.pop(key, None)
+        if slot is not None:
+            del self.slots[slot][key]
+
+    # Handles the current slot: keys on their last round come due, the
+    # others have a round less to go
+    def _advance(self):
+        slot = self.slots[self.cursor]
+        self.cursor = (self.cursor + 1) % len(self.slots)
+
+        due = []
+        for key, rounds in slot.items():
+            if rounds:
+                slot[key] = rounds - 1
+            else:
+                due.append(key)
+
+        for key in due:
+            del slot[key]
+            del self.where[key]
+            self.callback(key)
+
+        if self.where:
+            self._handle = self.loop.call_later(self.tick, self._advance)
+        else:
+            self._handle = None
+
+    # Stops the wheel, nothing on it comes due
+    def close(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
@@ -0,0 +1,213 @@
+"""history
+Compact, memory-bounded store for the public message history
+
+Messages are kept in columns rather than as one list per message: sender
+and recipient names are interned and stored as integer IDs, timestamps in a
+packed integer array and the text of every message in one UTF-8 buffer
+with an array of end offsets. Appending is amortized O(1) and any message
+can be read by its ID, which is still its position in the history.
+
+Only the newest messages are held in memory. Once a snapshot has copied
+messages to the on-disk archive (see storage.py) the retention policy may
+evict them, oldest first, when the store holds more than --retain-messages
+messages, more than --retain-bytes bytes, or messages older than
+--retain-age seconds. Evicted messages are read back from the memory mapped
+archive, so eviction never changes what a client can page through.
+"""
+import time
+from array import array
+
+import metrics
+
+DEFAULT_RETAIN_MESSAGES = 100000  # Messages held in memory
+DEFAULT_RETAIN_BYTES = 64 * 1024 * 1024  # Bytes of columns held in memory
+DEFAULT_RETAIN_AGE = None  # Seconds a message is held in memory, no limit
+
+ROW_SIZE = 24  # Bytes per message besides its text, sender, recipient, time and end offset
+COMPACT_MIN = 1024  # Evicted rows left in the columns before they are reclaimed
+
+EVICTED = metrics.Counter('chatterbox_history_evicted_total', 'Messages evicted from memory to the archive')
+
+
+class Retention:
+    """How much history is held in memory, None for no limit on a dimension"""
+
+    def __init__(self, messages=DEFAULT_RETAIN_MESSAGES, bytes=DEFAULT_RETAIN_BYTES, age=DEFAULT_RETAIN_AGE):
+        self.messages = messages
+        self.bytes = bytes
+        self.age = age
+
+
+class MessageStore:
+    """The public history, archived messages on disk and the newest in columns
+
+    Supports what the server needs from its message list: len(), indexing,
+    slicing, iteration and append(). Reads return a fresh (SRC, DEST,
+    TIMESTAMP, CONTENT) list. archive is a storage.MessageArchive holding the
+    first archived messages, or None to keep everything in memory.
+    """
+
+    def __init__(self, archive=None, archived=0, retention=None):
+        self.archive = archive
+        self.retention = retention if retention is not None else Retention()
+
+        self.names = []  # Interned names, a name's ID is its position
+        self._name_ids = {}
+
+        self._senders = array('I')
+        self._dests = array('I')
+        self._times = array('q')
+        self._ends = array('Q')  # End of each message's text in _text, plus _base
+        self._text = bytearray()
+        self._base = 0  # Text offset of _text[0], bytes reclaimed so far
+
+        # Messages that don't fit the columns (a timestamp that isn't an
+        # integer, say) are kept whole by ID, their rows are placeholders
+        self._irregular = {}
+
+        self._first = archived  # ID of the first message held in memory
+        self._start = 0  # Row of that message, rows before it are evicted
+        self.nbytes = 0  # Bytes held for the messages in memory
+
+        self.archived = 0
+        self._mapped = None
+        self.archived_through(archived)
+
+    def __len__(self):
+        return self._first + len(self._senders) - self._start
+
+    # Messages held in memory
+    @property
+    def held(self):
+        return len(self._senders) - self._start
+
+    def _intern(self, name):
+        name_id = self._name_ids.get(name)
+        if name_id is None:
+            name_id = self._name_ids[name] = len(self.names)
+            self.names.append(name)
+        return name_id
+
+    # Pre: message is a public (SRC, DEST, TIMESTAMP, CONTENT) list
+    # Post: the message is stored with the next message ID and messages the
+    #       retention policy no longer allows in memory are evicted
+    def append(self, message):
+        try:
+            sender, dest, timestamp, content = message
+            if {type(sender), type(dest), type(content)} != {str} or type(timestamp) is not int:
+                raise TypeError
+            text = content.encode('utf-8', 'surrogatepass')
+            self._times.append(timestamp)
+        except (TypeError, ValueError, OverflowError):
+            self._irregular[len(self)] = message
+            sender, dest, text = '', '', b''
+            self._times.append(int(time.time()))
+
+        self._senders.append(self._intern(sender))
+        self._dests.append(self._intern(dest))
+        self._text += text
+        self._ends.append(self._base + len(self._text))
+        self.nbytes += ROW_SIZE + len(text)
+
+        self._evict()
+
+    def extend(self, messages):
+        for message in messages:
+            self.append(message)
+
+    def _read(self, i):
+        message = self._irregular.get(i)
+        if message is not None:
+            return list(message)
+
+        row = i - self._first + self._start
+        start = self._ends[row - 1] - self._base if row else 0
+        end = self._ends[row] - self._base
+        return [self.names[self._senders[row]], self.names[self._dests[row]], self._times[row],
+                self._text[start:end].decode('utf-8', 'surrogatepass')]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("message index out of range")
+
+        if i < self._first:
+            return self._mapped[i]
+        return self._read(i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    # Pre: count messages are safely in the archive
+    # Post: they are read through a fresh mapping and may be evicted
+    def archived_through(self, count):
+        if self.archive is None or count <= self.archived:
+            return
+
+        self.archived = count
+        self._mapped = self.archive.map(count)
+        self._evict()
+
+    # Pre: the store holds no messages newer than the archive yet
+    # Post: the newest archived messages the retention policy allows are
+    #       read back into memory
+    # Purpose: loads history at startup so the first pages served don't
+    #       have to touch the disk
+    def preload(self):
+        keep = self._first
+        if self.retention.messages is not None:
+            keep = min(keep, self.retention.messages)
+
+        first = self._first - keep
+        self._first = first
+        for i in range(first, first + keep):
+            self.append(self._mapped[i])
+
+    def _over_limit(self, now):
+        retention = self.retention
+        if retention.messages is not None and self.held > retention.messages:
+            return True
+        if retention.bytes is not None and self.nbytes > retention.bytes:
+            return True
+        if retention.age is not None and self._times[self._start] < now - retention.age:
+            return True
+        return False
+
+    # Evicts the oldest archived messages until the store is within the
+    # retention policy or only messages not yet archived are left
+    def _evict(self):
+        now = time.time() if self.retention.age is not None else None
+        evicted = 0
+
+        while self._first < self.archived and self._over_limit(now):
+            row = self._start
+            start = self._ends[row - 1] - self._base if row else 0
+            self.nbytes -= ROW_SIZE + self._ends[row] - self._base - start
+            self._irregular.pop(self._first, None)
+            self._first += 1
+            self._start += 1
+            evicted += 1
+
+        if evicted:
+            EVICTED.inc(evicted)
+            if self._start >= COMPACT_MIN and self._start * 2 >= len(self._senders):
+                self._reclaim()
+
+    # Drops evicted rows from the columns, each row is dropped once so the
+    # cost is amortized over the appends that pushed them out
+    def _reclaim(self):
+        start = self._start
+        offset = self._ends[start - 1] - self._base
+
+        del self._senders[:start]
+        del self._dests[:start]
+        del self._times[:start]
+        del self._ends[:start]
+        del self._text[:offset]
+        self._base += offset
+        self._start = 0
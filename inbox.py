@@ -0,0 +1,95 @@
+"""inbox
+Per-user inboxes for direct messages
+
+Every DM is kept in its recipient's inbox until the recipient acknowledges
+it, whether they were online when it was sent or not. Each inbox numbers
+its messages from 0, and a DM is delivered with that inbox ID appended as a
+fifth element. Clients send INBOX_ACK with the ID of the newest DM they
+have received, which drops it and everything before it from the inbox. A
+client that acknowledges DMs says so by putting INBOX_ACK in its USERNAME
+frame, null if it has received none yet; at login it is sent only what is
+still pending, found by recipient rather than by scanning any history.
+Clients that never acknowledge aren't sent their inbox at login, it would
+only grow back to --inbox-size old DMs sent again every time.
+
+An inbox holds at most --inbox-size messages, the oldest unacknowledged
+ones are dropped beyond that.
+"""
+import metrics
+
+DEFAULT_MAX_PENDING = 1000  # Unacknowledged messages kept per user
+
+DROPPED = metrics.Counter('chatterbox_inbox_dropped_total', 'Unacknowledged DMs dropped from full inboxes')
+
+
+class InboxIndex:
+    """Pending DMs by recipient
+
+    inboxes is the server's persisted mapping of username to {"first": ID of
+    the oldest message held, "messages": list of pending messages}. It is
+    updated in place so it can be snapshotted like the rest of the state.
+    """
+
+    def __init__(self, inboxes, max_pending=DEFAULT_MAX_PENDING):
+        self.inboxes = inboxes
+        self.max_pending = max_pending
+        self.changed = set()  # Users whose inboxes changed since take_changed()
+
+    # Returns the users whose inboxes changed since it was last called
+    def take_changed(self):
+        changed = self.changed
+        self.changed = set()
+        return changed
+
+    # Pre: message is a (SRC, DEST, TIMESTAMP, CONTENT) list for user
+    # Post: returns the inbox ID assigned to message
+    def add(self, user, message):
+        inbox = self.inboxes.get(user)
+        if inbox is None:
+            inbox = self.inboxes[user] = {"first": 0, "messages": list()}
+
+        messages = inbox["messages"]
+        messages.append(message)
+        self.changed.add(user)
+        message_id = inbox["first"] + len(messages) - 1
+
+        if len(messages) > self.max_pending:
+            dropped = len(messages) - self.max_pending
+            del messages[:dropped]
+            inbox["first"] += dropped
+            DROPPED.inc(dropped)
+
+        return message_id
+
+    # True if through is the inbox ID of a message still pending for user
+    def holds(self, user, through):
+        inbox = self.inboxes.get(user)
+        return inbox is not None and inbox["first"] <= through < inbox["first"] + len(inbox["messages"])
+
+    # Pre: through is the inbox ID of a message user has received
+    # Post: returns True if it and every message before it were dropped
+    #       from the inbox, False if it isn't pending. An ID that was never
+    #       issued drops nothing, so a bad one can't lose DMs not yet
+    #       delivered.
+    def ack(self, user, through):
+        if not self.holds(user, through):
+            return False
+
+        inbox = self.inboxes[user]
+        del inbox["messages"][:through - inbox["first"] + 1]
+        inbox["first"] = through + 1
+        self.changed.add(user)
+        return True
+
+    # Pre: after is the inbox ID of the newest message user has received, or
+    #       None
+    # Post: returns the pending messages after it, oldest first with their
+    #       inbox ID appended
+    def after(self, user, after=None):
+        inbox = self.inboxes.get(user)
+        if inbox is None:
+            return []
+
+        first = inbox["first"]
+        start = max(after + 1 - first, 0) if after is not None else 0
+        return [message + [first + i] for i, message in enumerate(inbox["messages"][start:], start)]
@@ -0,0 +1,158 @@
+"""metrics
+Counters, gauges and histograms for the Chatterbox server
+
+Instruments are created once at import time by the modules that update
+them and registered in REGISTRY. Updating one is an attribute increment or
+a bucket search, cheap enough for the per-frame paths. render() writes
+every registered instrument in the Prometheus text exposition format, and
+serve() answers HTTP scrapes with it on a local port (--metrics-port).
+
+Also holds the server's logger, whose per-message records are rate limited
+so a busy server can log at debug level without the logging dominating.
+"""
+import asyncio
+import bisect
+import logging
+import time
+
+# Latency buckets in seconds, from 50us to 10s
+TIME_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                1.0, 2.5, 10.0)
+# Recipients per fanned out frame
+FANOUT_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+REGISTRY = []
+
+
+class Counter:
+    """A value that only goes up"""
+
+    kind = "counter"
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+        REGISTRY.append(self)
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        yield self.name, self.value
+
+
+class Gauge:
+    """A value read from a function whenever metrics are rendered"""
+
+    kind = "gauge"
+
+    def __init__(self, name, help, function=None):
+        self.name = name
+        self.help = help
+        self.function = function
+        REGISTRY.append(self)
+
+    def samples(self):
+        yield self.name, self.function() if self.function is not None else 0
+
+
+class Histogram:
+    """Counts observations into cumulative buckets"""
+
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=TIME_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # The last one is +Inf
+        self.sum = 0
+        REGISTRY.append(self)
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self):
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield '{}_bucket{{le="{}"}}'.format(self.name, bound), total
+        total += self.counts[-1]
+        yield '{}_bucket{{le="+Inf"}}'.format(self.name), total
+        yield self.name + '_sum', self.sum
+        yield self.name + '_count', total
+
+
+# Pre: none
+# Post: returns every registered instrument in the Prometheus text format
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.append('# HELP {} {}'.format(metric.name, metric.help))
+        lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+        for name, value in metric.samples():
+            lines.append('{} {}'.format(name, value))
+    return '\n'.join(lines) + '\n'
+
+
+# Answers every HTTP request on the connection with the current metrics
+async def _handle_scrape(reader, writer):
+    try:
+        request = await reader.readuntil(b'\r\n\r\n')
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        writer.close()
+        return
+
+    if request.startswith(b'GET /metrics ') or request.startswith(b'GET / '):
+        body = render().encode('utf-8')
+        status = b'200 OK'
+    else:
+        body = b'Not found\n'
+        status = b'404 Not Found'
+
+    writer.write(b'HTTP/1.0 ' + status + b'\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                 b'Content-Length: ' + str(len(body)).encode('ascii') + b'\r\nConnection: close\r\n\r\n' + body)
+    await writer.drain()
+    writer.close()
+
+
+# Pre: loop is the server's event loop
+# Post: returns the asyncio server answering scrapes on host:port
+def serve(loop, port, host='127.0.0.1'):
+    return loop.run_until_complete(asyncio.start_server(_handle_scrape, host, port))
+
+
+class RateLimitFilter(logging.Filter):
+    """Lets through at most burst records per message template per interval
+
+    Records over the limit are counted and the number suppressed is
+    reported with the next record of that template that gets through.
+    """
+
+    def __init__(self, burst=10, interval=1.0):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self._windows = {}  # Template to [window start, records let through, records suppressed]
+
+    def filter(self, record):
+        now = time.monotonic()
+        window = self._windows.get(record.msg)
+
+        if window is None or now - window[0] >= self.interval:
+            suppressed = window[2] if window is not None else 0
+            window = self._windows[record.msg] = [now, 0, 0]
+            if suppressed:
+                record.msg = record.msg + ' ({} similar messages suppressed)'.format(suppressed)
+
+        if window[1] >= self.burst:
+            window[2] += 1
+            return False
+
+        window[1] += 1
+        return True
+
+
+log = logging.getLogger('chatterbox')
@@ -0,0 +1,138 @@
+"""outbox
+Per-connection outbound queues for the Chatterbox server
+
+Frames go straight to the transport while the client keeps up. Once the
+transport's write buffer passes its high-water mark asyncio calls
+pause_writing() and frames are held in a bounded queue instead, which is
+drained again on resume_writing(). A client that lets the queue fill up is
+dealt with by the configured slow consumer policy, so it cannot make the
+server buffer without limit.
+"""
+from collections import deque
+
+import codec
+import metrics
+from framing import Frame
+
+# Slow consumer policies
+DROP_OLDEST = "drop-oldest"  # Discard the oldest queued frames
+COALESCE = "coalesce"  # Merge queued MESSAGES frames, then drop the oldest
+DISCONNECT = "disconnect"  # Abort the connection
+POLICIES = (DROP_OLDEST, COALESCE, DISCONNECT)
+
+DEFAULT_MAX_FRAMES = 1024
+DEFAULT_MAX_BYTES = 4 * 1024 * 1024
+
+FRAMES_OUT = metrics.Counter('chatterbox_frames_out_total', 'Frames written to client transports')
+BYTES_OUT = metrics.Counter('chatterbox_bytes_out_total', 'Bytes written to client transports, before TLS')
+
+
+class Outbox:
+    """Bounded queue of frames waiting for a paused transport"""
+
+    def __init__(self, transport, policy=DROP_OLDEST, max_frames=DEFAULT_MAX_FRAMES, max_bytes=DEFAULT_MAX_BYTES):
+        self.transport = transport
+        self.policy = policy
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self.codec = codec.JSON  # Switched once the client negotiates another
+        self.compressor = None  # framing.FrameCompressor once negotiated
+        self.roster = False  # Whether the client keeps a versioned roster
+
+        self.paused = False
+        self.closed = False
+        self.queue = deque()  # (frame, encoded bytes) in the order they were sent
+        self.queued_bytes = 0
+        self.dropped = 0  # Frames discarded because the client fell behind
+
+    # Number of frames waiting on the transport
+    @property
+    def depth(self):
+        return len(self.queue)
+
+    # Pre: frame is a framing.Frame
+    # Post: the frame is written, queued, or dropped by the policy
+    def send(self, frame):
+        if self.closed:
+            return
+
+        if not self.paused and not self.queue:
+            self._write(frame.encoded(self.codec))
+            return
+
+        # Encoded now so a codec switch only applies to frames sent after it
+        data = frame.encoded(self.codec)
+        self.queue.append((frame, data))
+        self.queued_bytes += len(data)
+
+        if len(self.queue) > self.max_frames or self.queued_bytes > self.max_bytes:
+            self.overflow()
+
+    # Called from the protocol's pause_writing()
+    def pause(self):
+        self.paused = True
+
+    # Called from the protocol's resume_writing(), writes queued frames until
+    # the queue is empty or the transport pauses us again
+    def resume(self):
+        self.paused = False
+
+        while self.queue and not self.paused and not self.closed:
+            frame, data = self.queue.popleft()
+            self.queued_bytes -= len(data)
+            self._write(data)
+
+    # Compression happens as frames are written rather than queued, since
+    # every compressed frame depends on the ones written before it
+    def _write(self, data):
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        FRAMES_OUT.value += 1
+        BYTES_OUT.value += len(data)
+        self.transport.write(data)
+
+    # Stops queueing and forgets anything still waiting
+    def close(self):
+        self.closed = True
+        self.queue.clear()
+        self.queued_bytes = 0
+
+    # Applies the slow consumer policy to a queue over its limits
+    def overflow(self):
+        if self.policy == DISCONNECT:
+            self.dropped += len(self.queue)
+            self.close()
+            self.transport.abort()
+            return
+
+        if self.policy == COALESCE:
+            self.coalesce()
+
+        while len(self.queue) > self.max_frames or self.queued_bytes > self.max_bytes:
+            frame, data = self.queue.popleft()
+            self.queued_bytes -= len(data)
+            self.dropped += 1
+
+    # Pre: none
+    # Post: every queued frame carrying nothing but MESSAGES is merged into a
+    #       single frame where the first of them was
+    def coalesce(self):
+        merged = []
+        position = None
+        kept = deque()
+
+        for frame, data in self.queue:
+            if list(frame.message) == ["MESSAGES"]:
+                if position is None:
+                    position = len(kept)
+                merged.extend(frame.message["MESSAGES"])
+            else:
+                kept.append((frame, data))
+
+        if position is None:
+            return
+
+        frame = Frame.encode({"MESSAGES": merged})
+        kept.insert(position, (frame, frame.encoded(self.codec)))
+        self.queue = kept
+        self.queued_bytes = sum(len(data) for frame, data in kept)
@@ -0,0 +1,112 @@
+"""presence
+Versioned roster of every user and whether they are online
+
+The roster is updated in place as users join and leave, and every change
+bumps its version. A snapshot of the whole roster is framed once and shared
+by every login until enough changes pile up after it; clients that keep a
+roster (they send ROSTER_VERSION at login) get that shared snapshot plus the
+changes since it, or only the changes since the version they last saw when
+they reconnect soon enough. Versions start over whenever the server does, so
+every roster also has a random epoch and a client's version only counts if
+it comes with the same epoch. The user listings for /DisplayUsers and
+/DisplayAllUsers are likewise built once per version.
+"""
+import os
+from collections import deque
+
+from framing import Frame
+
+DEFAULT_LOG_SIZE = 4096  # Changes kept for clients catching up
+DEFAULT_REBUILD_AFTER = 256  # Changes after which the shared snapshot is rebuilt
+
+
+class Roster:
+    """Every user ever logged in, in order of first login, with presence"""
+
+    def __init__(self, users, online, log_size=DEFAULT_LOG_SIZE, rebuild_after=DEFAULT_REBUILD_AFTER, epoch=None):
+        self.users = {user: user in online for user in users}
+        self.version = 0
+        # Tells this server start's versions from the last one's, workers
+        # are forked with the same roster and so share it
+        self.epoch = epoch if epoch is not None else os.urandom(4).hex()
+        self.rebuild_after = rebuild_after
+
+        # (version, user, online) for the latest changes, oldest first
+        self.log = deque(maxlen=log_size)
+
+        self._snapshot = None  # (version, Frame) shared by logins
+        self._cache = {}  # Built-per-version values, cleared on every change
+
+    # Pre: user has logged in or disconnected on some worker
+    # Post: returns the roster version after the change
+    def update(self, user, online):
+        if self.users.get(user) == online:
+            return self.version
+
+        self.users[user] = online
+        self.version += 1
+        self.log.append((self.version, user, online))
+        self._cache.clear()
+        return self.version
+
+    # Pre: version is a roster version a client saw
+    # Post: returns (joined, left) listing the users whose presence differs
+    #       from what it was at version, or None if the log no longer
+    #       reaches back that far
+    def changes_since(self, version):
+        if version > self.version or version < 0:
+            return None
+        if version < self.version and (not self.log or self.log[0][0] > version + 1):
+            return None
+
+        changed = {}
+        for change_version, user, online in reversed(self.log):
+            if change_version <= version:
+                break
+            if user not in changed:
+                changed[user] = online
+
+        joined = [user for user in changed if changed[user]]
+        left = [user for user in changed if not changed[user]]
+        return joined, left
+
+    # The roster as USER_LIST has always sent it, rebuilt once per version
+    def user_list(self):
+        if "user_list" not in self._cache:
+            self._cache["user_list"] = [{"name": user, "active": self.users[user]} for user in self.users]
+        return self._cache["user_list"]
+
+    # Pre: version and epoch are the ROSTER_VERSION and ROSTER_EPOCH a client
+    #       sent at login, None if it has no roster yet
+    # Post: returns the frames that bring the client's roster up to date
+    def catch_up(self, version, epoch=None):
+        if version is not None and epoch == self.epoch and self.changes_since(version) is not None:
+            return [self._delta_frame(version)]
+
+        if self._snapshot is None or self.version - self._snapshot[0] > self.rebuild_after:
+            snapshot = {"ROSTER": {"epoch": self.epoch, "version": self.version, "users": self.user_list()}}
+            self._snapshot = (self.version, Frame.encode(snapshot))
+
+        frames = [self._snapshot[1]]
+        if self._snapshot[0] != self.version:
+            frames.append(self._delta_frame(self._snapshot[0]))
+        return frames
+
+    def _delta_frame(self, since):
+        joined, left = self.changes_since(since)
+        return Frame.encode({"ROSTER": {"epoch": self.epoch, "version": self.version, "since": since,
+                                        "joined": joined, "left": left}})
+
+    # Text for /DisplayUsers
+    def display_online(self):
+        if "online" not in self._cache:
+            self._cache["online"] = '\n\nCURRENT USER(S) ONLINE\n' + str('-' * 22) + '\n' + "\n".join(
+                str(user) for user in self.users if self.users[user])
+        return self._cache["online"]
+
+    # Text for /DisplayAllUsers
+    def display_all(self):
+        if "all" not in self._cache:
+            self._cache["all"] = '\n\n   ALL USER(S)\n' + str('-' * 22) + '\n' + ''.join(
+                '\n' + str(user) + (' : ONLINE' if self.users[user] else ' : OFFLINE') for user in self.users)
+        return self._cache["all"]
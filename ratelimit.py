@@ -0,0 +1,182 @@
+"""ratelimit
+Token bucket rate limits and admission control
+
+Each connection has a bucket per class of request: chat messages, commands,
+heavy commands (those that build a reply over every user, channel or search
+result) and frames of any kind. A bucket holds up to its burst of tokens
+and refills at its rate; every request takes a token, refilled lazily when
+it is looked at, so a check is O(1) whatever the number of connections.
+
+A message or command arriving at an empty bucket is refused with an ERROR
+reply carrying RATE_LIMITED, sent once per run of refusals. Frames are never
+refused: a connection that has used up its frame tokens simply isn't read
+from until they have refilled, which pushes the flood back onto the client's
+own socket instead of the event loop.
+
+Each process also has buckets for new connections and for logins, so a
+burst of reconnections is turned away early instead of every client
+getting a slow reply.
+"""
+import math
+import time
+
+import metrics
+
+# Request classes
+MESSAGES = "messages"
+COMMANDS = "commands"
+HEAVY = "heavy"
+FRAMES = "frames"
+CONNECTIONS = "connections"
+LOGINS = "logins"
+
+HEAVY_COMMANDS = frozenset(("/DisplayUsers", "/DisplayAllUsers", "/Channels", "/Search"))
+
+# How refusals describe each class
+DESCRIPTIONS = {
+    MESSAGES: "Too many messages",
+    COMMANDS: "Too many commands",
+    HEAVY: "Too many user, channel and search listings",
+    CONNECTIONS: "Too many connections at once",
+    LOGINS: "Too many logins at once",
+}
+
+LIMITED = metrics.Counter('chatterbox_rate_limited_total', 'Requests refused by a rate limit')
+THROTTLED = metrics.Counter('chatterbox_throttled_total', 'Times reading from a client paused for its frame limit')
+TURNED_AWAY = metrics.Counter('chatterbox_connections_refused_total', 'Connections refused by admission control')
+
+
+class Limit:
+    """A sustained rate per second and the burst allowed above it
+
+    The burst defaults to the rate, but is at least one request, or a rate
+    below one a second could never be met.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate, 1)
+
+    def __repr__(self):
+        return '{}/{}'.format(self.rate, self.burst)
+
+
+# Per connection limits by request class, None for no limit
+DEFAULT_LIMITS = {
+    MESSAGES: Limit(20, 50),
+    COMMANDS: Limit(5, 20),
+    HEAVY: Limit(1, 5),
+    FRAMES: Limit(200, 400),
+}
+
+# Per process limits on new connections and logins
+DEFAULT_ADMISSION = {
+    CONNECTIONS: Limit(1000, 2000),
+    LOGINS: Limit(500, 1000),
+}
+
+
+# Pre: text is RATE or RATE/BURST as given on the command line
+# Post: returns the Limit, or None for a rate of 0
+def parse_limit(text):
+    rate, _, burst = text.partition('/')
+    rate = float(rate)
+    burst = float(burst) if burst else None
+    if rate < 0 or (burst is not None and burst < 1):
+        raise ValueError(text)
+    return Limit(rate, burst) if rate else None
+
+
+class TokenBucket:
+    """Tokens that refill at limit.rate per second up to limit.burst"""
+
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, limit):
+        self.rate = limit.rate
+        self.burst = limit.burst
+        self.tokens = limit.burst
+        self.stamp = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    # Takes cost tokens if there are that many, returning whether it did
+    def take(self, now, cost=1):
+        self._refill(now)
+        if self.tokens < cost:
+            return False
+        self.tokens -= cost
+        return True
+
+    # Takes cost tokens even if that leaves the bucket in debt, returning
+    # the seconds until it is out of debt
+    def charge(self, now, cost=1):
+        self._refill(now)
+        self.tokens -= cost
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    # Seconds until a token of cost is there to take
+    def wait(self, cost=1):
+        return max(cost - self.tokens, 0) / self.rate
+
+
+class Limiter:
+    """Buckets for one connection, or for one process's admission control
+
+    Classes without a limit are always allowed.
+    """
+
+    def __init__(self, limits):
+        self.buckets = {kind: TokenBucket(limit) for kind, limit in limits.items() if limit is not None}
+        self.refusing = set()  # Classes refused since their last success
+
+    # Takes a token for a request of class kind, returning whether it may
+    # go ahead
+    def allow(self, kind, now):
+        bucket = self.buckets.get(kind)
+        if bucket is None or bucket.take(now):
+            self.refusing.discard(kind)
+            return True
+
+        LIMITED.inc()
+        return False
+
+    # True for the first refusal of class kind since it was last allowed,
+    # the only one the client is told about
+    def first_refusal(self, kind):
+        if kind in self.refusing:
+            return False
+        self.refusing.add(kind)
+        return True
+
+    # Seconds until a request of class kind would be allowed
+    def retry_after(self, kind):
+        return self.buckets[kind].wait()
+
+    # Pre: kind is a request class, cost the number of requests just handled
+    # Post: returns the seconds to stop reading for before the next, 0 for
+    #       none
+    def charge(self, kind, now, cost=1):
+        bucket = self.buckets.get(kind)
+        if bucket is None:
+            return 0.0
+        return bucket.charge(now, cost)
+
+
+# The class a MESSAGES entry falls into, by its content
+def classify(content):
+    if not content.startswith('/'):
+        return MESSAGES
+    if content.split(None, 1)[0] in HEAVY_COMMANDS:
+        return HEAVY
+    return COMMANDS
+
+
+# The RATE_LIMITED reply for a request of class kind, the wait rounded up to
+# tenths of a second so it never reads as 0.0
+def refusal(kind, retry_after):
+    tenths = max(math.ceil(retry_after * 10 - 1e-9), 1)
+    return {"ERROR": "{}, try again in {:.1f} seconds".format(DESCRIPTIONS[kind], tenths / 10),
+            "RATE_LIMITED": {"limit": kind, "retry_after": round(retry_after, 3)}}
@@ -0,0 +1,491 @@
+#!/usr/bin/env python3
+"""replay
+Replays traffic captured with server.py --capture against a fresh server
+
+Starts server.py locally on a scratch data file, like bench.py, and sends
+every captured frame again over a connection of its own per captured
+connection, in the captured order: either at the original pacing (scaled
+by --speed) or, with --fast, as fast as the server answers. A connection
+waits for the reply to each login before sending anything else, as the
+codec it negotiated applies from then on. Whenever the next record is for
+another connection, the replay first waits until the server has handled
+everything sent so far (seen by its answer or, for frames that get none,
+by the answer to a PING sent after them), so the server sees frames from
+different connections in the captured order. Before a connection closes,
+and before the replay ends, every open connection is also sent a PING and
+its answer waited for, as it comes after anything the server sent it
+first, so no connection misses messages still on their way to it and every
+run gives the same output. Only a connection's own run of frames is
+pipelined. A server run with --workers (through --server-args) fans
+messages out between processes after answering, so its replays may still
+differ.
+
+For each kind of frame that gets an answer (logins, HISTORY requests,
+commands, and broadcasts and channel messages, which come back to their
+sender) the time to that answer is measured, and for DMs the time until
+the recipient has them if they are online. Everything each connection
+receives is reduced to what should not change between builds (messages
+without their IDs, errors, command replies, but not history cursors,
+presence or rate limit timings) and hashed, so two runs can be checked for
+the same output. Results are written as JSON, and with --baseline the run
+is compared with an earlier one: the exit status is 1 if any connection's
+output differs or, with --max-regression, if any p99 latency grew by more
+than that percentage.
+
+    python server.py "" --capture traffic.log
+    python replay.py traffic.log --fast --output before.json
+    (check out the new build)
+    python replay.py traffic.log --fast --baseline before.json --max-regression 20
+
+The replay server runs with the default rate limits, pass --server-args
+"--limit-messages 0 --limit-commands 0 --limit-heavy 0 --limit-frames 0"
+when a --fast replay of a busy capture would trip them.
+"""
+import argparse
+import asyncio
+import collections
+import hashlib
+import heapq
+import json
+import resource
+import sys
+import time
+
+import capture
+import codec
+from bench import Server, git_commit, make_client_context, summarize
+from framing import FrameCompressor, FrameDecoder, encode_frame
+
+KINDS = ("login", "history", "command", "broadcast", "channel", "direct")
+
+# Keys whose values depend on timing rather than on what the server does
+VOLATILE = frozenset(("HISTORY", "PING", "PONG", "ROSTER", "ROSTER_VERSION", "USER_LIST", "USERS_JOINED",
+                      "USERS_LEFT"))
+
+
+class ReplayClient(asyncio.Protocol):
+    """One captured connection, sending its frames again"""
+
+    def __init__(self, replay, connection):
+        self.replay = replay
+        self.connection = connection  # What the capture calls it
+        self.transport = None
+        self.decoder = FrameDecoder()
+        self.codec = codec.JSON
+        self.compressor = None
+        self.username = None
+        self.logged_in = None  # Future for the reply to the last login sent
+        self.unconfirmed = False  # Whether frames were sent that get no answer
+
+        # What each frame sent is waiting on, to send times oldest first
+        self.waiting = collections.defaultdict(collections.deque)
+
+        # Everything received that should be the same from build to build
+        self.output = collections.Counter()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        self.replay.lost(self)
+        if self.logged_in is not None and not self.logged_in.done():
+            self.logged_in.set_result(False)
+
+    def write(self, frame):
+        data = encode_frame(self.codec.encode(frame))
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        self.transport.write(data)
+
+    # Pre: frame is a captured frame
+    # Post: the frame is sent, noting what answer it expects
+    def send(self, frame):
+        now = time.perf_counter()
+        outstanding = self.replay.outstanding
+
+        for key, value in frame.items():
+            if key == "USERNAME":
+                self.username = value
+                self.logged_in = asyncio.get_event_loop().create_future()
+                self.expect(("login",), now)
+                if "COMPRESSION" in frame:
+                    self.decoder.enable_compression()
+
+            elif key == "HISTORY" and isinstance(value, dict):
+                self.expect(("history",), now)
+
+            elif key == "MESSAGES" and isinstance(value, list):
+                for message in value:
+                    if not isinstance(message, list) or len(message) < 4 or not isinstance(message[3], str):
+                        continue
+                    if message[3].startswith('/'):
+                        self.expect(("command",), now)
+                    elif message[1] == "ALL" or str(message[1]).startswith('#'):
+                        self.expect(("echo", message[1], message[3]), now)
+                    else:
+                        recipient = self.replay.online.get(message[1])
+                        if recipient is not None:
+                            recipient.expect(("dm", self.username, message[3]), now)
+
+        if self.replay.outstanding == outstanding:
+            self.unconfirmed = True
+        self.write(frame)
+
+    # Sends a PING, whose answer shows every frame sent before it was handled
+    def probe(self):
+        self.unconfirmed = False
+        self.expect(("pong",), time.perf_counter())
+        self.write({"PING": True})
+
+    def data_received(self, data):
+        for frame in self.decoder.feed(data):
+            self.handle_frame(self.codec.decode(frame))
+
+    def handle_frame(self, data):
+        now = time.perf_counter()
+
+        if "PING" in data:
+            self.write({"PONG": data["PING"]})
+        if "PONG" in data:
+            self.answered(("pong",), None, now)
+
+        if "USERNAME_ACCEPTED" in data:
+            self.answered(("login",), "login", now)
+            if "CODEC" in data:
+                self.codec = codec.CODECS[data["CODEC"]]
+            if "COMPRESSION" in data:
+                self.compressor = FrameCompressor()
+            if self.logged_in is not None and not self.logged_in.done():
+                self.logged_in.set_result(data["USERNAME_ACCEPTED"])
+            if data["USERNAME_ACCEPTED"]:
+                self.replay.online[self.username] = self
+
+        # Pages asked for, not the ones sent at login or on joining a channel
+        elif "HISTORY" in data and "CHANNELS" not in data:
+            self.answered(("history",), "history", now)
+
+        for message in data.get("MESSAGES", ()):
+            dm = ("dm", message[0], message[3])
+            if message[1] == self.username and self.waiting.get(dm):
+                self.answered(dm, "direct", now)
+            elif message[0] == self.username:
+                echo = ("echo", message[1], message[3])
+                if self.waiting.get(echo):
+                    self.answered(echo, "channel" if message[1].startswith('#') else "broadcast", now)
+                else:
+                    self.answered(("command",), "command", now)
+
+        self.output.update(normalize(data))
+
+    def expect(self, waiting_on, now):
+        self.waiting[waiting_on].append(now)
+        self.replay.outstanding += 1
+
+    def answered(self, waiting_on, kind, now):
+        sent = self.waiting.get(waiting_on)
+        if sent:
+            sent_at = sent.popleft()
+            if kind is not None:
+                self.replay.latencies[kind].append(now - sent_at)
+            self.replay.answered()
+
+    # Answers still outstanding, by kind
+    def unanswered(self):
+        counts = collections.Counter()
+        for waiting_on, sent in self.waiting.items():
+            kind = waiting_on[0]
+            if kind == "echo":
+                kind = "channel" if waiting_on[1].startswith('#') else "broadcast"
+            elif kind == "dm":
+                kind = "direct"
+            counts[kind] += len(sent)
+        return counts
+
+    # Hash of everything received, the same for the same output in any order
+    def digest(self):
+        text = '\n'.join('{} {}'.format(count, item) for item, count in sorted(self.output.items()))
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+# Pre: data is a frame received from the server
+# Post: returns the parts of it that should be the same on every build and
+#       every run, as strings
+def normalize(data):
+    items = []
+    for key, value in data.items():
+        if key in VOLATILE:
+            continue
+        if key == "MESSAGES":
+            items.extend(json.dumps(["MESSAGES"] + message[:4]) for message in value)
+        elif key == "RATE_LIMITED":
+            items.append(json.dumps([key, value.get("limit")]))
+        elif key == "ERROR" and "RATE_LIMITED" in data:
+            continue
+        else:
+            items.append(json.dumps([key, value], sort_keys=True))
+    return items
+
+
+# Pre: paths are captures, one per server process
+# Post: yields (epoch seconds, connection, value) over all of them in time
+#       order, connections keyed "<capture>:<connection>"
+def merge(paths):
+    def keyed(index, path):
+        for when, connection, value in capture.read(path):
+            yield when, '{}:{}'.format(index, connection), value
+
+    return heapq.merge(*(keyed(index, path) for index, path in enumerate(paths)), key=lambda record: record[0])
+
+
+class Replay:
+    """The connections of one replay and what they measured"""
+
+    def __init__(self, args):
+        self.args = args
+        self.clients = {}  # Captured connection to its ReplayClient
+        self.finished = []  # Clients whose captured connection closed
+        self.online = {}  # Username to the client logged in as it
+        self.latencies = {kind: [] for kind in KINDS}
+        self.frames = 0
+
+        # Answers every connection is still waiting on, and an event set
+        # whenever that falls to none
+        self.outstanding = 0
+        self.settled = asyncio.Event()
+
+    def answered(self, count=1):
+        self.outstanding -= count
+        if self.outstanding == 0:
+            self.settled.set()
+
+    # Stops waiting on what a closed connection was still owed, which is
+    # left to be reported as unanswered
+    def lost(self, client):
+        owed = sum(len(sent) for sent in client.waiting.values())
+        if owed:
+            self.answered(owed)
+
+    # Waits for every answer outstanding, or for at most --settle seconds
+    async def _answers(self):
+        if self.outstanding:
+            self.settled.clear()
+            try:
+                await asyncio.wait_for(self.settled.wait(), self.args.settle)
+            except asyncio.TimeoutError:
+                pass
+
+    # Pre: delivered is whether every open connection must also have
+    #       received everything the server sent it so far
+    # Post: every frame sent so far has been handled, or each wait gave up
+    #       after --settle seconds
+    # Purpose: frames from different connections reach the server in the
+    #       captured order, and connections close having received what they
+    #       did when the capture was made, so what each sees doesn't depend
+    #       on how fast the replay runs
+    async def settle(self, delivered=False):
+        open_clients = [client for client in self.clients.values() if not client.transport.is_closing()]
+        for client in open_clients:
+            if client.unconfirmed:
+                client.probe()
+        await self._answers()
+
+        # Messages are queued for every recipient before their sender is
+        # answered, a PONG queued after them shows they have arrived
+        if delivered:
+            for client in open_clients:
+                if not client.transport.is_closing():
+                    client.probe()
+            await self._answers()
+
+    # Pre: a server is listening on port
+    # Post: every captured record has been replayed
+    async def drive(self, port, records):
+        loop = asyncio.get_event_loop()
+        context = make_client_context(self.args.cafile)
+        started = time.perf_counter()
+        first = None
+        last = None
+
+        for when, connection, value in records:
+            if first is None:
+                first = when
+            if not self.args.fast:
+                delay = started + (when - first) / self.args.speed - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            if connection != last:
+                await self.settle()
+                last = connection
+
+            if value == capture.OPEN:
+                client = ReplayClient(self, connection)
+                await loop.create_connection(lambda: client, '127.0.0.1', port, ssl=context,
+                                             server_hostname='localhost')
+                self.clients[connection] = client
+                continue
+
+            client = self.clients.get(connection)
+            if client is None:
+                continue
+
+            if value == capture.CLOSE:
+                await self.settle(delivered=True)
+                client.transport.close()
+                if self.online.get(client.username) is client:
+                    del self.online[client.username]
+                self.finished.append(self.clients.pop(connection))
+
+            # Answers to the server's pings are sent as they come
+            elif isinstance(value, dict) and set(value) != {"PONG"}:
+                self.frames += 1
+                client.send(value)
+                if "USERNAME" in value:
+                    try:
+                        await asyncio.wait_for(asyncio.shield(client.logged_in), self.args.login_timeout)
+                    except asyncio.TimeoutError:
+                        pass
+
+        # Give the last answers a moment to arrive before the numbers are read
+        await self.settle(delivered=True)
+        await asyncio.sleep(self.args.drain)
+        return time.perf_counter() - started
+
+    def close(self):
+        for client in self.clients.values():
+            client.transport.close()
+        self.finished.extend(self.clients.values())
+        self.clients = {}
+
+
+async def run(args):
+    results = {
+        "started": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "config": vars(args).copy(),
+        "commit": git_commit(),
+        "python": sys.version.split()[0],
+    }
+
+    server = Server(args, args.history)
+    replay = Replay(args)
+    try:
+        await server.ready()
+        print("Replaying {}{}".format(', '.join(args.captures), ' as fast as possible' if args.fast else ''))
+        elapsed = await replay.drive(server.port, merge(args.captures))
+    finally:
+        replay.close()
+        server.stop()
+
+    unanswered = collections.Counter()
+    outputs = {}
+    for client in sorted(replay.finished, key=lambda client: client.connection):
+        unanswered.update(client.unanswered())
+        outputs[client.connection] = {"username": client.username, "received": sum(client.output.values()),
+                                      "digest": client.digest()}
+
+    results.update({
+        "elapsed_s": round(elapsed, 3),
+        "frames": replay.frames,
+        "connections": len(outputs),
+        "latency_ms": {kind: summarize(replay.latencies[kind]) for kind in KINDS},
+        "unanswered": {kind: unanswered[kind] for kind in KINDS},
+        "outputs": outputs,
+    })
+    return results
+
+
+def report(results):
+    print("Replayed {frames} frames over {connections} connections in {elapsed_s} s".format(**results))
+    for kind, latency in results["latency_ms"].items():
+        if latency["count"]:
+            print("{:<10} p50 {p50} ms, p99 {p99} ms, p999 {p999} ms ({count} samples, {} unanswered)".format(
+                kind, results["unanswered"][kind], **latency))
+
+
+# Pre: results and baseline are results from this script for the same
+#       capture
+# Post: prints how the latencies changed and which connections received
+#       something different, returning False if the run fails the gate
+def compare(results, baseline, max_regression=None):
+    passed = True
+
+    print("Compared with baseline {}".format(baseline.get("commit")))
+    for kind in KINDS:
+        for percentile in ("p50", "p99"):
+            before = baseline["latency_ms"][kind].get(percentile)
+            after = results["latency_ms"][kind].get(percentile)
+            if not before or after is None:
+                continue
+
+            change = (after - before) / before * 100
+            failed = percentile == "p99" and max_regression is not None and change > max_regression
+            passed = passed and not failed
+            print("  {:<22} {:>12} -> {:>12} ({:+.1f}%){}".format(
+                "{} {} ms".format(kind, percentile), before, after, change, "  REGRESSED" if failed else ""))
+
+    before, after = baseline["outputs"], results["outputs"]
+    differing = sorted(connection for connection in set(before) | set(after)
+                       if before.get(connection, {}).get("digest") != after.get(connection, {}).get("digest"))
+    if differing:
+        passed = False
+        print("Output differs on {} of {} connections:".format(len(differing), len(set(before) | set(after))))
+        for connection in differing[:10]:
+            print("  {} ({}): {} -> {} items received".format(
+                connection, (after.get(connection) or before.get(connection))["username"],
+                before.get(connection, {}).get("received"), after.get(connection, {}).get("received")))
+    else:
+        print("Output identical on all {} connections".format(len(after)))
+
+    return passed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay traffic captured with server.py --capture')
+    parser.add_argument('captures', metavar='capture', nargs='+',
+                        help='Capture to replay, one per server process for captures made with --workers')
+    parser.add_argument('--fast', action='store_true',
+                        help='Send every frame as soon as the one before it is sent, rather than at the captured pace')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='Without --fast, replay this many times faster than captured (default 1)')
+    parser.add_argument('--login-timeout', metavar='seconds', type=float, default=10.0,
+                        help='Longest to wait for the answer to a login (default 10)')
+    parser.add_argument('--settle', metavar='seconds', type=float, default=1.0,
+                        help='Longest the replay waits for the server to handle what was sent before it moves to '
+                             'another connection or closes one (default 1)')
+    parser.add_argument('--drain', metavar='seconds', type=float, default=1.0,
+                        help='How long to wait for answers after the last frame (default 1)')
+    parser.add_argument('--history', metavar='messages', type=int, default=0,
+                        help='Messages of history the server starts with (default 0)')
+    parser.add_argument('--server-args', metavar='args', default='',
+                        help='Extra arguments for server.py, e.g. "--workers 4"')
+    parser.add_argument('--port', type=int, default=None,
+                        help='Port for the server (default: any free port)')
+    parser.add_argument('--cafile', default=None,
+                        help='Verify the server against this CA file (default: no verification)')
+    parser.add_argument('--output', metavar='path', default=None,
+                        help='Write the results to this JSON file')
+    parser.add_argument('--baseline', metavar='path', default=None,
+                        help='Results of an earlier replay of the same capture to compare against')
+    parser.add_argument('--max-regression', metavar='percent', type=float, default=None,
+                        help='With --baseline, fail if any p99 latency grew by more than this')
+    parser.add_argument('-v', dest='verbose', action='store_true',
+                        help='Show the server\'s errors')
+    args = parser.parse_args()
+
+    # A busy capture has as many connections open at once
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    loop = asyncio.get_event_loop()
+    results = loop.run_until_complete(run(args))
+    loop.close()
+
+    report(results)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            if not compare(results, json.load(f), args.max_regression):
+                sys.exit(1)
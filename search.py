@@ -0,0 +1,252 @@
+"""search
+Full-text search over the public message history
+
+An inverted index maps every term (a lowercased word) to the IDs of the
+public messages containing it, oldest first, with an ID repeated once per
+occurrence. Messages are indexed as they are appended, so a search only
+reads the postings of its terms. Results hold every term and are ranked
+with BM25, newest first among equal scores.
+
+The index is saved next to the snapshot (server_data.search) along with how
+many messages it covers. At startup it is loaded and only the messages
+after those are indexed, instead of the whole history being tokenized
+again. While the server runs, each save appends only what was indexed since
+the last one: the postings added for the terms seen since then, found
+without looking at the rest of the index. The whole index is written out
+again when the server stops.
+"""
+import bisect
+import heapq
+import math
+import os
+import pickle
+import re
+from array import array
+
+TERM = re.compile(r"\w{2,64}")
+MAX_TERMS = 8  # Terms of a query that are searched for
+DEFAULT_PAGE_SIZE = 10  # Results per page
+DEFAULT_SAVE_EVERY = 10000  # Messages indexed between saves of the index
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+
+# Lowercased words of text, in order, repeats included
+def terms(text):
+    return TERM.findall(text.lower())
+
+
+class SearchIndex:
+    """Inverted index over the public messages, by message ID"""
+
+    def __init__(self):
+        self.postings = {}  # Term to an array of the IDs of messages holding it
+        self.documents = {}  # Term to the number of messages holding it
+        self.lengths = array('H')  # Terms in each message, by message ID
+        self.total_length = 0
+
+        # Term to the newest message ID holding it, most recent last, so the
+        # terms changed since a save are a suffix
+        self._touched = {}
+
+    # The touched terms are only needed for saves while the server runs
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_touched']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._touched = {}
+
+        # Indexes saved before document counts were kept
+        if 'documents' not in state:
+            self.documents = {word: _distinct(postings) for word, postings in self.postings.items()}
+
+    # Messages indexed, the next message ID expected
+    @property
+    def count(self):
+        return len(self.lengths)
+
+    # Pre: message_id is count, message is a public (SRC, DEST, TIMESTAMP,
+    #       CONTENT) list
+    # Post: the message's terms are indexed
+    def add(self, message_id, message):
+        try:
+            content = message[3]
+        except (IndexError, KeyError, TypeError):
+            content = None
+        words = terms(content) if isinstance(content, str) else ()
+
+        touched = self._touched
+        for word in words:
+            postings = self.postings.get(word)
+            if postings is None:
+                postings = self.postings[word] = array('I')
+            if not postings or postings[-1] != message_id:
+                self.documents[word] = self.documents.get(word, 0) + 1
+                touched.pop(word, None)
+                touched[word] = message_id
+            postings.append(message_id)
+
+        self.lengths.append(min(len(words), 0xFFFF))
+        self.total_length += len(words)
+
+    # Indexes the messages appended since the index was last updated, at
+    # most limit of them if given
+    def update(self, messages, limit=None):
+        end = len(messages) if limit is None else min(len(messages), self.count + limit)
+        for message_id in range(self.count, end):
+            self.add(message_id, messages[message_id])
+
+    # Pre: query is the text searched for, hidden the set of senders whose
+    #       messages the searcher may not see and messages the history
+    # Post: returns (IDs, total), the IDs of the page'th page (from 1) of
+    #       matching messages, best first, and how many matched in all
+    def search(self, query, hidden, messages, page=1, page_size=DEFAULT_PAGE_SIZE):
+        words = list(dict.fromkeys(terms(query)))[:MAX_TERMS]
+        if not words or any(word not in self.postings for word in words):
+            return [], 0
+
+        # Start from the rarest term, each later one narrows the candidates
+        words.sort(key=lambda word: len(self.postings[word]))
+        scores = None
+        for word in words:
+            frequencies, matching = self._frequencies(word, scores)
+            if not frequencies:
+                return [], 0
+            scores = {message_id: scores[message_id] if scores is not None else 0.0 for message_id in frequencies}
+            self._score(frequencies, matching, scores)
+
+        if hidden:
+            scores = {message_id: score for message_id, score in scores.items()
+                      if messages[message_id][0] not in hidden}
+
+        best = heapq.nlargest(page * page_size, scores, key=lambda message_id: (scores[message_id], message_id))
+        return best[(page - 1) * page_size:], len(scores)
+
+    # Returns ({message ID: occurrences of word}, messages holding word),
+    # counting only the candidates if there are any. Postings are sorted, so
+    # each candidate is looked up rather than every posting read.
+    def _frequencies(self, word, candidates):
+        postings = self.postings[word]
+        frequencies = {}
+
+        if candidates is None:
+            for message_id in postings:
+                frequencies[message_id] = frequencies.get(message_id, 0) + 1
+        else:
+            for message_id in candidates:
+                start = bisect.bisect_left(postings, message_id)
+                if start < len(postings) and postings[start] == message_id:
+                    frequencies[message_id] = bisect.bisect_right(postings, message_id, start) - start
+
+        return frequencies, self.documents[word]
+
+    # Adds a term's BM25 weight in each message it occurs in to its score
+    def _score(self, frequencies, matching, scores):
+        documents = self.count
+        average = self.total_length / documents if documents else 1.0
+        idf = math.log(1 + (documents - matching + 0.5) / (matching + 0.5))
+
+        for message_id, frequency in frequencies.items():
+            norm = K1 * (1 - B + B * self.lengths[message_id] / average)
+            scores[message_id] += idf * frequency * (K1 + 1) / (frequency + norm)
+
+    # Pre: since is the count of an index saved earlier, the terms added
+    #       since then untouched by anything but add()
+    # Post: returns what was indexed after the first since messages, which
+    #       a worker thread can save while the loop keeps indexing
+    # Purpose: costs what changed since the save rather than the size of
+    #       the index
+    def delta(self, since):
+        postings = {}
+        for word in reversed(self._touched):
+            if self._touched[word] < since:
+                break
+            word_postings = self.postings[word]
+            postings[word] = word_postings[bisect.bisect_left(word_postings, since):]
+
+        return {"since": since, "lengths": self.lengths[since:], "total_length": self.total_length,
+                "postings": postings}
+
+    # Pre: delta was returned by delta() on an index covering what this one
+    #       does
+    # Post: this index covers what that one did when delta was taken
+    def merge(self, delta):
+        for word, postings in delta["postings"].items():
+            existing = self.postings.get(word)
+            if existing is None:
+                existing = self.postings[word] = array('I')
+            self.documents[word] = self.documents.get(word, 0) + _distinct(postings)
+            existing.extend(postings)
+
+        self.lengths.extend(delta["lengths"])
+        self.total_length = delta["total_length"]
+
+
+# Messages holding a term, given its sorted postings
+def _distinct(postings):
+    count = 0
+    previous = None
+    for message_id in postings:
+        if message_id != previous:
+            count += 1
+            previous = message_id
+    return count
+
+
+# Pre: path names an index written by save() and extended by append(),
+#       which may not exist
+# Post: returns (index, size), the index with every intact delta merged
+#       and the bytes of the file they take up, or (None, 0) if there is no
+#       index or it can't be read
+# Purpose: a delta torn by a crash, or one not following the index, is
+#       ignored along with anything after it
+def load(path):
+    try:
+        with open(path, 'rb') as f:
+            index = pickle.load(f)
+            size = f.tell()
+
+            while True:
+                try:
+                    delta = pickle.load(f)
+                except (EOFError, pickle.UnpicklingError, ValueError, TypeError, AttributeError):
+                    break
+                if not isinstance(delta, dict) or delta.get("since") != index.count:
+                    break
+                index.merge(delta)
+                size = f.tell()
+
+            return index, size
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None, 0
+
+
+# Pre: the first size bytes of path hold an index covering exactly
+#       delta["since"] messages
+# Post: delta is appended and synced, returning the new size of the file
+# Purpose: anything past size, left by a save that failed, is cut off first
+def append(delta, path, size):
+    with open(path, 'r+b') as f:
+        f.truncate(size)
+        f.seek(size)
+        pickle.dump(delta, f, pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+        return f.tell()
+
+
+# Atomically replaces the index at path
+def save(index, path):
+    tmp_path = path + '.tmp'
+
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(index, f, pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(tmp_path, path)
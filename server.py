@@ -4,155 +4,278 @@
 # Asynchronous I/O inside an "asyncio" coroutine.
 
 # Last modified by Alice Easter && Eric Cacciavillani on 4/26/18
-import json
-
 import argparse
 import asyncio
-import ssl
-import struct
-import pickle
-from collections import defaultdict
+import logging
+import os
+import signal
+import socket
+import tempfile
+import time
+
+import batching
+import bus
+import capture
+import channels
+import codec
+import diagnostics
+import heartbeat
+import history
+import inbox
+import metrics
+import outbox
+import ratelimit
+import search
+import tls
+import storage
+from framing import (DEFAULT_COMPRESS_THRESHOLD, DEFAULT_MAX_FRAME_SIZE, DEFLATE, Frame, FrameCompressor,
+                     FrameDecoder, FrameTooLarge)
+from metrics import log
+from state import DEFAULT_HISTORY_PAGE, ServerState
+
+FRAMES_IN = metrics.Counter('chatterbox_frames_in_total', 'Frames received from clients')
+BYTES_IN = metrics.Counter('chatterbox_bytes_in_total', 'Bytes received from clients, after TLS')
+DECODE_SECONDS = metrics.Histogram('chatterbox_decode_seconds', 'Time spent decoding each client frame')
+
+# Replies that never change are framed once up front
+NO_SUCH_USER = Frame.encode({"ERROR": "Specified username does not exist"})
+BAD_MESSAGE = Frame.encode({"ERROR": "Messages need exactly a string source, string destination, "
+                                     "integer timestamp and string content, all valid UTF-8"})
+BAD_USERNAME = Frame.encode({"USERNAME_ACCEPTED": False,
+                             "ERROR": "Usernames must be non-empty valid UTF-8 strings, not ALL and "
+                                      "not starting with #"})
+BAD_INBOX_ACK = Frame.encode({"ERROR": "INBOX_ACK needs the integer inbox ID of a DM received"})
+BAD_HISTORY_REQUEST = Frame.encode({"ERROR": "HISTORY requests need integer before, after and limit values "
+                                              "and a string channel"})
+HISTORY_BEFORE_LOGIN = Frame.encode({"ERROR": "Log in before requesting history"})
+NOT_IN_CHANNEL = Frame.encode({"ERROR": "Join the channel with /Join before sending to or reading it"})
+PING = Frame.encode({"PING": True})
+PONG = Frame.encode({"PONG": True})
+
+MESSAGE_TYPES = (str, str, int, str)  # SRC, DEST, TIMESTAMP, CONTENT
+
+
+# True if text can be sent as UTF-8, which a lone surrogate can't
+def encodable(text):
+    try:
+        text.encode('utf-8')
+    except UnicodeEncodeError:
+        return False
+    return True
 
 
+# True if name can log in, ALL and channel names are taken by destinations
+def valid_username(name):
+    return (type(name) is str and name != "" and name != "ALL" and not channels.is_channel(name)
+            and encodable(name))
+
+
+# True for a [SRC, DEST, TIMESTAMP, CONTENT] list with nothing more
+def valid_message(message):
+    return (type(message) is list and len(message) == len(MESSAGE_TYPES)
+            and all(type(field) is kind for field, kind in zip(message, MESSAGE_TYPES))
+            and all(encodable(field) for field in message if type(field) is str))
 
-class AsyncServer(asyncio.Protocol):
-    transport_map = {}  # Map of usernames to transports
-    messages = []  # All messages for dump to user upon login
-    all_users_ever_logged = set()  # Init a set of all users ever logged into the server
-    client_blocked_users = defaultdict(dict)  # Shows the relationship between given users and their blocked user names
 
-    def __init__(self):
+class AsyncServer(asyncio.Protocol):
+    max_frame_size = DEFAULT_MAX_FRAME_SIZE  # Largest frame a client may send us
+    slow_consumer_policy = outbox.DROP_OLDEST  # What to do when a client's queue fills up
+    outbox_frames = outbox.DEFAULT_MAX_FRAMES  # Frames queued for a client before the policy applies
+    outbox_bytes = outbox.DEFAULT_MAX_BYTES  # Bytes queued for a client before the policy applies
+    compress_threshold = DEFAULT_COMPRESS_THRESHOLD  # Smallest frame compressed, None disables compression
+    ping_after = heartbeat.DEFAULT_PING_AFTER  # Seconds of silence before a client is pinged
+    idle_timeout = heartbeat.DEFAULT_IDLE_TIMEOUT  # Seconds of silence before the connection is aborted
+    wheel = None  # This process's heartbeat.TimerWheel, None turns heartbeats off
+    limits = ratelimit.DEFAULT_LIMITS  # Per connection ratelimit.Limit by request class
+    admission = None  # This process's ratelimit.Limiter for connections and logins, None admits everyone
+    capture = None  # This process's capture.Capture of client frames, None when not capturing
+
+    def __init__(self, state):
         super().__init__()
+        self.state = state  # Shared by every connection, see state.ServerState
         self.username = ""
 
         # Establish the user associated with this object
         self.thread_transport = None
-
-        '''
-        Since we need to send message to individual user, we have a modifiable
-        current transport that we can use to determine the recipient of any
-        given message
-        '''
-        self.current_transport = None
-        self.__buffer = ""
-        self.data_len = 0
-
-        #Pull data from db upon client init
-        with open('server_data.pkl', 'rb') as f:
-            AsyncServer.messages = pickle.load(f)
-            AsyncServer.all_users_ever_logged = pickle.load(f)
-            AsyncServer.client_blocked_users = pickle.load(f)
-
-        if AsyncServer.client_blocked_users is None:
-            AsyncServer.client_blocked_users = defaultdict(dict)
-
-        if AsyncServer.messages is None:
-            AsyncServer.messages = list()
-
-        if AsyncServer.all_users_ever_logged is None:
-            AsyncServer.all_users_ever_logged = set()
+        self.outbox = None
+        self.decoder = FrameDecoder(AsyncServer.max_frame_size)
+        self.codec = codec.JSON  # Until the client negotiates another at login
+        self.last_active = time.monotonic()  # When the client last sent anything
+        self.limiter = ratelimit.Limiter(AsyncServer.limits)
+        self.throttled = False  # Whether reading is paused for the frame limit
+        self.capture_id = None  # What the connection is recorded as in the capture
 
     def connection_made(self, transport):
         self.thread_transport = transport
-        self.current_transport = transport
-
-    # Pre: current transport should be set to the proper audience and data is
-    #       already in json format and encoded to ascii
-    # Post: sends data to the current transport
-    # Purpose: packs the size of the data, prepends said size to the data, then
-    #       sends the message through the current transport
-    def send_message(self, data):
-        msg = b''
-        msg += struct.pack("!I", len(data))
-        msg += data
-        self.current_transport.write(msg)
-
-    # Sends data to intended audience with the qualifier that said audience
-    # isn't blocked and haven't blocked this user
-    def broadcast(self, audience, data):
-
-        # Sending messages to themselves
-        if audience is self.username:
-            self.current_transport = self.thread_transport
-            self.send_message(data)
-
-        # Send messages to all users logged into the system
-        elif audience == 'ALL':
-            for user in AsyncServer.transport_map:
-
-                # Ensures user messages to be properly blocked
-                if AsyncServer.client_blocked_users is not None and self.username in AsyncServer.client_blocked_users:
-
-                    if AsyncServer.client_blocked_users[self.username] is not None and user not in AsyncServer.client_blocked_users[self.username]:
-                        self.current_transport = AsyncServer.transport_map[user]
-                        self.send_message(data)
-
-                # ----
-                elif AsyncServer.client_blocked_users is not None and user in AsyncServer.client_blocked_users:
-
-                    if AsyncServer.client_blocked_users[user] is not None and self.username not in AsyncServer.client_blocked_users[user]:
-                        self.current_transport = AsyncServer.transport_map[user]
-                        self.send_message(data)
-
-                else:
-                    self.current_transport = AsyncServer.transport_map[user]
-                    self.send_message(data)
-
-        # If we are sending a dm
-        elif audience in AsyncServer.transport_map:
-
-            # Ensures user messages to be properly blocked
-            if AsyncServer.client_blocked_users is not None and audience in AsyncServer.client_blocked_users:
+        tls.count_handshake(transport)
+        self.outbox = outbox.Outbox(transport, AsyncServer.slow_consumer_policy,
+                                    AsyncServer.outbox_frames, AsyncServer.outbox_bytes)
+
+        # During a burst of connections the extra ones are turned away
+        # before they cost anything more
+        if not self.admit(ratelimit.CONNECTIONS):
+            ratelimit.TURNED_AWAY.inc()
+            transport.close()
+            return
+
+        if AsyncServer.wheel is not None:
+            AsyncServer.wheel.schedule(self, AsyncServer.ping_after)
+        if AsyncServer.capture is not None:
+            self.capture_id = AsyncServer.capture.opened()
+
+    # Pre: this connection's deadline on the timer wheel has come up
+    # Post: the connection is aborted if the client has been silent for
+    #       idle_timeout, pinged if silent for ping_after, and put back on
+    #       the wheel for its next deadline otherwise
+    # Purpose: evicts half-open connections, which would otherwise keep
+    #       their username and be sent every broadcast forever
+    def heartbeat(self):
+        idle = time.monotonic() - self.last_active
+
+        if idle >= AsyncServer.idle_timeout:
+            log.info("Closing the connection of %s, silent for %.0f seconds", self.username or "a client", idle)
+            heartbeat.REAPED.inc()
+            self.thread_transport.abort()
+        elif idle >= AsyncServer.ping_after:
+            heartbeat.PINGS.inc()
+            self.send_frame(PING)
+            AsyncServer.wheel.schedule(self, AsyncServer.idle_timeout - idle)
+        else:
+            AsyncServer.wheel.schedule(self, AsyncServer.ping_after - idle)
+
+    # The transport's buffer is over its high-water mark, queue from now on
+    def pause_writing(self):
+        self.outbox.pause()
+
+    def resume_writing(self):
+        self.outbox.resume()
+
+    # Pre: frame is a framing.Frame, destination defaults to this client's
+    #       outbox
+    # Post: writes or queues the frame
+    # Purpose: sends an already serialized and length prefixed message, the
+    #       same frame may be sent to any number of outboxes
+    def send_frame(self, frame, destination=None):
+        if destination is None:
+            destination = self.outbox
+        destination.send(frame)
+
+    # Pre: message is a (SRC, DEST, TIMESTAMP, CONTENT) list
+    # Post: the message is queued for the intended audience with the
+    #       qualifier that said audience isn't blocked and haven't blocked
+    #       this user
+    # Purpose: hands chat messages and command replies to the batcher, which
+    #       sends each recipient everything queued for them in one frame.
+    #       DMs are kept in the recipient's inbox until they acknowledge
+    #       them, so users who are offline get them when they next log in.
+    def deliver(self, audience, message):
+        if audience == 'ALL':
+            self.state.publish_message(self.username, message)
+
+        elif channels.is_channel(audience):
+            if self.state.channels.is_member(audience, self.username):
+                self.state.publish_channel_message(self.username, audience, message)
+            else:
+                self.send_frame(NOT_IN_CHANNEL)
 
-                if AsyncServer.client_blocked_users[audience] is not None and self.username not in AsyncServer.client_blocked_users[audience]:
-                    self.current_transport = AsyncServer.transport_map[audience]
-                    self.send_message(data)
-            # -----
-            elif AsyncServer.client_blocked_users is not None and self.username in AsyncServer.client_blocked_users:
+        elif audience == self.username:
+            self.state.batcher.add_direct(audience, message)
 
-                if AsyncServer.client_blocked_users[self.username] is not None and audience not in AsyncServer.client_blocked_users[self.username]:
-                    self.current_transport = AsyncServer.transport_map[audience]
-                    self.send_message(data)
+        elif audience not in self.state.all_users_ever_logged:
+            self.send_frame(NO_SUCH_USER)
 
-            else:
-                self.current_transport = AsyncServer.transport_map[audience]
-                self.send_message(data)
-
-        # Would be called if the message is to an audience that doesn't exist
-        else:
-            self.current_transport = self.thread_transport
-            msg = {"ERROR": "Specified username does not exist (or at least is not online)"}
-            msg = json.dumps(msg).encode('ascii')
-            self.send_message(msg)
+        elif not self.state.blocks.is_blocked(self.username, audience):
+            self.state.send_direct(audience, message)
 
-    # Handles all data recived from
+    # Handles all data recived from the client, which may hold any number of
+    # whole or partial frames
     def data_received(self, data):
-        if self.__buffer == '':
-            # Find first brace and offset the data by that
-            brace_index = data.find(b'{')
-            self.data_len = struct.unpack("!I", data[0:brace_index])[0]
-            data = data[brace_index:(self.data_len + brace_index)]
-        data = data.decode('ascii')
-        self.__buffer += data
-
-        if len(self.__buffer) == self.data_len:
-            data = json.loads(self.__buffer)
-            self.__buffer = ""
-            self.data_len = 0
-
-            # We have two types of accepted keys, usernames and messages
-            # If we receive anything else we want to recognize it so we
-            # Output it to the server console, otherwise we direct the data
-            # To the proper management function
-            for key in data:
-                if key == "USERNAME":
-                    self.make_user(data)
-
-                elif key == "MESSAGES":
-                    self.handle_messages(data)
+        BYTES_IN.value += len(data)
+        self.last_active = time.monotonic()
+        try:
+            frames = self.decoder.feed(data)
+        except FrameTooLarge as e:
+            self.send_frame(Frame.encode({"ERROR": str(e)}))
+            self.thread_transport.close()
+            return
+
+        FRAMES_IN.value += len(frames)
+        for frame in frames:
+            started = time.perf_counter()
+            decoded = self.codec.decode(frame)
+            DECODE_SECONDS.observe(time.perf_counter() - started)
+            if self.capture_id is not None:
+                AsyncServer.capture.received(self.capture_id, decoded)
+            self.handle_frame(decoded)
+
+        # A client over its frame limit isn't read from until it is back
+        # under, the frames it sends meanwhile wait in its socket
+        if frames and not self.throttled:
+            delay = self.limiter.charge(ratelimit.FRAMES, self.last_active, len(frames))
+            if delay:
+                ratelimit.THROTTLED.inc()
+                self.throttled = True
+                self.thread_transport.pause_reading()
+                asyncio.get_event_loop().call_later(delay, self.unthrottle)
+
+    def unthrottle(self):
+        self.throttled = False
+        if not self.thread_transport.is_closing():
+            self.thread_transport.resume_reading()
+
+    # Pre: kind is a ratelimit request class
+    # Post: returns whether this connection's request may go ahead, telling
+    #       the client if it may not unless it has been told already
+    # Purpose: applies the per connection limits, and the process's
+    #       admission control for connections and logins
+    def admit(self, kind):
+        if kind in (ratelimit.CONNECTIONS, ratelimit.LOGINS):
+            limiter = AsyncServer.admission
+            if limiter is None:
+                return True
+        else:
+            limiter = self.limiter
+
+        if limiter.allow(kind, time.monotonic()):
+            return True
+        if limiter is AsyncServer.admission or self.limiter.first_refusal(kind):
+            self.send_frame(Frame.encode(ratelimit.refusal(kind, limiter.retry_after(kind))))
+        return False
+
+    # We have two types of accepted keys, usernames and messages
+    # If we receive anything else we want to recognize it so we
+    # Output it to the server console, otherwise we direct the data
+    # To the proper management function
+    def handle_frame(self, data):
+        for key in data:
+            if key == "USERNAME":
+                self.make_user(data)
+
+            elif key == "MESSAGES":
+                self.handle_messages(data)
+
+            elif key == "HISTORY":
+                if self.admit(ratelimit.COMMANDS):
+                    self.send_history(data[key])
+
+            # Anything received shows the client is alive, PONG included
+            elif key == "PONG":
+                pass
+
+            elif key == "PING":
+                self.send_frame(PONG)
+
+            elif key == "INBOX_ACK":
+                # At login it is read by make_user
+                if "USERNAME" not in data:
+                    self.ack_inbox(data[key])
+
+            elif key in ("CODECS", "COMPRESSION", "ROSTER_VERSION", "ROSTER_EPOCH", "RESUME"):
+                # Login options, read by make_user
+                pass
 
-                else:
-                    print("New message type!!! " + key + ": " + data[key])
+            else:
+                log.warning("New message type %s: %r", key, data[key])
 
     # Pre: Takes in a username
     # Post: Returns username accepted status, and optionally updates user with
@@ -166,65 +289,166 @@ class AsyncServer(asyncio.Protocol):
         key = "USERNAME"
         user_accept = {"USERNAME_ACCEPTED": False}
 
-        if data[key] not in AsyncServer.transport_map:
+        # Too many logins at once, the client should try again shortly
+        if not self.admit(ratelimit.LOGINS):
+            self.send_frame(Frame.encode(user_accept))
+            return
+
+        if not valid_username(data[key]):
+            self.send_frame(BAD_USERNAME)
+            return
+
+        if not self.state.is_online(data[key]):
             user_accept["USERNAME_ACCEPTED"] = True
             user_accept["INFO"] = "Welcome to the server!"
             self.username = data[key]
-            AsyncServer.transport_map[data[key]] = self.thread_transport
-
-            users_online = []
-            for user in AsyncServer.transport_map:
-                users_online.append(user)
-
-            user_accept["USER_LIST"] = self.get_users()
-
-            message_dump = AsyncServer.messages
-
-            if AsyncServer.client_blocked_users is not None and self.username in AsyncServer.client_blocked_users:
-                message_dump = list(
-                    filter(lambda message: message[0] not in AsyncServer.client_blocked_users[self.username],
-                           message_dump))
-
-            user_accept["MESSAGES"] = message_dump
+            self.state.join(data[key], self.outbox)
+
+            # Clients keeping a roster get it in ROSTER frames after the
+            # reply, usually just what changed since they last saw it
+            roster_version = data.get("ROSTER_VERSION")
+            self.outbox.roster = "ROSTER_VERSION" in data
+            if not self.outbox.roster:
+                user_accept["USER_LIST"] = self.get_users()
+
+            # Only the newest page of history, older pages are requested with
+            # HISTORY and the cursor sent alongside. Channels the user is in
+            # follow with a page each once the reply is out. A reconnecting
+            # client sends the last message IDs it saw in RESUME and gets
+            # every message after them instead, while they are still held.
+            resume = data.get("RESUME")
+            resuming = isinstance(resume, dict)
+            if not resuming:
+                resume = {}
+            replies = self.state.login_history(self.username, None, resuming, resume.get("after"))
+            user_accept.update(replies.pop(0))
+            user_accept["CHANNELS"] = sorted(self.state.channels.joined(self.username))
+
+            # The reply itself still goes out as JSON, the chosen codec is
+            # used for every frame after it in both directions
+            chosen = codec.negotiate(data.get("CODECS"))
+            if "CODECS" in data:
+                user_accept["CODEC"] = chosen.name
+
+            # Compression on the other hand starts with the reply, which
+            # carries the history and roster and is the frame it helps most
+            if self.negotiate_compression(data.get("COMPRESSION")):
+                user_accept["COMPRESSION"] = DEFLATE
 
         else:
             user_accept["USERNAME_ACCEPTED"] = False
 
-        msg = json.dumps(user_accept).encode('ascii')
-        self.send_message(msg)
+        self.send_frame(Frame.encode(user_accept))
 
         if user_accept["USERNAME_ACCEPTED"]:
+            self.codec = self.outbox.codec = chosen
+
+            if self.outbox.roster:
+                if type(roster_version) is not int:
+                    roster_version = None
+                for frame in self.state.roster.catch_up(roster_version, data.get("ROSTER_EPOCH")):
+                    self.send_frame(frame)
+
+            for reply in replies:
+                self.send_frame(Frame.encode(reply))
+
             self.new_user(data[key])
-            AsyncServer.all_users_ever_logged.add(data[key])
+
+            seen = resume.get("channels")
+            if not isinstance(seen, dict):
+                seen = {}
+            for channel in user_accept["CHANNELS"]:
+                self.state.send_channel_history(self.username, channel, resuming, seen.get(channel))
+
+            # DMs still in the inbox, less any the client says it already
+            # received, for clients that acknowledge them
+            if "INBOX_ACK" in data:
+                acked = data["INBOX_ACK"]
+                if type(acked) is not int:
+                    acked = None
+                else:
+                    self.state.ack_inbox(self.username, acked)
+                self.state.send_inbox(self.username, acked)
+
+    # Pre: offered is the COMPRESSION list from the client's login frame
+    # Post: returns whether compression is now on for this connection
+    # Purpose: large frames to and from clients that offered deflate are
+    #       compressed, each direction with its own persistent zlib stream
+    def negotiate_compression(self, offered):
+        if AsyncServer.compress_threshold is None:
+            return False
+        if not isinstance(offered, list) or DEFLATE not in offered:
+            return False
+
+        self.outbox.compressor = FrameCompressor(AsyncServer.compress_threshold)
+        self.decoder.enable_compression()
+        return True
+
+    # Pre: request is the HISTORY object of a client frame, holding a message
+    #       ID in "before" or "after", optionally a page "limit" and the
+    #       "channel" the IDs belong to
+    # Post: sends the requested page of history back to this client
+    # Purpose: lets clients page through history on demand rather than
+    #       receiving all of it at login
+    def send_history(self, request):
+        try:
+            before = request.get("before")
+            after = request.get("after")
+            limit = request.get("limit")
+            channel = request.get("channel")
+            for value in (before, after, limit):
+                if value is not None and type(value) is not int:
+                    raise ValueError
+            if channel is not None and type(channel) is not str:
+                raise ValueError
+        except (AttributeError, ValueError):
+            self.send_frame(BAD_HISTORY_REQUEST)
+            return
+
+        if not self.username:
+            self.send_frame(HISTORY_BEFORE_LOGIN)
+            return
+
+        if channel is not None and not self.state.channels.is_member(channel, self.username):
+            self.send_frame(NOT_IN_CHANNEL)
+            return
+
+        self.send_frame(Frame.encode(self.state.history_reply(self.username, before, after, limit, channel)))
+
+    # Pre: through is the INBOX_ACK value of a client frame
+    # Post: the DMs up to that inbox ID are dropped from this user's inbox
+    def ack_inbox(self, through):
+        if type(through) is not int:
+            self.send_frame(BAD_INBOX_ACK)
+        elif self.username:
+            self.state.ack_inbox(self.username, through)
 
     def new_user(self, username):
-        user_message = {"USERS_JOINED": [username]}
-        user_message = json.dumps(user_message).encode('ascii')
-        self.broadcast("ALL", user_message)
+        self.state.announce_join(username)
 
-    # Gets an array of user objects
+    # Gets an array of user objects, built once per roster version
     def get_users(self):
-        userlist = []
-
-        for username in self.all_users_ever_logged:
-            userlist.append({
-                "name" : username,
-                "active" : False
-            })
-        
-        for username in AsyncServer.transport_map:
-            for user in userlist:
-                if user["name"] == username:
-                    user["active"] = True 
-
-        return userlist
+        return self.state.roster.user_list()
 
     # Determines if message is a command then handles it accordingly
     def handle_messages(self, data):
-        msg = {"MESSAGES": []}
+        messages = data["MESSAGES"]
+        if type(messages) is not list:
+            self.send_frame(BAD_MESSAGE)
+            return
+
+        for message in messages:
+            log.debug("Message from %s: %r", self.username, message)
 
-        for message in data["MESSAGES"]:
-            print(message)
+            # Stored and fanned out as sent, so anything else would reach
+            # every client
+            if not valid_message(message):
+                self.send_frame(BAD_MESSAGE)
+                continue
+
+            # Over the limit for its class, refused without being looked at
+            if not self.admit(ratelimit.classify(message[3])):
+                continue
 
             # Possible command found
             if message[3].startswith('/'):
@@ -235,9 +459,7 @@ class AsyncServer(asyncio.Protocol):
                 # FUNCTION: returns client's username
                 if tokenized_message[0] == '/Name':
                     message[3] = "Your username is " + self.username;
-                    dm = {"MESSAGES": [message]}
-                    dm = json.dumps(dm).encode('ascii')
-                    self.broadcast(message[1], dm)
+                    self.deliver(message[1], message)
 
                 # COMMAND: /Block <username>
                 # FUNCTION: blocks messages to and from the specified username
@@ -249,23 +471,12 @@ class AsyncServer(asyncio.Protocol):
                     server_message = "The following users will now be blocked: "
 
                     for user in block_users_list:
-                        if user in AsyncServer.all_users_ever_logged and user != self.username:
+                        if user in self.state.all_users_ever_logged and user != self.username:
                             server_message += (" " + user)
-
-                            if AsyncServer.client_blocked_users is not None and self.username in AsyncServer.client_blocked_users:
-                                AsyncServer.client_blocked_users[self.username].add(user)
-                            else:
-
-                                print(type(AsyncServer.client_blocked_users))
-                                AsyncServer.client_blocked_users[self.username]
-                                AsyncServer.client_blocked_users[self.username] = set()
-                                AsyncServer.client_blocked_users[self.username].add(user)
-                                print("Set ", AsyncServer.client_blocked_users[self.username])
+                            self.state.block(self.username, user)
 
                     message[3] = server_message
-                    dm = {"MESSAGES": [message]}
-                    dm = json.dumps(dm).encode('ascii')
-                    self.broadcast(message[1], dm)
+                    self.deliver(message[1], message)
 
                 # COMMAND: /UnBlock <username>
                 # FUNCTION: unblocks messages from the specified username
@@ -273,7 +484,7 @@ class AsyncServer(asyncio.Protocol):
                 #       messages still cannot be sent between the two clients
                 elif tokenized_message[0] == '/UnBlock':
 
-                    if self.username in AsyncServer.client_blocked_users:
+                    if self.state.blocks.blocked(self.username):
 
                         tokenized_message.pop(0)
 
@@ -283,26 +494,18 @@ class AsyncServer(asyncio.Protocol):
 
                         for user in unblock_users_set:
 
-                            if user in AsyncServer.client_blocked_users[self.username] and user != self.username:
+                            if user != self.username and self.state.unblock(self.username, user):
                                 server_message += (" " + user)
 
-                                if self.username in AsyncServer.client_blocked_users:
-                                    AsyncServer.client_blocked_users = AsyncServer.client_blocked_users[self.username] \
-                                        .remove(user)
-
                         message[3] = server_message
-                        dm = {"MESSAGES": [message]}
-                        dm = json.dumps(dm).encode('ascii')
-                        self.broadcast(message[0], dm)
+                        self.deliver(message[0], message)
 
                 # COMMAND: /Blocked
                 # FUNCTION: shows all users whom the client has blocked
                 elif tokenized_message[0] == '/Blocked':
 
-                    if AsyncServer.client_blocked_users is not None and \
-                            self.username in AsyncServer.client_blocked_users and \
-                            len(AsyncServer.client_blocked_users[self.username]) != 0:
-                        blocked_users_set = AsyncServer.client_blocked_users[self.username]
+                    if len(self.state.blocks.blocked(self.username)) != 0:
+                        blocked_users_set = self.state.blocks.blocked(self.username)
                         server_message = "You currently have these users blocked: " + " ".join(
                             str(user) for user in blocked_users_set)
 
@@ -310,72 +513,341 @@ class AsyncServer(asyncio.Protocol):
                         server_message = "You have no users blocked"
 
                     message[3] = server_message
-                    dm = {"MESSAGES": [message]}
-                    dm = json.dumps(dm).encode('ascii')
-                    self.broadcast(message[1], dm)
+                    self.deliver(message[1], message)
 
                 # COMMAND: /DisplayUsers
                 # FUNCTION: Display all currently active users
                 elif message[3] == '/DisplayUsers':
 
-                    message[3] = '\n\nCURRENT USER(S) ONLINE\n' + str('-' * 22) + '\n' + "\n".join(
-                        str(user) for user in AsyncServer.transport_map)
-                    dm = {"MESSAGES": [message]}
-                    dm = json.dumps(dm).encode('ascii')
-                    self.broadcast(message[1], dm)
+                    message[3] = self.state.roster.display_online()
+                    self.deliver(message[1], message)
 
                 # COMMAND: /DisplayAllUsers
                 # FUNCTION: Display all users who have ever accessed the server
                 elif message[3] == '/DisplayAllUsers':
 
-                    server_message = '\n\n   ALL USER(S)\n' + str('-' * 22) + '\n'
+                    message[3] = self.state.roster.display_all()
+                    self.deliver(message[1], message)
+
+                # COMMAND: /Join #channel
+                # FUNCTION: joins (creating if need be) a channel and shows
+                #       its latest messages
+                elif tokenized_message[0] == '/Join' and len(tokenized_message) == 2:
+                    channel = tokenized_message[1]
+                    joining = False
+
+                    if not channels.valid_name(channel):
+                        message[3] = "Channel names are # followed by up to 32 letters, digits, _ or -"
+                    elif self.state.channels.is_member(channel, self.username):
+                        message[3] = "You are already in " + channel
+                    else:
+                        message[3] = "You joined " + channel
+                        joining = True
+
+                    # The channel's history follows the reply
+                    self.deliver(self.username, message)
+                    if joining:
+                        self.state.join_channel(self.username, channel)
+
+                # COMMAND: /Leave #channel
+                # FUNCTION: stops receiving a channel's messages
+                elif tokenized_message[0] == '/Leave' and len(tokenized_message) == 2:
+                    if self.state.leave_channel(self.username, tokenized_message[1]):
+                        message[3] = "You left " + tokenized_message[1]
+                    else:
+                        message[3] = "You are not in " + tokenized_message[1]
+
+                    self.deliver(self.username, message)
+
+                # COMMAND: /Search [-page] <terms>
+                # FUNCTION: finds public messages holding every term, best
+                #       matches first, a page at a time
+                elif tokenized_message[0] == '/Search' and len(tokenized_message) > 1:
+                    message[3] = self.search_results(tokenized_message[1:])
+                    self.deliver(self.username, message)
 
-                    for user in AsyncServer.all_users_ever_logged:
-                        server_message = server_message + '\n' + str(user)
+                # COMMAND: /Channels
+                # FUNCTION: lists every channel, marking those the user is in
+                elif message[3] == '/Channels':
+                    listing = self.state.channels.listing()
+                    joined = self.state.channels.joined(self.username)
 
-                        if user in AsyncServer.transport_map:
-                            server_message = server_message + ' : ONLINE'
-                        else:
-                            server_message = server_message + ' : OFFLINE'
+                    server_message = '\n\n   CHANNEL(S)\n' + str('-' * 22)
+                    for name, members in listing:
+                        server_message += '\n{} ({} members){}'.format(name, members, ' : JOINED' if name in joined else '')
+                    if not listing:
+                        server_message += '\nNo channels yet, create one with /Join #name'
 
                     message[3] = server_message
-                    dm = {"MESSAGES": [message]}
-                    dm = json.dumps(dm).encode('ascii')
-                    self.broadcast(message[1], dm)
+                    self.deliver(self.username, message)
 
                 else:
                     pass
 
-            # Those messages that are directed to all get appended to the
-            # Monolithic message
+            # Those messages that are directed to all get added to the
+            # history and batched up for everyone allowed to see them
             elif message[1] == 'ALL':
-                msg["MESSAGES"].append(message)
-                AsyncServer.messages.append(message)
+                self.deliver('ALL', message)
 
             # If a message is directed to a specific user we pull it out of the
             # list of messages and send it to the designated client
             else:
-                dm = {"MESSAGES": [message]}
-                dm = json.dumps(dm).encode('ascii')
-                self.broadcast(message[1], dm)
+                self.deliver(message[1], message)
+
+    # Pre: words are the arguments of a /Search, optionally led by -<page>
+    # Post: returns the text of that page of results
+    def search_results(self, words):
+        page = 1
+        if len(words) > 1 and words[0].startswith('-') and words[0][1:].isdigit():
+            page = max(int(words[0][1:]), 1)
+            words = words[1:]
+
+        query = ' '.join(words)
+        server_message = '\n\n   SEARCH: {}\n'.format(query) + str('-' * 22)
 
-        msg = json.dumps(msg).encode('ascii')
-        self.broadcast("ALL", msg)
+        # With --lazy-history the index loads after the server starts
+        if self.state.search is None:
+            return server_message + '\nThe search index is still loading, try again shortly'
 
-    # Remove client from the transport list upon connection lost and backup
-    # data to the db
+        results, total = self.state.search_messages(self.username, query, page)
+        pages = max((total + search.DEFAULT_PAGE_SIZE - 1) // search.DEFAULT_PAGE_SIZE, 1)
+
+        for sender, _, _, content, message_id in results:
+            server_message += '\n[{}] {}: {}'.format(message_id, sender, content)
+
+        if total == 0:
+            server_message += '\nNo messages found'
+        else:
+            server_message += '\n\n{} message(s), page {} of {}'.format(total, min(page, pages), pages)
+            if page < pages:
+                server_message += ', /Search -{} {} for more'.format(page + 1, query)
+
+        return server_message
+
+    # Remove client from the transport list upon connection lost, everything
+    # worth keeping has already been journaled
     def connection_lost(self, exc):
+        self.outbox.close()
+        if AsyncServer.wheel is not None:
+            AsyncServer.wheel.cancel(self)
+        if self.capture_id is not None:
+            AsyncServer.capture.closed(self.capture_id)
+
         # Check to make sure that the user is logged in
         if self.username != None and self.username != '':
-            AsyncServer.transport_map.pop(self.username)
-            msg = {"USERS_LEFT": [self.username]}
-            msg = json.dumps(msg).encode('ascii')
-            self.broadcast("ALL", msg)
+            self.state.leave(self.username)
+
+
+# Pre: state is the state this process serves from
+# Post: the gauges read connected users, outbound queues and held history
+#       from state
+def register_gauges(state):
+    metrics.Gauge('chatterbox_connected_users', 'Users connected to this process', lambda: len(state.transport_map))
+    metrics.Gauge('chatterbox_online_users', 'Users online on any process', lambda: len(state.online))
+    metrics.Gauge('chatterbox_outbox_frames', 'Frames queued for slow clients',
+                  lambda: state.queue_stats()["queued_frames"])
+    metrics.Gauge('chatterbox_outbox_bytes', 'Bytes queued for slow clients',
+                  lambda: state.queue_stats()["queued_bytes"])
+    metrics.Gauge('chatterbox_outbox_max_depth', 'Frames queued for the slowest client',
+                  lambda: state.queue_stats()["max_depth"])
+    metrics.Gauge('chatterbox_dropped_frames', 'Frames dropped by the slow consumer policy',
+                  lambda: state.queue_stats()["dropped_frames"])
+    metrics.Gauge('chatterbox_history_held_messages', 'Public messages held in memory', lambda: state.messages.held)
+    metrics.Gauge('chatterbox_history_held_bytes', 'Bytes held in memory for public messages',
+                  lambda: state.messages.nbytes)
+
+
+# Pre: loop is running this process's server, port is --metrics-port
+# Post: metrics are served on the port, if one was given
+def serve_metrics(loop, state, port):
+    if port is None:
+        return None
+
+    register_gauges(state)
+    server = metrics.serve(loop, port)
+    log.info('Metrics at http://127.0.0.1:%d/metrics (pid %d)', port, os.getpid())
+    return server
+
+
+# Pre: args.diagnostics is set, nothing has been served yet
+# Post: the handlers most likely to stall the loop log themselves when slow
+def instrument_handlers(threshold):
+    diagnostics.instrument(AsyncServer, ('data_received', 'make_user', 'handle_messages', 'send_history',
+                                         'get_users', 'connection_lost'), threshold)
+    diagnostics.instrument(ServerState, ('apply', 'history_page', 'search_messages'), threshold)
+    diagnostics.instrument(batching.Batcher, ('flush',), threshold)
+    diagnostics.instrument(storage.Persistence, ('compact',), threshold)
+    diagnostics.instrument(bus.BusHub, ('received',), threshold)
+
+
+# Pre: loop is this process's event loop
+# Post: with --diagnostics, loop lag is monitored and the profiling signals
+#       are handled
+def start_diagnostics(loop, args):
+    if not args.diagnostics:
+        return
+
+    diagnostics.LagMonitor(loop, threshold=args.slow_callback).start()
+    diagnostics.Profiler(args.profile_dir).install(loop)
+    log.info('Diagnostics on, SIGUSR1 toggles cProfile and SIGUSR2 stack sampling (pid %d)', os.getpid())
+
+
+# Pre: state has been loaded, context is the TLS context shared by every
+#       process, bus_path is the hub's socket when this process is one of
+#       several workers, worker is its index among them, upstream the Unix
+#       socket to serve TLS terminators on instead of the TCP port
+# Post: serves clients on a fresh event loop until it is stopped
+def serve(args, state, context, bus_path=None, worker=None, upstream=None):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    # Workers apply changes in the order the hub sends them and leave
+    # persistence to the parent, so they wait until every worker is connected
+    if bus_path is not None:
+        worker_bus = loop.run_until_complete(loop.create_unix_connection(lambda: bus.WorkerBus(state), bus_path))[1]
+        state.bus = worker_bus
+        loop.run_until_complete(worker_bus.ready)
+    else:
+        state.open(loop)
+
+    if upstream is not None:
+        coro = loop.create_unix_server(lambda: AsyncServer(state), upstream)
+    else:
+        coro = loop.create_server(lambda: AsyncServer(state), *(args.host, args.p), ssl=context,
+                                  reuse_port=bus_path is not None)
+
+    # One wheel for every connection of this process
+    if args.idle_timeout > 0:
+        AsyncServer.wheel = heartbeat.TimerWheel(loop, AsyncServer.heartbeat, args.heartbeat_tick)
+
+    # Workers each write their own capture
+    if args.capture is not None:
+        path = args.capture if worker is None else '{}.{}'.format(args.capture, worker)
+        AsyncServer.capture = capture.Capture(path, loop)
+
+    server = loop.run_until_complete(coro)
+    log.info('Listening at %s (pid %d)', upstream or (args.host, args.p), os.getpid())
+    if state.search is None:
+        loop.create_task(state.load_search(loop))
+
+    # The parent takes --metrics-port, worker N the port N + 1 after it
+    metrics_port = args.metrics_port
+    if metrics_port is not None and worker is not None:
+        metrics_port += worker + 1
+    metrics_server = serve_metrics(loop, state, metrics_port)
+    start_diagnostics(loop, args)
+
+    try:
+        loop.run_forever()
+    finally:
+        server.close()
+        if AsyncServer.wheel is not None:
+            AsyncServer.wheel.close()
+        if AsyncServer.capture is not None:
+            AsyncServer.capture.close()
+        if metrics_server is not None:
+            metrics_server.close()
+        state.close()
+        loop.close()
 
-            with open('server_data.pkl', 'wb') as f:
-                pickle.dump(AsyncServer.messages, f)
-                pickle.dump(AsyncServer.all_users_ever_logged, f)
-                pickle.dump(AsyncServer.client_blocked_users, f)
+
+# Pre: state has been loaded and args.workers is more than one, upstreams
+#       has a Unix socket path per worker if TLS is offloaded
+# Post: forks the workers, then runs the bus hub until interrupted
+# Purpose: spreads TLS and JSON work over several cores. Each worker is
+#       forked with a copy of the state and accepts on the same port through
+#       SO_REUSEPORT, the parent keeps the persisted copy and relays every
+#       change between the workers over a Unix domain socket.
+def run_workers(args, state, context, upstreams=None):
+    bus_path = os.path.join(tempfile.mkdtemp(), 'bus.sock')
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(bus_path)
+    listener.listen(args.workers)
+
+    workers = []
+    for worker in range(args.workers):
+        pid = os.fork()
+        if pid == 0:
+            listener.close()
+            state.persistence = None
+            try:
+                serve(args, state, context, bus_path, worker, upstreams[worker] if upstreams else None)
+            finally:
+                os._exit(0)
+        workers.append(pid)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    state.open(loop)
+
+    hub = bus.BusHub(state, args.workers)
+    state.bus = hub
+    server = loop.run_until_complete(loop.create_unix_server(hub.connection, sock=listener))
+    if state.search is None:
+        loop.create_task(state.load_search(loop))
+    metrics_server = serve_metrics(loop, state, args.metrics_port)
+    start_diagnostics(loop, args)
+
+    try:
+        loop.run_forever()
+    finally:
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+            except ProcessLookupError:
+                pass
+        server.close()
+        if metrics_server is not None:
+            metrics_server.close()
+        state.close()
+        loop.close()
+        os.remove(bus_path)
+        os.rmdir(os.path.dirname(bus_path))
+
+
+# Pre: context is the server's TLS context, args.tls_workers is positive
+# Post: returns (pids, upstreams), the terminator processes forked to
+#       accept clients on the port and the Unix socket paths, one per server
+#       process, they relay clients to
+def start_terminators(args, context):
+    directory = tempfile.mkdtemp()
+    upstreams = [os.path.join(directory, 'chat-{}.sock'.format(worker)) for worker in range(args.workers)]
+
+    # Their metrics ports come after the server processes'
+    metrics_port = args.metrics_port
+    if metrics_port is not None:
+        metrics_port += args.workers if args.workers > 1 else 0
+
+    pids = []
+    for terminator in range(args.tls_workers):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                tls.terminate(args.host, args.p, context, upstreams,
+                              metrics_port + terminator + 1 if metrics_port is not None else None)
+            finally:
+                os._exit(0)
+        pids.append(pid)
+
+    return pids, upstreams
+
+
+# Stops the terminators and removes the sockets they relayed to
+def stop_terminators(pids, upstreams):
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+        except (ChildProcessError, ProcessLookupError):
+            pass
+
+    for path in upstreams:
+        if os.path.exists(path):
+            os.remove(path)
+    os.rmdir(os.path.dirname(upstreams[0]))
 
 
 if __name__ == '__main__':
@@ -383,21 +855,146 @@ if __name__ == '__main__':
     parser.add_argument('host', help='IP or hostname')
     parser.add_argument('-p', metavar='port', type=int, default=9000,
                         help='TCP port (default 9000)')
+    parser.add_argument('--workers', metavar='N', type=int, default=1,
+                        help='Worker processes accepting on the same port (default 1)')
+    parser.add_argument('--tls-workers', metavar='N', type=int, default=0,
+                        help='Processes that do TLS for the server and relay clients to it (default 0, '
+                             'the server does its own)')
+    parser.add_argument('--max-frame-size', metavar='bytes', type=int, default=DEFAULT_MAX_FRAME_SIZE,
+                        help='Largest frame accepted from a client (default {})'.format(DEFAULT_MAX_FRAME_SIZE))
+    parser.add_argument('--slow-consumer', choices=outbox.POLICIES, default=outbox.DROP_OLDEST,
+                        help='What to do with a client whose outbound queue fills up (default {})'.format(
+                            outbox.DROP_OLDEST))
+    parser.add_argument('--outbox-frames', metavar='frames', type=int, default=outbox.DEFAULT_MAX_FRAMES,
+                        help='Frames queued for a slow client before --slow-consumer applies (default {})'.format(
+                            outbox.DEFAULT_MAX_FRAMES))
+    parser.add_argument('--outbox-bytes', metavar='bytes', type=int, default=outbox.DEFAULT_MAX_BYTES,
+                        help='Bytes queued for a slow client before --slow-consumer applies (default {})'.format(
+                            outbox.DEFAULT_MAX_BYTES))
+    parser.add_argument('--limit-messages', metavar='rate[/burst]', type=ratelimit.parse_limit,
+                        default=ratelimit.DEFAULT_LIMITS[ratelimit.MESSAGES],
+                        help='Chat messages a client may send per second, 0 for no limit (default {})'.format(
+                            ratelimit.DEFAULT_LIMITS[ratelimit.MESSAGES]))
+    parser.add_argument('--limit-commands', metavar='rate[/burst]', type=ratelimit.parse_limit,
+                        default=ratelimit.DEFAULT_LIMITS[ratelimit.COMMANDS],
+                        help='Commands and HISTORY requests a client may send per second (default {})'.format(
+                            ratelimit.DEFAULT_LIMITS[ratelimit.COMMANDS]))
+    parser.add_argument('--limit-heavy', metavar='rate[/burst]', type=ratelimit.parse_limit,
+                        default=ratelimit.DEFAULT_LIMITS[ratelimit.HEAVY],
+                        help='/DisplayUsers, /DisplayAllUsers, /Channels and /Search a client may send per second '
+                             '(default {})'.format(ratelimit.DEFAULT_LIMITS[ratelimit.HEAVY]))
+    parser.add_argument('--limit-frames', metavar='rate[/burst]', type=ratelimit.parse_limit,
+                        default=ratelimit.DEFAULT_LIMITS[ratelimit.FRAMES],
+                        help='Frames read from a client per second before reading pauses (default {})'.format(
+                            ratelimit.DEFAULT_LIMITS[ratelimit.FRAMES]))
+    parser.add_argument('--admit-connections', metavar='rate[/burst]', type=ratelimit.parse_limit,
+                        default=ratelimit.DEFAULT_ADMISSION[ratelimit.CONNECTIONS],
+                        help='New connections each process accepts per second (default {})'.format(
+                            ratelimit.DEFAULT_ADMISSION[ratelimit.CONNECTIONS]))
+    parser.add_argument('--admit-logins', metavar='rate[/burst]', type=ratelimit.parse_limit,
+                        default=ratelimit.DEFAULT_ADMISSION[ratelimit.LOGINS],
+                        help='Logins each process accepts per second (default {})'.format(
+                            ratelimit.DEFAULT_ADMISSION[ratelimit.LOGINS]))
+    parser.add_argument('--ping-after', metavar='seconds', type=float, default=heartbeat.DEFAULT_PING_AFTER,
+                        help='Silence from a client before it is sent a PING (default {})'.format(
+                            heartbeat.DEFAULT_PING_AFTER))
+    parser.add_argument('--idle-timeout', metavar='seconds', type=float, default=heartbeat.DEFAULT_IDLE_TIMEOUT,
+                        help='Silence from a client before its connection is closed, 0 never closes it '
+                             '(default {})'.format(heartbeat.DEFAULT_IDLE_TIMEOUT))
+    parser.add_argument('--heartbeat-tick', metavar='seconds', type=float, default=heartbeat.DEFAULT_TICK,
+                        help='How often idle connections are checked (default {})'.format(heartbeat.DEFAULT_TICK))
+    parser.add_argument('--compress-threshold', metavar='bytes', type=int, default=DEFAULT_COMPRESS_THRESHOLD,
+                        help='Smallest frame deflated for clients that offer compression (default {})'.format(
+                            DEFAULT_COMPRESS_THRESHOLD))
+    parser.add_argument('--no-compression', action='store_true',
+                        help='Never agree to compress frames')
+    parser.add_argument('--batch-window', metavar='seconds', type=float, default=batching.DEFAULT_WINDOW,
+                        help='How long outgoing messages wait to be batched per recipient (default {})'.format(
+                            batching.DEFAULT_WINDOW))
+    parser.add_argument('--batch-max', metavar='messages', type=int, default=batching.DEFAULT_MAX_MESSAGES,
+                        help='Pending messages that flush a batch early (default {})'.format(
+                            batching.DEFAULT_MAX_MESSAGES))
+    parser.add_argument('--data', metavar='path', default='server_data.pkl',
+                        help='Snapshot file, journal segments are kept next to it (default server_data.pkl)')
+    parser.add_argument('--fsync-interval', metavar='seconds', type=float, default=storage.DEFAULT_FSYNC_INTERVAL,
+                        help='Longest a journaled change waits to be fsync\'d (default {})'.format(
+                            storage.DEFAULT_FSYNC_INTERVAL))
+    parser.add_argument('--lazy-history', action='store_true',
+                        help='Memory map the message archive instead of reading it at startup, and load the '
+                             'search index once the server is listening')
+    parser.add_argument('--retain-messages', metavar='messages', type=int, default=history.DEFAULT_RETAIN_MESSAGES,
+                        help='Archived messages kept in memory, older ones are read from the archive (default {})'.format(
+                            history.DEFAULT_RETAIN_MESSAGES))
+    parser.add_argument('--retain-bytes', metavar='bytes', type=int, default=history.DEFAULT_RETAIN_BYTES,
+                        help='Bytes of archived messages kept in memory (default {})'.format(
+                            history.DEFAULT_RETAIN_BYTES))
+    parser.add_argument('--retain-age', metavar='seconds', type=float, default=history.DEFAULT_RETAIN_AGE,
+                        help='How long archived messages are kept in memory (default no limit)')
+    parser.add_argument('--inbox-size', metavar='messages', type=int, default=inbox.DEFAULT_MAX_PENDING,
+                        help='Unacknowledged DMs kept per user, the oldest are dropped beyond it (default {})'.format(
+                            inbox.DEFAULT_MAX_PENDING))
+    parser.add_argument('--history-page', metavar='messages', type=int, default=DEFAULT_HISTORY_PAGE,
+                        help='Messages of history sent at login and per HISTORY request (default {})'.format(
+                            DEFAULT_HISTORY_PAGE))
+    parser.add_argument('--snapshot-every', metavar='records', type=int, default=storage.DEFAULT_SNAPSHOT_EVERY,
+                        help='Journal records between snapshots (default {})'.format(storage.DEFAULT_SNAPSHOT_EVERY))
+    parser.add_argument('--metrics-port', metavar='port', type=int, default=None,
+                        help='Serve Prometheus metrics on this local port, workers use the ports after it')
+    parser.add_argument('--log-level', choices=('debug', 'info', 'warning', 'error'), default='info',
+                        help='Least severe records logged, debug logs every message (default info)')
+    parser.add_argument('--log-burst', metavar='records', type=int, default=10,
+                        help='Records of any one kind logged per second before the rest are suppressed (default 10)')
+    parser.add_argument('--capture', metavar='path', default=None,
+                        help='Record every frame clients send to this file, for replay.py')
+    parser.add_argument('--diagnostics', action='store_true',
+                        help='Monitor event loop lag, log slow handlers and profile on SIGUSR1/SIGUSR2')
+    parser.add_argument('--slow-callback', metavar='seconds', type=float, default=diagnostics.DEFAULT_SLOW_CALLBACK,
+                        help='Loop lag or handler time logged with --diagnostics (default {})'.format(
+                            diagnostics.DEFAULT_SLOW_CALLBACK))
+    parser.add_argument('--profile-dir', metavar='path', default='.',
+                        help='Where --diagnostics writes profiling captures (default .)')
     args = parser.parse_args()
 
-    loop = asyncio.get_event_loop()
-
-    purpose = ssl.Purpose.CLIENT_AUTH
-    context = ssl.create_default_context(purpose, cafile='ca.crt')
-    context.load_cert_chain('localhost.pem')
-
-    coro = loop.create_server(AsyncServer, *(args.host, args.p), ssl=context)
-
-    server = loop.run_until_complete(coro)
-    print('Listening at {}'.format((args.host, args.p)))
+    logging.basicConfig(level=args.log_level.upper(), format='%(asctime)s %(levelname)s %(message)s')
+    log.addFilter(metrics.RateLimitFilter(args.log_burst))
+
+    AsyncServer.max_frame_size = args.max_frame_size
+    AsyncServer.slow_consumer_policy = args.slow_consumer
+    AsyncServer.outbox_frames = args.outbox_frames
+    AsyncServer.outbox_bytes = args.outbox_bytes
+    AsyncServer.compress_threshold = None if args.no_compression else args.compress_threshold
+    AsyncServer.limits = {ratelimit.MESSAGES: args.limit_messages, ratelimit.COMMANDS: args.limit_commands,
+                          ratelimit.HEAVY: args.limit_heavy, ratelimit.FRAMES: args.limit_frames}
+    AsyncServer.admission = ratelimit.Limiter({ratelimit.CONNECTIONS: args.admit_connections,
+                                               ratelimit.LOGINS: args.admit_logins})
+    AsyncServer.ping_after = args.ping_after
+    AsyncServer.idle_timeout = args.idle_timeout
+    if 0 < args.idle_timeout <= args.ping_after:
+        parser.error('--idle-timeout must be longer than --ping-after')
+    if args.diagnostics:
+        instrument_handlers(args.slow_callback)
+
+    # Rebuild the state once from the snapshot and journal tail, every
+    # connection shares it
+    retention = history.Retention(args.retain_messages, args.retain_bytes, args.retain_age)
+    persistence = storage.Persistence(args.data, args.fsync_interval, args.snapshot_every, retention,
+                                      inbox_size=args.inbox_size)
+    state = ServerState.load(persistence, lazy=args.lazy_history, history_page_size=args.history_page,
+                             batch_window=args.batch_window, batch_max=args.batch_max)
+
+    # One context for every process, so they all share its session ticket
+    # keys and a reconnecting client resumes wherever it lands
+    context = tls.server_context()
+
+    terminators, upstreams = [], None
+    if args.tls_workers > 0:
+        terminators, upstreams = start_terminators(args, context)
 
     try:
-        loop.run_forever()
+        if args.workers > 1:
+            run_workers(args, state, context, upstreams)
+        else:
+            serve(args, state, context, upstream=upstreams[0] if upstreams else None)
     finally:
-        server.close()
-        loop.close()
+        if upstreams:
+            stop_terminators(terminators, upstreams)
@@ -0,0 +1,443 @@
+"""state
+Shared state of a running Chatterbox server
+
+One ServerState is loaded when the server starts and handed to every
+connection's protocol instance, so nothing is read from disk per connection.
+Changes to it are published on a bus (see bus.py) and applied by apply(),
+which is what lets several worker processes keep identical copies.
+"""
+from collections import defaultdict
+
+import asyncio
+
+import batching
+import bus
+import inbox
+import presence
+import search
+import storage
+from blocks import BlockIndex
+from channels import ChannelIndex
+from framing import Frame
+from history import MessageStore
+
+DEFAULT_HISTORY_PAGE = 50  # Messages sent at login and per HISTORY request
+MAX_HISTORY_PAGE = 500  # Largest page a client may ask for
+MAX_RESUME = 2000  # Missed messages a reconnecting client is sent instead of the newest page
+SEARCH_CHUNK = 1000  # Messages a deferred search index indexes per pass of the event loop
+
+
+class ServerState:
+    """Users, messages, block lists and channels shared by every connection"""
+
+    def __init__(self, messages=None, all_users_ever_logged=None, client_blocked_users=None, channels=None,
+                 inboxes=None, search_index=None, persistence=None, history_page_size=DEFAULT_HISTORY_PAGE,
+                 batch_window=batching.DEFAULT_WINDOW, batch_max=batching.DEFAULT_MAX_MESSAGES, defer_search=False):
+        self.transport_map = {}  # Map of usernames connected to this process to their outbox.Outbox
+        self.dropped_frames = 0  # Frames dropped for users who have since left
+
+        # Every public message, a message's ID is its position in the history
+        self.messages = messages if messages is not None else MessageStore()
+        self.history_page_size = history_page_size
+
+        # Inverted index over the public messages for /Search. A deferred
+        # index is None until load_search has loaded it after startup
+        self.search_path = persistence.index_path if persistence is not None else None
+        if defer_search:
+            self.search = None
+        else:
+            self.search = search_index if search_index is not None else search.SearchIndex()
+            self.search.update(self.messages)
+        self.all_users_ever_logged = all_users_ever_logged if all_users_ever_logged is not None else set()
+
+        # Who is online, versioned so clients can be sent only what changed
+        self.roster = presence.Roster(self.all_users_ever_logged, set())
+
+        # Shows the relationship between given users and their blocked user names
+        self.client_blocked_users = client_blocked_users if client_blocked_users is not None else defaultdict(dict)
+        self.blocks = BlockIndex(self.client_blocked_users)
+
+        # Channel members and histories, public messages outside "ALL"
+        self.channels = ChannelIndex(channels if channels is not None else dict(), self.blocks.online,
+                                     persistence.channel_history if persistence is not None else None)
+
+        # DMs waiting for their recipients to acknowledge them, an
+        # inbox.InboxIndex
+        self.inboxes = inboxes if inboxes is not None else inbox.InboxIndex(dict())
+
+        # Outgoing chat messages wait here briefly so they can be batched
+        self.batcher = batching.Batcher(self.transport_map, batch_window, batch_max)
+
+        # Journal that every accepted change is written to
+        self.persistence = persistence
+
+        # Where changes are published, replaced by a bus.WorkerBus in workers
+        self.bus = bus.LocalBus(self)
+
+    # Pre: persistence has not been opened yet
+    # Post: returns a state rebuilt from the snapshot and journal
+    # Purpose: loads everything once at startup, with lazy set the message
+    #       archive is memory mapped instead of read and the search index is
+    #       left to load_search. Any other keyword options are passed on to
+    #       the constructor.
+    @classmethod
+    def load(cls, persistence, lazy=False, **options):
+        messages, users, blocked, channels, inboxes = persistence.load(lazy)
+        index = None if lazy else persistence.load_index(messages)
+        return cls(messages, users, blocked, channels, inboxes, index, persistence, defer_search=lazy, **options)
+
+    # Pre: the state was loaded with defer_search and loop is running
+    # Post: the search index is loaded, or rebuilt, and used from then on
+    # Purpose: the saved index is read in a thread, then the messages it
+    #       doesn't cover are indexed SEARCH_CHUNK at a time so clients
+    #       aren't kept waiting behind the whole history. Only the process
+    #       that persists the state saves a new index.
+    async def load_search(self, loop):
+        index, size = await loop.run_in_executor(None, search.load, self.search_path)
+        if self.persistence is not None:
+            index = self.persistence.saved_index(index, size, len(self.messages))
+        elif index is None or index.count > len(self.messages):
+            index = search.SearchIndex()
+
+        while index.count < len(self.messages):
+            index.update(self.messages, SEARCH_CHUNK)
+            await asyncio.sleep(0)
+
+        self.search = index
+        if self.persistence is not None:
+            self.persistence.index_loaded(index)
+
+    # Pre: loop is the loop the server runs on
+    # Post: changes passed to persist() are journaled
+    def open(self, loop):
+        if self.persistence is not None:
+            self.persistence.open(loop, lambda: (self.messages, self.all_users_ever_logged, self.client_blocked_users,
+                                                 self.channels.channels, self.inboxes),
+                                  self.archived, self.search)
+
+    # Tells every copy of the state that the first count messages are in the
+    # archive, and the first channel_counts[name] of each channel named in
+    # its own, so the retention policy may evict them from memory
+    def archived(self, count, channel_counts):
+        self.bus.publish({"type": bus.ARCHIVED, "count": count, "channels": channel_counts})
+
+    # Writes a change to the journal so it survives a restart
+    def persist(self, op, data):
+        if self.persistence is not None:
+            self.persistence.record(op, data)
+
+    # Users online on any worker
+    @property
+    def online(self):
+        return self.blocks.online
+
+    def is_online(self, username):
+        return username in self.blocks.online
+
+    # Registers a logged in user's outbox, the join is announced separately
+    # once the user has been told they are in
+    def join(self, username, outbox):
+        self.transport_map[username] = outbox
+        self.blocks.join(username)
+        self.channels.presence_changed(username)
+
+    def announce_join(self, username):
+        self.bus.publish({"type": bus.JOIN, "user": username})
+
+    # Forgets a disconnected user's outbox and announces that they left
+    def leave(self, username):
+        outbox = self.transport_map.pop(username)
+        self.dropped_frames += outbox.dropped
+        self.bus.publish({"type": bus.LEAVE, "user": username})
+
+    # Pre: none
+    # Post: returns a dict with the frames and bytes currently queued for
+    #       slow clients, the deepest single queue, and frames dropped so far
+    def queue_stats(self):
+        stats = {"queued_frames": 0, "queued_bytes": 0, "max_depth": 0, "dropped_frames": self.dropped_frames}
+
+        for outbox in self.transport_map.values():
+            stats["queued_frames"] += outbox.depth
+            stats["queued_bytes"] += outbox.queued_bytes
+            stats["max_depth"] = max(stats["max_depth"], outbox.depth)
+            stats["dropped_frames"] += outbox.dropped
+
+        return stats
+
+    # Blocks target for user, returning True if they weren't already blocked
+    def block(self, user, target):
+        if self.blocks.block(user, target):
+            self.bus.publish({"type": bus.BLOCK, "user": user, "target": target})
+            return True
+        return False
+
+    # Unblocks target for user, returning True if they were blocked
+    def unblock(self, user, target):
+        if self.blocks.unblock(user, target):
+            self.bus.publish({"type": bus.UNBLOCK, "user": user, "target": target})
+            return True
+        return False
+
+    # Pre: message is a public (SRC, DEST, TIMESTAMP, CONTENT) list
+    # Post: the message is added to the history and sent to everyone allowed
+    #       to see it, on every worker
+    def publish_message(self, sender, message):
+        self.bus.publish({"type": bus.MESSAGE, "sender": sender, "message": message})
+
+    # Pre: sender is a member of the channel, message is addressed to it
+    # Post: the message is added to the channel's history and sent to its
+    #       members, on every worker
+    def publish_channel_message(self, sender, channel, message):
+        self.bus.publish({"type": bus.CHANNEL_MESSAGE, "sender": sender, "channel": channel, "message": message})
+
+    # Adds user to a channel, creating it if need be, returning True if they
+    # weren't already a member
+    def join_channel(self, user, channel):
+        if self.channels.is_member(channel, user):
+            return False
+        self.bus.publish({"type": bus.CHANNEL_JOIN, "user": user, "channel": channel})
+        return True
+
+    # Takes user out of a channel, returning True if they were a member
+    def leave_channel(self, user, channel):
+        if not self.channels.is_member(channel, user):
+            return False
+        self.bus.publish({"type": bus.CHANNEL_LEAVE, "user": user, "channel": channel})
+        return True
+
+    # Pre: recipient is a user who has logged in before, message a
+    #       (SRC, DEST, TIMESTAMP, CONTENT) list addressed to them
+    # Post: message is kept in the recipient's inbox on every worker and
+    #       batched for them wherever they are connected
+    def send_direct(self, recipient, message):
+        self.bus.publish({"type": bus.INBOX, "to": recipient, "message": message})
+
+    # Drops the DMs up to inbox ID through from user's inbox, on every worker
+    def ack_inbox(self, user, through):
+        if self.inboxes.holds(user, through):
+            self.bus.publish({"type": bus.INBOX_ACK, "user": user, "through": through})
+
+    # Pre: event was published on the bus
+    # Post: the change is applied to this copy of the state and delivered to
+    #       the users connected to this process
+    def apply(self, event):
+        kind = event["type"]
+
+        if kind == bus.MESSAGE:
+            message = event["message"]
+            message_id = self.add_message(message)
+            self.batcher.add_public(message + [message_id], self.blocks.recipients(event["sender"]))
+
+        elif kind == bus.CHANNEL_MESSAGE:
+            channel = event["channel"]
+            message = event["message"]
+            message_id = self.channels.add_message(channel, message)
+            self.persist(storage.CHANNEL_MESSAGE, [channel, message])
+
+            # Both sides are frozensets, intersecting walks the smaller one
+            recipients = self.channels.online_members(channel) & self.blocks.recipients(event["sender"])
+            self.batcher.add_public(message + [message_id], recipients)
+
+        elif kind == bus.CHANNEL_JOIN:
+            self.channels.join(event["channel"], event["user"])
+            self.persist(storage.CHANNEL_JOIN, [event["user"], event["channel"]])
+            self.send_channel_history(event["user"], event["channel"])
+
+        elif kind == bus.CHANNEL_LEAVE:
+            self.channels.leave(event["channel"], event["user"])
+            self.persist(storage.CHANNEL_LEAVE, [event["user"], event["channel"]])
+
+        elif kind == bus.INBOX:
+            recipient = event["to"]
+            message = event["message"]
+            message_id = self.inboxes.add(recipient, message)
+            self.persist(storage.INBOX, [recipient, message])
+            self.batcher.add_direct(recipient, message + [message_id])
+
+        elif kind == bus.INBOX_ACK:
+            if self.inboxes.ack(event["user"], event["through"]):
+                self.persist(storage.INBOX_ACK, [event["user"], event["through"]])
+
+        elif kind == bus.JOIN:
+            username = event["user"]
+            self.blocks.join(username)
+            self.channels.presence_changed(username)
+
+            if username not in self.all_users_ever_logged:
+                self.all_users_ever_logged.add(username)
+                self.persist(storage.JOIN, username)
+
+            version = self.roster.update(username, True)
+            self.batcher.add_presence(username, True, self.blocks.recipients(username), version)
+
+        elif kind == bus.LEAVE:
+            self.blocks.leave(event["user"])
+            self.channels.presence_changed(event["user"])
+            version = self.roster.update(event["user"], False)
+            self.batcher.add_presence(event["user"], False, self.blocks.recipients(event["user"]), version)
+
+        elif kind == bus.BLOCK:
+            self.blocks.block(event["user"], event["target"])
+            self.persist(storage.BLOCK, [event["user"], event["target"]])
+
+        elif kind == bus.UNBLOCK:
+            self.blocks.unblock(event["user"], event["target"])
+            self.persist(storage.UNBLOCK, [event["user"], event["target"]])
+
+        elif kind == bus.ARCHIVED:
+            self.messages.archived_through(event["count"])
+            for channel, count in event["channels"].items():
+                self.channels.history(channel).archived_through(count)
+
+        elif kind == bus.JOIN_REJECTED:
+            outbox = self.transport_map.get(event["user"])
+            if outbox is not None:
+                outbox.send(Frame.encode({"ERROR": "Username is already in use"}))
+                outbox.transport.close()
+
+    # Pre: message is a public (SRC, DEST, TIMESTAMP, CONTENT) list
+    # Post: returns the message ID assigned to it
+    # Purpose: appends the message to the history and journals it
+    def add_message(self, message):
+        message_id = len(self.messages)
+        self.messages.append(message)
+        # A deferred index catches up on it once loaded
+        if self.search is not None:
+            self.search.add(message_id, message)
+        self.persist(storage.MESSAGE, message)
+        return message_id
+
+    # Pre: at most one of before/after is a message ID, limit is positive,
+    #       channel is None for "ALL" or a channel username is a member of
+    # Post: returns (page, more), page holding up to limit messages oldest
+    #       first with their ID appended as a fifth element, and more telling
+    #       whether history continues past the page
+    # Purpose: serves one page of history by position, starting at the
+    #       cursor, skipping senders blocked either way. With neither
+    #       cursor given the newest messages are returned.
+    def history_page(self, username, before=None, after=None, limit=None, channel=None):
+        if limit is None:
+            limit = self.history_page_size
+        limit = max(1, min(limit, MAX_HISTORY_PAGE))
+
+        messages = self.messages if channel is None else self.channels.history(channel)
+        blocked = self.blocks.hidden(username)
+        end = len(messages)
+        page = []
+
+        if after is not None:
+            position = max(after + 1, 0)
+            while position < end and len(page) < limit:
+                message = messages[position]
+                if message[0] not in blocked:
+                    page.append(message + [position])
+                position += 1
+
+            return page, position < end
+
+        position = end if before is None else max(min(before, end), 0)
+        while position > 0 and len(page) < limit:
+            position -= 1
+            message = messages[position]
+            if message[0] not in blocked:
+                page.append(message + [position])
+
+        page.reverse()
+        return page, position > 0
+
+    # Pre: after is the ID of the last message username saw, in channel if
+    #       given
+    # Post: returns the history replies holding every message after it
+    #       oldest first, or None if a full sync is needed: after isn't a
+    #       message ID, the messages after it aren't all held in memory any
+    #       more or there are over MAX_RESUME of them
+    def resume_replies(self, username, after, channel=None):
+        if type(after) is not int:
+            return None
+
+        messages = self.messages if channel is None else self.channels.history(channel)
+        held_from = len(messages) - messages.held
+
+        if not held_from - 1 <= after < len(messages) or len(messages) - 1 - after > MAX_RESUME:
+            return None
+
+        replies = []
+        while True:
+            reply = self.history_reply(username, after=after, limit=MAX_HISTORY_PAGE, channel=channel)
+            reply["HISTORY"]["resumed"] = True
+            replies.append(reply)
+            if not reply["HISTORY"]["more"]:
+                return replies
+            after = reply["HISTORY"]["after"]
+
+    # Pre: resuming is whether username sent RESUME at login, after the ID
+    #       of the last message they saw there, in channel if given
+    # Post: returns the history replies to send them at login: what they
+    #       missed if they are resuming and it can be sent, otherwise the
+    #       newest page. A resuming client's cursors say whether it resumed.
+    def login_history(self, username, channel=None, resuming=False, after=None):
+        replies = self.resume_replies(username, after, channel) if resuming else None
+
+        if replies is None:
+            replies = [self.history_reply(username, channel=channel)]
+            if resuming:
+                replies[0]["HISTORY"]["resumed"] = False
+
+        return replies
+
+    # Pre: query is the text of a /Search, page counts from 1
+    # Post: returns (results, total), the page of public messages holding
+    #       every term of the query that username may see, best first with
+    #       their ID appended, and how many matched in all
+    def search_messages(self, username, query, page=1):
+        ids, total = self.search.search(query, self.blocks.hidden(username), self.messages, page)
+        return [self.messages[message_id] + [message_id] for message_id in ids], total
+
+    # Pre: as for history_page
+    # Post: returns a frame's worth of history, the page in MESSAGES and in
+    #       HISTORY the cursor a client uses to ask for the pages around it
+    def history_reply(self, username, before=None, after=None, limit=None, channel=None):
+        page, more = self.history_page(username, before, after, limit, channel)
+
+        messages = self.messages if channel is None else self.channels.history(channel)
+        cursor = {"before": page[0][4] if page else len(messages), "more": more}
+        if page:
+            cursor["after"] = page[-1][4]
+        if channel is not None:
+            cursor["channel"] = channel
+
+        return {"HISTORY": cursor, "MESSAGES": page}
+
+    # Pre: user is connected to this process and a member of channel,
+    #       resuming and after as for login_history
+    # Post: the newest page of the channel's history, or what they missed of
+    #       it, is sent to them after anything already batched for them
+    def send_channel_history(self, user, channel, resuming=False, after=None):
+        outbox = self.transport_map.get(user)
+        if outbox is not None:
+            self.batcher.flush()
+            for reply in self.login_history(user, channel, resuming, after):
+                outbox.send(Frame.encode(reply))
+
+    # Pre: user is connected to this process, after the inbox ID of the
+    #       newest DM they say they have received, or None
+    # Post: the DMs still pending after it are sent to them, after anything
+    #       already batched for them
+    # Purpose: delivers what arrived while the user was away by looking up
+    #       their inbox, in pages no larger than history pages
+    def send_inbox(self, user, after=None):
+        outbox = self.transport_map.get(user)
+        if outbox is None:
+            return
+
+        pending = self.inboxes.after(user, after)
+        if pending:
+            self.batcher.flush()
+        for start in range(0, len(pending), MAX_HISTORY_PAGE):
+            outbox.send(Frame.encode({"MESSAGES": pending[start:start + MAX_HISTORY_PAGE]}))
+
+    # Flushes anything not yet sent or on disk
+    def close(self):
+        self.batcher.flush()
+        if self.persistence is not None:
+            self.persistence.close()
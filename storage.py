@@ -0,0 +1,647 @@
+"""storage
+Persistence engine for the Chatterbox server
+
+Server state is kept as a pickle snapshot (server_data.pkl by default) plus a
+write-ahead journal of every change accepted since that snapshot was taken.
+Journal records are appended as they happen and fsync'd in batches, and the
+snapshot is periodically rewritten from a worker thread so the event loop
+never has to stop for a full dump.
+
+The journal is split into segments named after the sequence number of their
+first record, e.g. server_data.0000000000000042.journal. Once a snapshot
+covering a segment is safely on disk the segment is deleted.
+
+Messages are not pickled into the snapshot. Each snapshot appends the
+messages accepted since the previous one to an append-only archive
+(server_data.history, with an offsets index in server_data.history.idx) and
+the snapshot only records how many archived messages it covers. That keeps
+snapshots proportional to what changed, and lets the server memory map the
+archive instead of loading it at startup. The history itself is a
+history.MessageStore, which only holds the newest messages in memory and
+reads older ones through that mapping.
+
+Channels (see channels.py) are pickled after the sequence number, each
+with its members and the number of its messages archived. Channel histories
+are archived the same way as the public one, each to a pair of files of its
+own (server_data.channel-<name in hex>.history and .history.idx). Snapshots
+written before channels existed have none, older ones with channels carry
+each channel's whole history.
+Pending DMs (see inbox.py) are pickled after the channels, likewise missing
+from older snapshots.
+
+The search index (see search.py) is saved to server_data.search along with
+a snapshot once enough messages have been indexed since it was last saved,
+each save appending only what was indexed since the last, and is written
+out whole when the server stops.
+"""
+import glob
+import json
+import mmap
+import os
+import pickle
+import struct
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import inbox
+import metrics
+import search
+from framing import HEADER, HEADER_SIZE, encode_frame
+from history import MessageStore
+
+DEFAULT_FSYNC_INTERVAL = 0.05  # Seconds a journal record may wait for fsync
+DEFAULT_FSYNC_BATCH = 256  # Records that force an fsync before the interval
+DEFAULT_SNAPSHOT_EVERY = 1000  # Journal records between snapshots
+
+# Journal record types
+MESSAGE = "message"
+JOIN = "join"
+BLOCK = "block"
+UNBLOCK = "unblock"
+CHANNEL_MESSAGE = "channel_message"
+CHANNEL_JOIN = "channel_join"
+CHANNEL_LEAVE = "channel_leave"
+INBOX = "inbox"
+INBOX_ACK = "inbox_ack"
+
+
+OFFSET = struct.Struct("!Q")  # Entry in the archive's offsets index
+
+# Each is only observed from the one thread doing that work
+FSYNC_SECONDS = metrics.Histogram('chatterbox_journal_fsync_seconds', 'Time each journal fsync took')
+COMMIT_SECONDS = metrics.Histogram('chatterbox_journal_commit_seconds',
+                                   'Time from a journal record being written to it being fsync\'d')
+SNAPSHOT_SECONDS = metrics.Histogram('chatterbox_snapshot_seconds', 'Time taken to write each snapshot')
+
+
+# Pre: path names a snapshot written by the server, which may not exist yet
+# Post: returns (messages, all_users_ever_logged, client_blocked_users,
+#       channels, inboxes, seq)
+# Purpose: reads the three pickled state objects the server has always
+#       stored, followed by the journal sequence number the snapshot covers
+#       (missing from snapshots written before the journal existed), the
+#       channels (missing from snapshots older than channels) and the
+#       inboxes (missing from snapshots older than inboxes). Current
+#       snapshots store the number of archived messages in place of the
+#       message list itself, older ones the whole list.
+def read_snapshot(path):
+    messages = None
+    users = None
+    blocked = None
+    channels = None
+    inboxes = None
+    seq = 0
+
+    try:
+        with open(path, 'rb') as f:
+            messages = pickle.load(f)
+            users = pickle.load(f)
+            blocked = pickle.load(f)
+
+            try:
+                seq = pickle.load(f)
+                channels = pickle.load(f)
+                inboxes = pickle.load(f)
+            except EOFError:
+                pass
+    except FileNotFoundError:
+        pass
+
+    if messages is None:
+        messages = list()
+
+    if users is None:
+        users = set()
+
+    if blocked is None:
+        blocked = defaultdict(dict)
+
+    if channels is None:
+        channels = dict()
+
+    if inboxes is None:
+        inboxes = dict()
+
+    return messages, users, blocked, channels, inboxes, seq
+
+
+# Pre: state is a (messages, users, blocked, channels, inboxes) tuple private to the caller,
+#       where messages may be the archived message count
+# Post: the snapshot at path is atomically replaced
+# Purpose: writes the snapshot to a temporary file, syncs it and renames it
+#       over the old one so a crash never leaves a half written snapshot
+def write_snapshot(path, state, seq):
+    messages, users, blocked, channels, inboxes = state
+    tmp_path = path + '.tmp'
+
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(messages, f)
+        pickle.dump(users, f)
+        pickle.dump(blocked, f)
+        pickle.dump(seq, f)
+        pickle.dump(channels, f)
+        pickle.dump(inboxes, f)
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(tmp_path, path)
+
+
+# Pre: path names a journal segment
+# Post: yields each intact record in the segment in order
+# Purpose: replays a segment, stopping at a torn final line left behind by a
+#       crash in the middle of a write
+def read_journal(path):
+    with open(path, 'rb') as f:
+        for line in f:
+            try:
+                yield json.loads(line.decode('utf-8'))
+            except ValueError:
+                return
+
+
+# Applies a single journal record to the in-memory state, new_history(name)
+# returning the history of a channel being created
+def apply_record(record, messages, users, blocked, channels, inboxes, new_history):
+    op = record["op"]
+    data = record["data"]
+
+    if op == MESSAGE:
+        messages.append(data)
+
+    elif op == JOIN:
+        users.add(data)
+
+    elif op == BLOCK:
+        user, target = data
+        if user not in blocked:
+            blocked[user] = set()
+        blocked[user].add(target)
+
+    elif op == UNBLOCK:
+        user, target = data
+        if user in blocked:
+            blocked[user].discard(target)
+
+    elif op == CHANNEL_JOIN:
+        user, name = data
+        if name not in channels:
+            channels[name] = {"members": set(), "messages": new_history(name)}
+        channels[name]["members"].add(user)
+
+    elif op == CHANNEL_LEAVE:
+        user, name = data
+        if name in channels:
+            channels[name]["members"].discard(user)
+
+    elif op == CHANNEL_MESSAGE:
+        name, message = data
+        channels[name]["messages"].append(message)
+
+    elif op == INBOX:
+        user, message = data
+        inboxes.add(user, message)
+
+    elif op == INBOX_ACK:
+        user, through = data
+        inboxes.ack(user, through)
+
+
+def _copy_inbox(inbox):
+    return {"first": inbox["first"], "messages": list(inbox["messages"])}
+
+
+class MessageArchive:
+    """Append-only on-disk message history
+
+    The data file holds every message as a length prefixed JSON frame and the
+    index file holds the offset of each frame as a fixed size integer, so the
+    n-th message can be found without reading the ones before it.
+    """
+
+    def __init__(self, root):
+        self.data_path = root + '.history'
+        self.index_path = root + '.history.idx'
+
+    # Pre: count is the number of messages a snapshot says are archived
+    # Post: the archive holds exactly count messages
+    # Purpose: drops anything appended by a snapshot that never completed,
+    #       the journal still holds those messages
+    def truncate(self, count):
+        try:
+            index_size = os.path.getsize(self.index_path)
+        except FileNotFoundError:
+            index_size = 0
+
+        if index_size < count * OFFSET.size:
+            raise ValueError("Message archive holds fewer messages than the snapshot expects")
+
+        if count == 0:
+            data_size = 0
+        else:
+            with open(self.index_path, 'rb') as f:
+                f.seek((count - 1) * OFFSET.size)
+                last = OFFSET.unpack(f.read(OFFSET.size))[0]
+            with open(self.data_path, 'rb') as f:
+                f.seek(last)
+                data_size = last + HEADER_SIZE + HEADER.unpack(f.read(HEADER_SIZE))[0]
+
+        for path, size in ((self.index_path, count * OFFSET.size), (self.data_path, data_size)):
+            with open(path, 'ab') as f:
+                f.truncate(size)
+
+    # Pre: messages is a list not shared with the event loop
+    # Post: the messages are appended to the archive and synced to disk
+    def extend(self, messages):
+        with open(self.data_path, 'ab') as data, open(self.index_path, 'ab') as index:
+            offset = data.tell()
+            offsets = bytearray()
+
+            for message in messages:
+                frame = encode_frame(json.dumps(message).encode('utf-8'))
+                data.write(frame)
+                offsets += OFFSET.pack(offset)
+                offset += len(frame)
+
+            index.write(offsets)
+
+            data.flush()
+            os.fsync(data.fileno())
+            index.flush()
+            os.fsync(index.fileno())
+
+    # Maps the first count messages without reading them
+    def map(self, count):
+        return MappedMessages(self, count)
+
+
+class MappedMessages:
+    """Read-only sequence view of an archive through mmap
+
+    Opening one costs the same whatever the size of the archive, messages are
+    only decoded when they are looked up.
+    """
+
+    def __init__(self, archive, count):
+        self._count = count
+        self._data = None
+        self._index = None
+
+        if count:
+            with open(archive.data_path, 'rb') as f:
+                self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            with open(archive.index_path, 'rb') as f:
+                self._index = mmap.mmap(f.fileno(), count * OFFSET.size, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self._count))]
+
+        if i < 0:
+            i += self._count
+        if not 0 <= i < self._count:
+            raise IndexError("archived message index out of range")
+
+        offset = OFFSET.unpack_from(self._index, i * OFFSET.size)[0]
+        size = HEADER.unpack_from(self._data, offset)[0]
+        start = offset + HEADER_SIZE
+        return json.loads(self._data[start:start + size].decode('utf-8'))
+
+
+class Journal:
+    """Append-only, line delimited JSON log with batched fsync
+
+    Records are written to the OS immediately but only fsync'd once per
+    fsync_interval (or every batch_size records), on a dedicated thread so
+    the event loop never blocks on the disk.
+    """
+
+    def __init__(self, path, loop, fsync_interval=DEFAULT_FSYNC_INTERVAL, batch_size=DEFAULT_FSYNC_BATCH):
+        self.path = path
+        self.loop = loop
+        self.fsync_interval = fsync_interval
+        self.batch_size = batch_size
+
+        self._file = open(path, 'ab')
+        self._pending = 0
+        self._oldest = None  # When the oldest record not yet fsync'd was written
+        self._flush_handle = None
+
+        # A single worker keeps fsyncs and closes of old segments in order
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def append(self, record):
+        self._file.write(json.dumps(record).encode('utf-8') + b'\n')
+        if self._pending == 0:
+            self._oldest = time.perf_counter()
+        self._pending += 1
+
+        if self._pending >= self.batch_size:
+            self.flush()
+        elif self._flush_handle is None:
+            self._flush_handle = self.loop.call_later(self.fsync_interval, self.flush)
+
+    # Hands everything written so far to the OS and schedules an fsync
+    def flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        if self._pending == 0:
+            return
+
+        self._pending = 0
+        self._file.flush()
+        self._executor.submit(self._fsync, self._file.fileno(), self._oldest)
+
+    @staticmethod
+    def _fsync(fileno, oldest):
+        started = time.perf_counter()
+        os.fsync(fileno)
+        finished = time.perf_counter()
+        FSYNC_SECONDS.observe(finished - started)
+        COMMIT_SECONDS.observe(finished - oldest)
+
+    # Pre: path names a segment that does not exist yet
+    # Post: subsequent records are appended to the new segment
+    # Purpose: starts a new segment, syncing and closing the old one in the
+    #       background once its pending fsyncs are done
+    def rotate(self, path):
+        self.flush()
+        old_file = self._file
+        self._executor.submit(self._sync_and_close, old_file)
+
+        self.path = path
+        self._file = open(path, 'ab')
+
+    # Flushes, syncs and closes the journal, waiting for background work
+    def close(self):
+        self.flush()
+        self._executor.submit(self._sync_and_close, self._file)
+        self._executor.shutdown(wait=True)
+
+    @staticmethod
+    def _sync_and_close(f):
+        os.fsync(f.fileno())
+        f.close()
+
+
+class Persistence:
+    """Snapshot plus write-ahead journal for the server's shared state"""
+
+    def __init__(self, path='server_data.pkl', fsync_interval=DEFAULT_FSYNC_INTERVAL,
+                 snapshot_every=DEFAULT_SNAPSHOT_EVERY, retention=None, index_every=search.DEFAULT_SAVE_EVERY,
+                 inbox_size=inbox.DEFAULT_MAX_PENDING):
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.snapshot_every = snapshot_every
+        self.retention = retention  # history.Retention for the message store
+        self.index_every = index_every  # Messages indexed between saves of the search index
+        self.inbox_size = inbox_size  # Unacknowledged DMs kept per user
+
+        self.seq = 0  # Sequence number of the last record journaled
+        self.journal = None
+
+        self._root = os.path.splitext(path)[0]
+        self.archive = MessageArchive(self._root)
+        self.index_path = self._root + '.search'
+        self._index_saved = 0  # Messages covered by the saved search index
+        self._index_size = 0  # Bytes of the index file holding that
+        self._archived = 0  # Messages already in the archive
+        self._channels_archived = {}  # Channel to its messages already in its archive
+        self._inboxes = {}  # Copy of the inboxes as of the last snapshot, only for its thread
+        self._state = None
+        self._archived_callback = None
+        self._index = None
+        self._since_snapshot = 0
+        self._snapshot = None  # Future for the snapshot being written, if any
+        self._snapshot_executor = ThreadPoolExecutor(max_workers=1)
+
+    def _segment_path(self, first_seq):
+        return '{}.{:016d}.journal'.format(self._root, first_seq)
+
+    # Journal segments on disk, oldest first
+    def _segments(self):
+        return sorted(glob.glob(glob.escape(self._root) + '.*.journal'))
+
+    # Names are hex encoded without their "#" so two differing only in case
+    # don't share files on a case-insensitive file system
+    def _channel_archive(self, name):
+        return MessageArchive('{}.channel-{}'.format(self._root, name[1:].encode('utf-8').hex()))
+
+    # Pre: name is a valid channel name, archived the number of its messages
+    #       in its archive
+    # Post: returns the channel's history, evicting to its own archive under
+    #       the same retention policy as the public history
+    def channel_history(self, name, archived=0):
+        return MessageStore(self._channel_archive(name), archived, self.retention)
+
+    # Pre: nothing has been journaled yet
+    # Post: returns (messages, all_users_ever_logged, client_blocked_users,
+    #       channels, inboxes), inboxes an inbox.InboxIndex
+    # Purpose: rebuilds the state from the latest snapshot and replays every
+    #       journal record written after it. The archived history is memory
+    #       mapped, and unless lazy is set the newest of it the retention
+    #       policy allows is read back into memory, so with lazy set startup
+    #       does not depend on how much history there is.
+    def load(self, lazy=False):
+        messages, users, blocked, channels, inboxes, seq = read_snapshot(self.path)
+        inboxes = inbox.InboxIndex(inboxes, self.inbox_size)
+
+        # Snapshots from before the archive existed carry the whole list, the
+        # first compaction will move it into the archive
+        if isinstance(messages, int):
+            self._archived = messages
+            self.archive.truncate(messages)
+
+            store = MessageStore(self.archive, messages, self.retention)
+            if not lazy:
+                store.preload()
+        else:
+            store = MessageStore(self.archive, 0, self.retention)
+            store.extend(messages)
+        messages = store
+
+        for name, channel in channels.items():
+            if isinstance(channel["messages"], int):
+                archived = channel["messages"]
+                self._channel_archive(name).truncate(archived)
+
+                history = self.channel_history(name, archived)
+                if not lazy:
+                    history.preload()
+            else:
+                archived = 0
+                history = self.channel_history(name)
+                history.extend(channel["messages"])
+
+            self._channels_archived[name] = archived
+            channel["messages"] = history
+
+        for segment in self._segments():
+            for record in read_journal(segment):
+                if record["seq"] > seq:
+                    apply_record(record, messages, users, blocked, channels, inboxes, self.channel_history)
+                    seq = record["seq"]
+                    self._since_snapshot += 1
+
+        self.seq = seq
+        self._inboxes = {user: _copy_inbox(inboxes.inboxes[user]) for user in inboxes.inboxes}
+        inboxes.take_changed()
+        return messages, users, blocked, channels, inboxes
+
+    # Pre: messages is the history returned by load()
+    # Post: returns the saved search.SearchIndex brought up to date with
+    #       messages, or a new one if none was saved
+    # Purpose: only indexes the messages the saved index doesn't cover
+    def load_index(self, messages):
+        index, size = search.load(self.index_path)
+        index = self.saved_index(index, size, len(messages))
+        index.update(messages)
+        return index
+
+    # Pre: index and size are what search.load returned for index_path,
+    #       count the number of messages in the history
+    # Post: returns index, or a new empty one if there was none or it covers
+    #       more than count messages
+    # Purpose: a new index is saved empty right away so later saves can
+    #       append to it
+    def saved_index(self, index, size, count):
+        if index is None or index.count > count:
+            index = search.SearchIndex()
+            search.save(index, self.index_path)
+            size = os.path.getsize(self.index_path)
+
+        self._index_saved = index.count
+        self._index_size = size
+        return index
+
+    # Pre: state is a callable returning the live (messages, users, blocked,
+    #       channels, inboxes), inboxes the inbox.InboxIndex, archived one called with the number of messages in the
+    #       archive and a dict of the channels whose archives grew to their
+    #       number whenever a snapshot adds to them, index the live search
+    #       index if it is to be saved, which may be set later on through
+    #       index_loaded
+    # Post: records can be journaled
+    # Purpose: opens a fresh journal segment on the running loop
+    def open(self, loop, state, archived=None, index=None):
+        self.loop = loop
+        self._state = state
+        self._archived_callback = archived
+        self._index = index
+        self.journal = Journal(self._segment_path(self.seq + 1), loop, self.fsync_interval)
+
+    # Pre: index came from saved_index and has since been brought up to date
+    # Post: index is saved with snapshots and when the server stops
+    def index_loaded(self, index):
+        self._index = index
+
+    # Pre: op is one of the record types above and data is JSON serializable
+    # Post: the change is journaled and a snapshot is started if one is due
+    def record(self, op, data):
+        self.seq += 1
+        self.journal.append({"seq": self.seq, "op": op, "data": data})
+
+        self._since_snapshot += 1
+        if self._since_snapshot >= self.snapshot_every and self._snapshot is None:
+            self.compact()
+
+    # Pre: the journal is open
+    # Post: a snapshot of the current state is being written in the background
+    # Purpose: rotates the journal so everything up to now lives in segments
+    #       the snapshot will cover, then pickles a private copy of the state
+    #       off the event loop
+    def compact(self):
+        seq = self.seq
+        self.journal.rotate(self._segment_path(seq + 1))
+        self._since_snapshot = 0
+
+        # Shallow copies are cheap compared to pickling and keep the worker
+        # thread from seeing the loop mutate the state underneath it. Only the
+        # messages added since the last snapshot need copying, for channels
+        # as for the public history.
+        messages, users, blocked, live_channels, inboxes = self._state()
+        count = len(messages)
+        new_messages = messages[self._archived:count]
+
+        channels = {}
+        new_channel_messages = {}  # Channel to (messages archived, messages to append)
+        for name, channel in live_channels.items():
+            history = channel["messages"]
+            channel_count = len(history)
+            channels[name] = {"members": set(channel["members"]), "messages": channel_count}
+
+            archived = self._channels_archived.get(name, 0)
+            if channel_count > archived:
+                new_channel_messages[name] = (archived, history[archived:channel_count])
+
+        # Inboxes are copied as they change, the thread pickles the copies of
+        # the rest from earlier snapshots. No snapshot is being written while
+        # they are updated.
+        for user in inboxes.take_changed():
+            self._inboxes[user] = _copy_inbox(inboxes.inboxes[user])
+        state = (count, set(users), defaultdict(dict, {user: set(blocked[user]) for user in blocked}), channels,
+                 self._inboxes)
+
+        # The index covers exactly the messages the snapshot does, only what
+        # was indexed since it was last saved is copied
+        index = None
+        if self._index is not None and self._index.count - self._index_saved >= self.index_every:
+            index = self._index.delta(self._index_saved)
+
+        channel_counts = {name: channels[name]["messages"] for name in new_channel_messages}
+        self._snapshot = self.loop.run_in_executor(self._snapshot_executor, self._write_snapshot,
+                                                   self._archived, new_messages, new_channel_messages, state, seq,
+                                                   index, self._index_size)
+        self._snapshot.add_done_callback(lambda future: self._snapshot_done(future, count, channel_counts, index))
+
+    # Returns the size of the search index file once index is appended to it
+    def _write_snapshot(self, archived, new_messages, new_channel_messages, state, seq, index, index_size):
+        started = time.perf_counter()
+        self.archive.truncate(archived)
+        self.archive.extend(new_messages)
+        for name, (channel_archived, channel_messages) in new_channel_messages.items():
+            archive = self._channel_archive(name)
+            archive.truncate(channel_archived)
+            archive.extend(channel_messages)
+        write_snapshot(self.path, state, seq)
+        if index is not None:
+            index_size = search.append(index, self.index_path, index_size)
+
+        # Every segment that started at or before seq is now covered
+        for segment in self._segments():
+            if segment < self._segment_path(seq + 1):
+                os.remove(segment)
+
+        SNAPSHOT_SECONDS.observe(time.perf_counter() - started)
+        return index_size
+
+    def _snapshot_done(self, future, count, channel_counts, index):
+        self._snapshot = None
+        if future.exception() is not None:
+            metrics.log.error("Snapshot failed: %s", future.exception())
+        else:
+            self._archived = count
+            self._channels_archived.update(channel_counts)
+            if index is not None:
+                self._index_saved = index["since"] + len(index["lengths"])
+                self._index_size = future.result()
+            if self._archived_callback is not None:
+                self._archived_callback(count, channel_counts)
+
+    # Flushes the journal, waits for any snapshot still being written and
+    # saves the search index if it has grown, every message it covers is now
+    # in the journal or the archive
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+        self._snapshot_executor.shutdown(wait=True)
+
+        if self._index is not None and self._index.count > self._index_saved:
+            search.save(self._index, self.index_path)
+            self._index_saved = self._index.count
+            self._index_size = os.path.getsize(self.index_path)
@@ -0,0 +1,68 @@
+import asyncio
+
+import codec
+from batching import Batcher
+
+
+class Recipient:
+    """Stands in for an outbox.Outbox, encoding frames as they are sent"""
+
+    roster = False
+
+    def __init__(self, chosen):
+        self.codec = chosen
+        self.received = []
+
+    def send(self, frame):
+        self.received.append(self.codec.decode(frame.encoded(self.codec)[4:]))
+
+
+def flushed(batcher, *adds):
+    async def run():
+        for add in adds:
+            add()
+        batcher.flush()
+
+    asyncio.run(run())
+
+
+def test_public_messages_batched_per_recipient_set():
+    outboxes = {"alice": Recipient(codec.JSON), "bob": Recipient(codec.BINARY), "carol": Recipient(codec.JSON)}
+    batcher = Batcher(outboxes)
+    everyone = frozenset(outboxes)
+    first = ["alice", "ALL", 1, "one", 0]
+    second = ["bob", "ALL", 2, "two", 1]
+
+    flushed(batcher, lambda: batcher.add_public(first, everyone),
+            lambda: batcher.add_public(second, frozenset(("alice", "bob"))))
+
+    assert outboxes["alice"].received == [{"MESSAGES": [first, second]}]
+    assert outboxes["bob"].received == [{"MESSAGES": [first, second]}]
+    assert outboxes["carol"].received == [{"MESSAGES": [first]}]
+
+
+def test_unencodable_message_dropped_alone():
+    outboxes = {"alice": Recipient(codec.JSON), "bob": Recipient(codec.BINARY)}
+    batcher = Batcher(outboxes)
+    everyone = frozenset(outboxes)
+    good = ["alice", "ALL", 1, "fine", 0]
+    bad = ["alice", "ALL", 2, {"not", "json"}, 1]
+    later = ["bob", "ALL", 3, "still here", 2]
+
+    flushed(batcher, lambda: batcher.add_public(good, everyone), lambda: batcher.add_public(bad, everyone),
+            lambda: batcher.add_public(later, everyone), lambda: batcher.add_direct("bob", ["alice", "bob", 4, {1}]),
+            lambda: batcher.add_direct("alice", ["bob", "alice", 5, "dm", 0]))
+
+    assert outboxes["alice"].received == [{"MESSAGES": [good, later]}, {"MESSAGES": [["bob", "alice", 5, "dm", 0]]}]
+    assert outboxes["bob"].received == [{"MESSAGES": [good, later]}]
+
+
+def test_surrogate_text_still_delivered():
+    outboxes = {"alice": Recipient(codec.JSON), "bob": Recipient(codec.BINARY)}
+    batcher = Batcher(outboxes)
+    message = ["alice", "ALL", 1, "lone \ud800", 0]
+
+    flushed(batcher, lambda: batcher.add_public(message, frozenset(outboxes)))
+
+    assert outboxes["alice"].received == [{"MESSAGES": [message]}]
+    assert outboxes["bob"].received == [{"MESSAGES": [message]}]
@@ -0,0 +1,38 @@
+import pytest
+
+import codec
+
+TEXTS = ["plain", "", "café 中文", "\U0001f600 non-BMP \U00010348", "lone \ud800 surrogate",
+         "\udfff", "😀 escaped pair"]
+
+
+@pytest.mark.parametrize("chosen", [codec.JSON, codec.BINARY])
+@pytest.mark.parametrize("text", TEXTS)
+def test_messages_round_trip(chosen, text):
+    message = {"MESSAGES": [["alice", "ALL", 1700000000, text, 7], [text or "bob", "#room", 1699999999, "reply"],
+                            ["bob", "alice", 1700000001, text]]}
+    assert chosen.decode(chosen.encode(message)) == message
+
+
+def test_json_is_utf8_unless_it_cannot_be():
+    assert codec.JSON.encode({"INFO": "\U0001f600"}) == '{"INFO":"\U0001f600"}'.encode('utf-8')
+    assert codec.JSON.encode({"INFO": "\ud800"}) == b'{"INFO":"\\ud800"}'
+
+
+def test_binary_packs_only_messages():
+    payload = codec.BINARY.encode({"MESSAGES": [["alice", "ALL", 1, "hi"]]})
+    assert payload[0] == codec.PACKED_MESSAGES
+
+    # Anything else, or messages that don't fit the layout, go as JSON
+    for message in ({"PING": True}, {"MESSAGES": [["alice", "ALL", "soon", "hi"]]},
+                    {"MESSAGES": [["alice", "ALL", 1, "hi"]], "HISTORY": {"before": 0, "more": False}}):
+        payload = codec.BINARY.encode(message)
+        assert payload == codec.JSON.encode(message)
+        assert codec.BINARY.decode(payload) == message
+
+
+def test_negotiate():
+    assert codec.negotiate(["bin1", "json"]) is codec.BINARY
+    assert codec.negotiate(["nope", "json"]) is codec.JSON
+    assert codec.negotiate(None) is codec.JSON
+    assert codec.negotiate([5, {}]) is codec.JSON
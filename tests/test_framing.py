@@ -0,0 +1,74 @@
+import pytest
+
+from framing import COMPRESSED, HEADER, FrameCompressor, FrameDecoder, FrameTooLarge, encode_frame
+
+
+def chunks(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def test_frames_split_across_feeds():
+    payloads = [b'{"PING":true}', b'', b'x' * 5000, b'{"MESSAGES":[]}']
+    stream = b''.join(encode_frame(payload) for payload in payloads)
+
+    for size in (1, 3, 4, 7, 4096, len(stream)):
+        decoder = FrameDecoder()
+        received = []
+        for chunk in chunks(stream, size):
+            received += decoder.feed(chunk)
+        assert received == payloads
+        assert decoder.buffered() == 0
+
+
+def test_partial_frame_stays_buffered():
+    decoder = FrameDecoder()
+    frame = encode_frame(b'hello')
+
+    assert decoder.feed(frame[:6]) == []
+    assert decoder.buffered() == 6
+    assert decoder.feed(frame[6:] + frame[:2]) == [b'hello']
+    assert decoder.buffered() == 2
+
+
+def test_oversized_header_is_rejected():
+    decoder = FrameDecoder(max_frame_size=16)
+    with pytest.raises(FrameTooLarge):
+        decoder.feed(HEADER.pack(17))
+
+
+def test_compressed_frames_split_across_feeds():
+    compressor = FrameCompressor(threshold=64)
+    payloads = [b'short', b'abc' * 1000, b'{"MESSAGES":[["a","ALL",1,"hi"]]}' * 40, b'abc' * 1000]
+    frames = [compressor.compress(encode_frame(payload)) for payload in payloads]
+
+    # Only the frames over the threshold are deflated, and they shrink
+    assert not HEADER.unpack_from(frames[0])[0] & COMPRESSED
+    assert all(HEADER.unpack_from(frame)[0] & COMPRESSED for frame in frames[1:])
+    assert len(frames[3]) < len(payloads[3])
+
+    stream = b''.join(frames)
+    for size in (1, 5, 100, len(stream)):
+        decoder = FrameDecoder()
+        decoder.enable_compression()
+        received = []
+        for chunk in chunks(stream, size):
+            received += decoder.feed(chunk)
+        assert received == payloads
+
+
+def test_compressed_frame_before_compression_is_enabled():
+    compressor = FrameCompressor(threshold=0)
+    frame = compressor.compress(encode_frame(b'x' * 100))
+
+    with pytest.raises(FrameTooLarge):
+        FrameDecoder().feed(frame)
+
+
+def test_inflated_size_is_bounded():
+    compressor = FrameCompressor(threshold=0)
+    frame = compressor.compress(encode_frame(b'\0' * 10000))
+
+    decoder = FrameDecoder(max_frame_size=1000)
+    decoder.enable_compression()
+    with pytest.raises(FrameTooLarge):
+        decoder.feed(frame)
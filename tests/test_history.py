@@ -0,0 +1,93 @@
+from history import MessageStore, Retention
+from storage import MessageArchive
+
+
+def message(i):
+    return ["user{}".format(i % 4), "ALL", 1700000000 + i, "message {} \U0001f600".format(i)]
+
+
+def test_everything_held_without_an_archive():
+    store = MessageStore(retention=Retention(messages=10))
+    store.extend(message(i) for i in range(100))
+
+    assert len(store) == store.held == 100
+    assert store[0] == message(0)
+    assert store[-1] == message(99)
+    assert store[10:13] == [message(i) for i in range(10, 13)]
+
+
+def test_only_archived_messages_are_evicted(tmp_path):
+    archive = MessageArchive(str(tmp_path / 'data'))
+    store = MessageStore(archive, retention=Retention(messages=10))
+    history = [message(i) for i in range(100)]
+    store.extend(history)
+    assert store.held == 100
+
+    archive.extend(history[:60])
+    store.archived_through(60)
+    assert store.held == 40
+    assert list(store) == history
+
+    archive.extend(history[60:])
+    store.archived_through(100)
+    assert store.held == 10
+    assert len(store) == 100
+    assert store[0] == history[0] and store[95] == history[95]
+
+    # New messages push the oldest archived ones out as they come
+    store.append(message(100))
+    assert store.held == 10
+    assert store[100] == message(100)
+    assert store[90] == history[90]
+
+
+def test_byte_limit(tmp_path):
+    archive = MessageArchive(str(tmp_path / 'data'))
+    store = MessageStore(archive, retention=Retention(messages=None, bytes=1000))
+    history = [message(i) for i in range(100)]
+    store.extend(history)
+    archive.extend(history)
+    store.archived_through(100)
+
+    assert 0 < store.nbytes <= 1000
+    assert store.held < 100
+    assert list(store) == history
+
+
+def test_reclaimed_rows_still_read(tmp_path):
+    archive = MessageArchive(str(tmp_path / 'data'))
+    store = MessageStore(archive, retention=Retention(messages=5))
+    history = [message(i) for i in range(3000)]
+    for i in range(0, 3000, 500):
+        store.extend(history[i:i + 500])
+        archive.extend(history[i:i + 500])
+        store.archived_through(i + 500)
+
+    assert store.held == 5
+    assert store[2999] == history[2999]
+    assert store[1234] == history[1234]
+
+
+def test_preload_reads_back_newest(tmp_path):
+    archive = MessageArchive(str(tmp_path / 'data'))
+    history = [message(i) for i in range(50)]
+    archive.extend(history)
+
+    store = MessageStore(archive, 50, Retention(messages=20))
+    assert store.held == 0
+    store.preload()
+    assert store.held == 20
+    assert list(store) == history
+
+
+def test_irregular_and_surrogate_messages(tmp_path):
+    archive = MessageArchive(str(tmp_path / 'data'))
+    store = MessageStore(archive, retention=Retention(messages=1))
+    history = [["alice", "ALL", "not a time", "odd"], ["alice", "ALL", 1, "lone \ud800"], message(2)]
+    store.extend(history)
+    assert list(store) == history
+
+    archive.extend(history)
+    store.archived_through(3)
+    assert store.held == 1
+    assert list(store) == history
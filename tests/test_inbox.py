@@ -0,0 +1,51 @@
+from inbox import InboxIndex
+
+
+def message(i):
+    return ["alice", "bob", i, "dm {}".format(i)]
+
+
+def test_ids_count_from_zero_per_user():
+    inboxes = InboxIndex({})
+    assert [inboxes.add("bob", message(i)) for i in range(3)] == [0, 1, 2]
+    assert inboxes.add("carol", message(0)) == 0
+    assert inboxes.take_changed() == {"bob", "carol"}
+    assert inboxes.take_changed() == set()
+
+
+def test_ack_drops_through_the_id():
+    inboxes = InboxIndex({})
+    for i in range(5):
+        inboxes.add("bob", message(i))
+
+    assert inboxes.ack("bob", 2)
+    assert [m[4] for m in inboxes.after("bob")] == [3, 4]
+    assert inboxes.after("bob", 3) == [message(4) + [4]]
+
+
+def test_ack_out_of_bounds_drops_nothing():
+    inboxes = InboxIndex({})
+    for i in range(3):
+        inboxes.add("bob", message(i))
+    inboxes.ack("bob", 0)
+
+    # Already acknowledged, never issued, or not an inbox at all
+    for through in (-1, 0, 3, 10 ** 9):
+        assert not inboxes.holds("bob", through)
+        assert not inboxes.ack("bob", through)
+    assert not inboxes.ack("nobody", 0)
+
+    assert [m[4] for m in inboxes.after("bob")] == [1, 2]
+    assert inboxes.inboxes["bob"]["first"] == 1
+
+
+def test_full_inbox_drops_oldest():
+    inboxes = InboxIndex({}, max_pending=3)
+    for i in range(5):
+        inboxes.add("bob", message(i))
+
+    assert [m[4] for m in inboxes.after("bob")] == [2, 3, 4]
+    assert not inboxes.ack("bob", 1)
+    assert inboxes.ack("bob", 4)
+    assert inboxes.after("bob") == []
+    assert inboxes.add("bob", message(5)) == 5
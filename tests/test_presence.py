@@ -0,0 +1,39 @@
+from presence import Roster
+
+
+def roster_of(frame):
+    return frame.message["ROSTER"]
+
+
+def test_catch_up_within_an_epoch():
+    roster = Roster(["alice", "bob"], set(), epoch="one")
+    version = roster.update("alice", True)
+    roster.update("bob", True)
+    roster.update("alice", False)
+
+    frames = roster.catch_up(version, "one")
+    assert len(frames) == 1
+    assert roster_of(frames[0]) == {"epoch": "one", "version": 3, "since": 1, "joined": ["bob"], "left": ["alice"]}
+
+
+def test_other_epoch_gets_a_snapshot():
+    roster = Roster(["alice", "bob"], set(), epoch="two")
+    roster.update("alice", True)
+
+    # Same version number, but counted by an earlier start of the server
+    for epoch in ("one", None):
+        frames = roster.catch_up(1, epoch)
+        snapshot = roster_of(frames[0])
+        assert snapshot["epoch"] == "two"
+        assert "users" in snapshot
+        assert [roster_of(frame)["version"] for frame in frames][-1] == 1
+
+
+def test_epochs_differ_per_roster():
+    assert Roster([], set()).epoch != Roster([], set()).epoch
+
+
+def test_display_survives_odd_names():
+    roster = Roster(["alice", 5], {"alice"})
+    assert roster.display_all().endswith("\nalice : ONLINE\n5 : OFFLINE")
+    assert roster.display_online().endswith("\nalice")
@@ -0,0 +1,104 @@
+import search
+from search import SearchIndex
+
+WORDS = ["apple", "banana", "cherry", "delta", "echo", "foxtrot", "golf"]
+
+
+def messages(start, stop):
+    return [["user{}".format(i % 3), "ALL", i, " ".join(WORDS[(i * k) % len(WORDS)] for k in range(1, i % 4 + 2))]
+            for i in range(start, stop)]
+
+
+def built(history):
+    index = SearchIndex()
+    index.update(history)
+    return index
+
+
+def assert_same(index, expected):
+    assert index.count == expected.count
+    assert list(index.lengths) == list(expected.lengths)
+    assert index.total_length == expected.total_length
+    assert index.documents == expected.documents
+    assert {word: list(postings) for word, postings in index.postings.items()} == \
+        {word: list(postings) for word, postings in expected.postings.items()}
+
+
+def test_delta_merges_into_saved_copy():
+    history = messages(0, 50)
+    index = built(history[:20])
+    saved = built(history[:20])
+
+    index.update(history)
+    saved.merge(index.delta(20))
+    assert_same(saved, built(history))
+
+
+def test_deltas_appended_to_file(tmp_path):
+    path = str(tmp_path / 'data.search')
+    history = messages(0, 120)
+
+    index = built(history[:40])
+    search.save(index, path)
+    loaded, size = search.load(path)
+    assert_same(loaded, index)
+
+    # Two saves appending only what was indexed since the one before
+    saved = 40
+    for end in (90, 120):
+        index.update(history[:end])
+        delta = index.delta(saved)
+        size = search.append(delta, path, size)
+        saved = delta["since"] + len(delta["lengths"])
+
+    loaded, loaded_size = search.load(path)
+    assert loaded_size == size
+    assert_same(loaded, built(history))
+    assert loaded.search("apple banana", set(), history) == built(history).search("apple banana", set(), history)
+
+
+def test_torn_delta_is_ignored(tmp_path):
+    path = str(tmp_path / 'data.search')
+    history = messages(0, 30)
+    index = built(history[:10])
+    search.save(index, path)
+    _, size = search.load(path)
+
+    index.update(history)
+    with open(path, 'ab') as f:
+        f.write(b'\x80\x05truncated')
+
+    loaded, loaded_size = search.load(path)
+    assert loaded_size == size
+    assert_same(loaded, built(history[:10]))
+
+    # The next save cuts the torn bytes off before appending
+    search.append(index.delta(10), path, size)
+    assert_same(search.load(path)[0], built(history))
+
+
+def test_missing_index(tmp_path):
+    assert search.load(str(tmp_path / 'none.search')) == (None, 0)
+
+
+def test_update_limit():
+    history = messages(0, 25)
+    index = SearchIndex()
+    index.update(history, 10)
+    assert index.count == 10
+    while index.count < len(history):
+        index.update(history, 10)
+    assert_same(index, built(history))
+
+
+def test_search_ranks_and_hides():
+    history = [["alice", "ALL", 1, "apple apple pie"], ["bob", "ALL", 2, "apple"], ["carol", "ALL", 3, "banana"],
+               ["bob", "ALL", 4, "apple pie"]]
+    index = built(history)
+
+    ids, total = index.search("apple", set(), history)
+    assert total == 3 and set(ids) == {0, 1, 3}
+    ids, total = index.search("apple pie", set(), history)
+    assert total == 2 and set(ids) == {0, 3}
+    assert index.search("apple pie", {"alice"}, history) == ([3], 1)
+    assert index.search("kiwi", set(), history) == ([], 0)
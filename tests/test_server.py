@@ -0,0 +1,37 @@
+import pytest
+
+from server import valid_message, valid_username
+
+
+@pytest.mark.parametrize("message", [
+    ["alice", "ALL", 1, "hi"],
+    ["alice", "#room", 0, ""],
+    ["alice", "bob", -5, "\U0001f600 non-BMP"],
+])
+def test_valid_messages(message):
+    assert valid_message(message)
+
+
+@pytest.mark.parametrize("message", [
+    ("alice", "ALL", 1, "hi"),
+    ["alice", "ALL", 1],
+    ["alice", "ALL", 1, "hi", 2],
+    ["alice", "ALL", "1", "hi"],
+    ["alice", "ALL", True, "hi"],
+    ["alice", None, 1, "hi"],
+    ["alice", "ALL", 1, "lone \ud800"],
+    ["\udfff", "ALL", 1, "hi"],
+    ["alice", "b\ud83d", 1, "hi"],
+])
+def test_invalid_messages(message):
+    assert not valid_message(message)
+
+
+@pytest.mark.parametrize("name", ["alice", "Bob_2", "all", "a#b", "\U0001f600"])
+def test_valid_usernames(name):
+    assert valid_username(name)
+
+
+@pytest.mark.parametrize("name", [5, None, ["alice"], {"name": "alice"}, "", "ALL", "#room", "#", "bad \ud800"])
+def test_invalid_usernames(name):
+    assert not valid_username(name)
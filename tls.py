@@ -0,0 +1,166 @@
+"""tls
+TLS contexts, session resumption and handshake offload for Chatterbox
+
+The server builds its context once, before forking any workers, so every
+process shares the same session ticket keys and a client reconnecting to
+any of them can resume its session instead of doing a full handshake. A
+ClientContext keeps the session of the client's last connection and offers
+it again when the client reconnects.
+
+With --tls-workers the chat loop does no TLS at all. That many terminator
+processes accept clients on the port, do the handshakes and encryption, and
+relay the plaintext to the server over a Unix domain socket per server
+process, so a burst of reconnections can't starve message delivery.
+"""
+import asyncio
+import itertools
+import os
+import ssl
+
+import metrics
+from metrics import log
+
+HANDSHAKES = metrics.Counter('chatterbox_tls_handshakes_total', 'TLS handshakes completed')
+RESUMED = metrics.Counter('chatterbox_tls_resumed_total', 'TLS handshakes that resumed an earlier session')
+
+
+# Pre: none
+# Post: returns the context every server process and terminator serves
+#       clients with
+def server_context(certfile='localhost.pem', cafile='ca.crt'):
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH, cafile=cafile)
+    context.load_cert_chain(certfile)
+
+    # Resumption uses tickets (and the session cache for TLS 1.2), both on
+    # by default, but make sure nothing has turned tickets off
+    context.options &= ~ssl.OP_NO_TICKET
+    return context
+
+
+# Counts a completed handshake on transport, if it is a TLS one
+def count_handshake(transport):
+    ssl_object = transport.get_extra_info('ssl_object')
+    if ssl_object is None:
+        return
+
+    HANDSHAKES.inc()
+    if ssl_object.session_reused:
+        RESUMED.inc()
+
+
+class ClientContext(ssl.SSLContext):
+    """Client context that offers the session of its last connection"""
+
+    session = None
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        return super().wrap_bio(incoming, outgoing, server_side, server_hostname,
+                                session if session is not None else self.session)
+
+    # Pre: transport is a connection made with this context
+    # Post: returns True once its session is kept for the next connection.
+    #       With TLS 1.3 the session only exists once the server has sent
+    #       something after the handshake.
+    def remember(self, transport):
+        ssl_object = transport.get_extra_info('ssl_object')
+        if ssl_object is None or ssl_object.session is None:
+            return False
+
+        self.session = ssl_object.session
+        return True
+
+
+# The same context ssl.create_default_context() would build, but one that
+# resumes sessions
+def client_context(cafile=None):
+    context = ClientContext(ssl.PROTOCOL_TLS_CLIENT)
+    if cafile is not None:
+        context.load_verify_locations(cafile)
+    else:
+        context.load_default_certs(ssl.Purpose.SERVER_AUTH)
+    return context
+
+
+class Relay(asyncio.Protocol):
+    """One side of a relayed connection, writing what it reads to the other
+
+    Reading from either side pauses while the other side's transport is
+    backed up, so a slow client still applies backpressure to the server.
+    """
+
+    def __init__(self, peer=None):
+        self.peer = peer
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.peer.transport.write(data)
+
+    def pause_writing(self):
+        self.peer.transport.pause_reading()
+
+    def resume_writing(self):
+        self.peer.transport.resume_reading()
+
+    def connection_lost(self, exc):
+        if self.peer is not None and self.peer.transport is not None:
+            self.peer.transport.close()
+
+
+class ClientRelay(Relay):
+    """A client's TLS connection to a terminator, relayed to a server process"""
+
+    def __init__(self, upstreams):
+        super().__init__()
+        self.upstreams = upstreams
+
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        count_handshake(transport)
+
+        # Nothing is read from the client until the server side is there
+        transport.pause_reading()
+        asyncio.ensure_future(self._connect(next(self.upstreams)))
+
+    async def _connect(self, path):
+        loop = asyncio.get_event_loop()
+        try:
+            _, self.peer = await loop.create_unix_connection(lambda: Relay(self), path)
+        except OSError as e:
+            log.error("Could not relay a client to %s: %s", path, e)
+            self.transport.close()
+            return
+
+        if self.transport.is_closing():
+            self.peer.transport.close()
+        else:
+            self.transport.resume_reading()
+
+
+# Pre: context is the server's context, upstreams the Unix socket paths the
+#       server processes listen on
+# Post: accepts TLS clients on host:port until the process is stopped,
+#       spreading them over the upstreams in turn
+def terminate(host, port, context, upstreams, metrics_port=None):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    upstreams = itertools.cycle(upstreams)
+    server = loop.run_until_complete(loop.create_server(lambda: ClientRelay(upstreams), host, port, ssl=context,
+                                                        reuse_port=True))
+    log.info('Terminating TLS at %s (pid %d)', (host, port), os.getpid())
+
+    metrics_server = None
+    if metrics_port is not None:
+        metrics_server = metrics.serve(loop, metrics_port)
+        log.info('Metrics at http://127.0.0.1:%d/metrics (pid %d)', metrics_port, os.getpid())
+
+    try:
+        loop.run_forever()
+    finally:
+        server.close()
+        if metrics_server is not None:
+            metrics_server.close()
+        loop.close()